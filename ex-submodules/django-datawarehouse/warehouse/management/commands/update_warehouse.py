@@ -18,8 +18,37 @@ class Command(BaseCommand):
             help='Cleanup the tables before starting the warehouse',
             default=False,
         )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            dest='bulk',
+            help='Use the set-based engine for the base level data, if the runner supports it',
+            default=False,
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            help='Only update what changed since the last run, if the runner supports it',
+            default=False,
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            help='Number of worker processes to use, if the runner supports it',
+            default=None,
+        )
+
     def handle(self, *args, **options):
         start_date = None if len(args) < 1 else string_to_datetime(args[0])
         end_date = None if len(args) < 2 else string_to_datetime(args[1]) 
         cleanup = options["cleanup"]
-        return runner.update_warehouse(start_date, end_date, cleanup) 
+        runner_options = {}
+        if options["bulk"]:
+            runner_options["bulk"] = True
+        if options["incremental"]:
+            runner_options["incremental"] = True
+        if options["workers"]:
+            runner_options["workers"] = options["workers"]
+        return runner.update_warehouse(start_date, end_date, cleanup, **runner_options) 
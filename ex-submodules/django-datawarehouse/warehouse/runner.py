@@ -13,8 +13,17 @@ class WarehouseRunner(object):
     """
     This class gets executed by the warehouse management command.
     Subclasses control how data gets into the warehouse.
+
+    Any keyword options passed in (e.g. from the management command)
+    override the class attributes of the same name.
     """
-    
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if not hasattr(self, name):
+                raise TypeError("%s has no option %s" % (self.__class__.__name__, name))
+            setattr(self, name, value)
+
     def cleanup(self, start, end):
         """
         Cleanup all warehouse data between start and end.
@@ -44,16 +53,17 @@ class DemoWarehouseRunner(WarehouseRunner):
                "this actually do something.") % (run_record.start, run_record.end))
     
 
-def get_warehouse_runner():
+def get_warehouse_runner(**options):
     """
     Get the configured runner, bsed on the WAREHOUSE_RUNNER setting, or
-    the default demo runner if none found. 
+    the default demo runner if none found. Any options are passed on to
+    the runner.
     """
     classpath = settings.WAREHOUSE_RUNNER if hasattr(settings, "WAREHOUSE_RUNNER") \
         else "warehouse.runner.DemoWarehouseRunner"
-    return to_function(classpath, failhard=True)()
+    return to_function(classpath, failhard=True)(**options)
     
-def update_warehouse(start_date=None, end_date=None, cleanup=False):
+def update_warehouse(start_date=None, end_date=None, cleanup=False, **runner_options):
     
     print("Start time: %s" % datetime.now())
     
@@ -66,7 +76,7 @@ def update_warehouse(start_date=None, end_date=None, cleanup=False):
     if end_date is None:
         end_date = datetime.utcnow() 
     
-    runner = get_warehouse_runner()
+    runner = get_warehouse_runner(**runner_options)
     print("executing warehouse from %s, %s to %s" % (runner, start_date.date(), end_date.date()))
     if cleanup:
         runner.cleanup(start_date, end_date)
@@ -0,0 +1,121 @@
+"""
+The product catalog: every product (with its type) by sms code and
+alias, so that parsing a report and checking its products doesn't take
+a query per product code.
+
+The products hardly ever change, so the catalog is kept for the life of
+the process, under a version kept in the cache. Saving or deleting a
+product or product type bumps the version (see invalidate_catalog), and
+every process reloads the catalog the next time it's asked for. Code
+that changes products without their signals (e.g. QuerySet.update)
+should call invalidate_catalog itself.
+"""
+from __future__ import unicode_literals
+from builtins import object
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+from rapidsms.conf import settings
+
+
+CATALOG_VERSION_KEY = "logistics-product-catalog-version"
+
+_lock = threading.Lock()
+_current = {'version': None, 'catalog': None}
+
+
+class ProductCatalog(object):
+    """
+    All the products, looked up in memory. Codes are case insensitive.
+    """
+
+    def __init__(self, products):
+        self.products = list(products)
+        self._by_code = dict((p.sms_code.lower(), p) for p in self.products)
+        self.aliases = dict((alias.lower(), code.lower()) for alias, code in
+                            getattr(settings, "LOGISTICS_PRODUCT_ALIASES", {}).items())
+
+    def get(self, code, base_level=None, active=None):
+        """
+        The product with the sms code (if it is at the base level and
+        active or not, when those are given), or None.
+        """
+        product = self._by_code.get(code.lower())
+        if product is None:
+            return None
+        if base_level is not None and product.type.base_level != base_level:
+            return None
+        if active is not None and product.is_active != active:
+            return None
+        return product
+
+    def resolve_alias(self, code):
+        """
+        The sms code the alias stands for, or the code itself if it isn't
+        one.
+        """
+        return self.aliases.get(code.lower(), code)
+
+    def matching(self, code):
+        """
+        The products whose sms code contains the code, like a
+        sms_code__icontains lookup.
+        """
+        code = code.lower()
+        return [p for p in self.products if code in p.sms_code.lower()]
+
+    def active(self, base_level=None):
+        return [p for p in self.products if p.is_active and
+                (base_level is None or p.type.base_level == base_level)]
+
+
+def _catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def get_catalog():
+    """
+    The current product catalog. This costs a cache lookup, so hold on
+    to it while handling a message rather than asking for it per product.
+    """
+    from logistics.models import Product
+    version = _catalog_version()
+    with _lock:
+        if _current['version'] == version:
+            return _current['catalog']
+    catalog = ProductCatalog(Product.objects.select_related('type').order_by('type', 'sms_code'))
+    with _lock:
+        _current['version'] = version
+        _current['catalog'] = catalog
+    return catalog
+
+
+def _forget_catalog():
+    with _lock:
+        _current['version'] = None
+        _current['catalog'] = None
+
+
+def _bump_catalog_version():
+    cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+    _forget_catalog()
+
+
+def invalidate_catalog(sender=None, **kwargs):
+    """
+    Forget the catalog, in this process and the others. Connected to the
+    signals of Product and ProductType.
+
+    The other processes are only told once the change is committed, since
+    they would otherwise reload the old products under the new version and
+    keep them. This process forgets it straight away (and again then).
+    """
+    _forget_catalog()
+    transaction.on_commit(_bump_catalog_version)
@@ -8,6 +8,40 @@ from dateutil.relativedelta import relativedelta
 from django.core.cache import cache
 import gviz_api
 from logistics.models import Product, ProductStock
+from logistics.consumption import daily_consumptions
+
+
+def monthly_amcs(sps, year, month, products):
+    """
+    The average monthly consumption of each product across the supply
+    points in the month, by sms code. Products without a cached value
+    are worked out together, from one stream of transactions.
+    """
+    amcs = {}
+    missing = []
+    for pr in products:
+        cached_amc = cache.get("log-amc-%s-%s-%s" % (pr.sms_code, year, month))
+        if cached_amc is not None:
+            amcs[pr.sms_code] = cached_amc
+        else:
+            missing.append(pr)
+    if not missing:
+        return amcs
+
+    dm = DateSpan(startdate=datetime(year,month,1)-relativedelta(months=2), enddate=get_day_of_month(year, month, -1))
+    pairs = ProductStock.objects.filter(supply_point__in=sps, product__in=missing, is_active=True)\
+        .values_list('supply_point', 'product')
+    totals = dict((pr.pk, [0.0, 0.0]) for pr in missing)
+    for (sp, product), consumption in daily_consumptions(pairs, datespan=dm).items():
+        if consumption is not None:
+            totals[product][0] += consumption * 30.0
+            totals[product][1] += 1
+    for pr in missing:
+        total, count = totals[pr.pk]
+        amc_avg = old_div(total, count) if count else 0
+        cache.set("log-amc-%s-%s-%s" % (pr.sms_code, year, month), amc_avg, (30 * 24 * 60 * 60) - 1)
+        amcs[pr.sms_code] = amc_avg
+    return amcs
 
 
 def amc_plot(sps, datespan, products=None):
@@ -20,27 +54,7 @@ def amc_plot(sps, datespan, products=None):
 
     data_rows = {}
     for year, month in datespan.months_iterator():
-        dm = DateSpan(startdate=datetime(year,month,1)-relativedelta(months=2), enddate=get_day_of_month(year, month, -1))
-        dt = datetime(year, month, 1)
-        if not dt in data_rows: data_rows[dt] = {}
-        for pr in products:
-            cache_key = "log-amc-%s-%s-%s" % (pr.sms_code, year, month)
-            cached_amc = cache.get(cache_key)
-            if cached_amc is not None:
-                data_rows[dt][pr.sms_code] = cached_amc
-            else:
-                ps = ProductStock.objects.filter(supply_point__in=sps, product=pr, is_active=True)
-                total = 0.0
-                count = 0.0
-                for p in ps:
-                    try:
-                        total += p.get_daily_consumption(datespan=dm) * 30.0
-                        count += 1
-                    except:
-                        continue
-                amc_avg = old_div(total, count) if count else 0
-                cache.set(cache_key, amc_avg, (30 * 24 * 60 * 60) - 1)
-                data_rows[dt][pr.sms_code] = amc_avg
+        data_rows[datetime(year, month, 1)] = monthly_amcs(sps, year, month, products)
 
     rows = []
     for d in list(data_rows.keys()):
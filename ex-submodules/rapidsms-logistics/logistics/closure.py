@@ -0,0 +1,153 @@
+"""
+Closure tables: a hierarchy (e.g. supply points and the supply points
+they are supplied by) materialized as a row for every node and each of
+its ancestors, so that "everything below X" is a single join instead of
+a chain of joins or a query per level.
+
+A closure model has ``ancestor`` and ``descendant`` foreign keys to the
+node model and a ``depth``: 0 for a node's row for itself, 1 for its
+parent, and so on. Every node is in it, active or not; it's up to the
+queries to filter on that.
+"""
+from __future__ import unicode_literals
+from builtins import object
+import logging
+from collections import defaultdict
+
+
+class Closure(object):
+    """
+    Maintains the closure table *model* of the hierarchy given by the
+    *parent_attr* (e.g. "supplied_by_id") of its nodes.
+
+    Only works through the ORM, so it can be used with the historical
+    models in migrations too.
+    """
+
+    def __init__(self, model, parent_attr):
+        self.model = model
+        self.parent_attr = parent_attr
+
+    @property
+    def node_model(self):
+        return self.model._meta.get_field('descendant').related_model
+
+    def descendants(self, node, depth=None, include_self=False):
+        """
+        The nodes below *node* (only those exactly *depth* below, if
+        given), as a queryset.
+        """
+        lookups = {'ancestor_links__ancestor': node}
+        if depth is not None:
+            lookups['ancestor_links__depth'] = depth
+        elif not include_self:
+            lookups['ancestor_links__depth__gt'] = 0
+        return self.node_model.objects.filter(**lookups)
+
+    def ancestors(self, node, include_self=False):
+        """
+        The nodes above *node*, nearest first.
+        """
+        lookups = {'descendant_links__descendant': node}
+        if not include_self:
+            lookups['descendant_links__depth__gt'] = 0
+        return self.node_model.objects.filter(**lookups).order_by('descendant_links__depth')
+
+    def _expected(self, parents):
+        """
+        The (ancestor, descendant, depth) rows for the hierarchy given by
+        the {node: parent} dict *parents*. Loops are broken (with a
+        warning) at the node they come back round to.
+        """
+        rows = []
+        for node in parents:
+            seen = set()
+            current, depth = node, 0
+            while current in parents and current not in seen:
+                seen.add(current)
+                rows.append((current, node, depth))
+                current, depth = parents[current], depth + 1
+            if current in seen:
+                logging.warning("%s %s is in a loop of %s" % (self.node_model.__name__, node,
+                                                            self.parent_attr))
+        return rows
+
+    def _parents(self, queryset=None):
+        if queryset is None:
+            queryset = self.node_model.objects.all()
+        return dict(queryset.order_by().values_list('pk', self.parent_attr))
+
+    def rebuild(self):
+        """
+        Rebuild the whole table from the nodes' parents.
+        """
+        self.model.objects.all().delete()
+        self.model.objects.bulk_create([
+            self.model(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+            for ancestor, descendant, depth in self._expected(self._parents())
+        ], batch_size=1000)
+
+    def check(self):
+        """
+        Compare the table against the nodes' parents, returning the
+        (ancestor, descendant, depth) rows that are missing from it and
+        those that shouldn't be in it.
+        """
+        expected = set(self._expected(self._parents()))
+        actual = set(self.model.objects.values_list('ancestor', 'descendant', 'depth'))
+        return sorted(expected - actual), sorted(actual - expected)
+
+    def _subtree(self, node_id, parent_id):
+        # {node: parent} for the node and everything below it, going by
+        # the nodes' own parents (not the table, which may be out of date)
+        subtree = {node_id: parent_id}
+        frontier = [node_id]
+        while frontier:
+            children = self._parents(self.node_model.objects.filter(
+                **{'%s__in' % self.parent_attr: frontier}).exclude(pk__in=list(subtree)))
+            subtree.update(children)
+            frontier = list(children)
+        return subtree
+
+    def relink(self, node_id, parent_id):
+        """
+        Rewrite the rows for the node and everything below it, after it
+        was added or moved.
+        """
+        subtree = self._subtree(node_id, parent_id)
+        above = list(self.model.objects.filter(descendant=parent_id).values_list('ancestor', 'depth')) \
+            if parent_id is not None else []
+        if any(ancestor in subtree for ancestor, depth in above):
+            logging.warning("%s %s is in a loop of %s" % (self.node_model.__name__, node_id,
+                                                        self.parent_attr))
+            above = []
+        detached = dict(subtree)
+        detached[node_id] = None
+        rows = self._expected(detached)
+        depths = defaultdict(int)
+        for ancestor, descendant, depth in rows:
+            if ancestor == node_id:
+                depths[descendant] = depth
+        rows.extend((ancestor, descendant, depths[descendant] + depth + 1)
+                    for descendant in subtree for ancestor, depth in above)
+
+        self.model.objects.filter(descendant__in=list(subtree)).delete()
+        self.model.objects.bulk_create([
+            self.model(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+            for ancestor, descendant, depth in rows
+        ], batch_size=1000)
+
+    def post_save(self, sender, instance, **kwargs):
+        """
+        Keep the table up to date as nodes are saved (including raw saves,
+        so fixtures are covered, in whatever order they load).
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields and not set(update_fields) & set([self.parent_attr, self.parent_attr[:-3]]):
+            return
+        parent_id = getattr(instance, self.parent_attr)
+        links = dict(self.model.objects.filter(descendant=instance.pk, depth__lte=1)
+                     .values_list('depth', 'ancestor'))
+        if 0 in links and links.get(1) == parent_id:
+            return
+        self.relink(instance.pk, parent_id)
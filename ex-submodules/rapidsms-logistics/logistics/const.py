@@ -22,3 +22,19 @@ class Reports(object):
         LOSS_ADJUST: "loss or adjustment" 
     }
 
+
+
+class StockStatus(object):
+    """
+    The single category a stock level falls into. See StockLevels.status
+    """
+    NO_DATA = "no_data"
+    STOCKOUT = "stockout"
+    EMERGENCY = "emergency"
+    LOW = "low"
+    GOOD = "good"
+    OVERSTOCK = "overstock"
+    # stocked, but with no consumption to compare against
+    OTHER = "other"
+    CHOICES = [NO_DATA, STOCKOUT, EMERGENCY, LOW, GOOD, OVERSTOCK, OTHER]
+    STATUS_CHOICES = [(val, val) for val in CHOICES]
@@ -1,7 +1,9 @@
 from __future__ import division
 from __future__ import unicode_literals
 from builtins import object
+from collections import namedtuple
 from datetime import datetime, timedelta
+from itertools import groupby
 from rapidsms.conf import settings
 from logistics.const import Reports
 from logistics_project.utils.dates import delta_secs
@@ -27,6 +29,11 @@ class ConsumptionSettings(object):
     def default(cls):
         return ConsumptionSettings(settings.LOGISTICS_CONSUMPTION)
 
+# the fields of a StockTransaction the consumption calculation needs
+_TRANSACTION_FIELDS = ('date', 'ending_balance', 'quantity', 'product_report__report_type__code')
+_Transaction = namedtuple('_Transaction', 'date ending_balance quantity report_type')
+
+
 def daily_consumption(supply_point, product, datespan=None, 
                       consumption_settings=None):
     """
@@ -47,16 +54,57 @@ def daily_consumption(supply_point, product, datespan=None,
     from logistics.models import StockTransaction
     consumption_settings = consumption_settings or ConsumptionSettings.default()
     
-    total_time = timedelta(0)
-    total_consumption = 0
-    
     txs = StockTransaction.objects.filter\
         (supply_point=supply_point,product=product).order_by('-date')
     
     if datespan:
         txs = txs.filter(date__gte=datespan.startdate,
                          date__lte=datespan.enddate)
-    if txs.count() < consumption_settings.min_transactions:
+    txs = [_Transaction(*t) for t in txs.values_list(*_TRANSACTION_FIELDS)]
+    return _daily_consumption(txs, consumption_settings, consumption_settings.cutoff_date)
+
+
+def daily_consumptions(pairs, consumption_settings=None, datespan=None):
+    """
+    The bulk version of daily_consumption, for a list of (supply point,
+    product) pairs (either models or ids). All the transactions are read
+    in one ordered stream.
+
+    Returns a dict of (supply point id, product id) to daily consumption
+    (or None, where there isn't enough data).
+    """
+    from logistics.models import StockTransaction
+    consumption_settings = consumption_settings or ConsumptionSettings.default()
+    cutoff_date = consumption_settings.cutoff_date
+    pairs = set((getattr(sp, 'pk', sp), getattr(p, 'pk', p)) for sp, p in pairs)
+    results = dict((pair, None) for pair in pairs)
+    if not pairs:
+        return results
+
+    txs = StockTransaction.objects.filter(
+        supply_point__in=set(sp for sp, p in pairs),
+        product__in=set(p for sp, p in pairs),
+    ).order_by('supply_point', 'product', '-date')
+    if datespan:
+        txs = txs.filter(date__gte=datespan.startdate,
+                         date__lte=datespan.enddate)
+    rows = txs.values_list('supply_point_id', 'product_id', *_TRANSACTION_FIELDS).iterator()
+    for pair, group in groupby(rows, key=lambda row: row[:2]):
+        if pair in pairs:
+            results[pair] = _daily_consumption([_Transaction(*row[2:]) for row in group],
+                                               consumption_settings, cutoff_date)
+    return results
+
+
+def _daily_consumption(txs, consumption_settings, cutoff_date):
+    """
+    The daily consumption algorithm (see daily_consumption), given the
+    transactions most recent first.
+    """
+    total_time = timedelta(0)
+    total_consumption = 0
+
+    if len(txs) < consumption_settings.min_transactions:
         return None
     period_receipts = 0
     end_transaction = None
@@ -67,7 +115,7 @@ def daily_consumption(supply_point, product, datespan=None,
             end_transaction = None
             period_receipts = 0
             continue
-        if t.product_report.report_type.code == Reports.SOH:
+        if t.report_type == Reports.SOH:
             if end_transaction:
                 # End of a period.
                 if t.ending_balance + period_receipts >= end_transaction.ending_balance:
@@ -79,20 +127,20 @@ def daily_consumption(supply_point, product, datespan=None,
                     period_time = (end_transaction.date - t.date)
                     period_consumption = t.ending_balance + period_receipts - end_transaction.ending_balance
                     
-                    scaling_factor = 1 if consumption_settings.cutoff_date < t.date \
-                        else max(0, delta_secs(end_transaction.date - consumption_settings.cutoff_date) / delta_secs(period_time))
+                    scaling_factor = 1 if cutoff_date < t.date \
+                        else max(0, delta_secs(end_transaction.date - cutoff_date) / delta_secs(period_time))
                     
                     total_time += timedelta(seconds=scaling_factor * delta_secs(period_time))
                     total_consumption += scaling_factor * period_consumption
                     
-            if t.date < consumption_settings.cutoff_date:
+            if t.date < cutoff_date:
                 break
             else:
                 # Start a new period.
                 end_transaction = t
                 period_receipts = 0
             
-        elif t.product_report.report_type.code == Reports.REC:
+        elif t.report_type == Reports.REC:
             # Receipt.
             if end_transaction:
                 # Mid-period receipt, so we care about it.
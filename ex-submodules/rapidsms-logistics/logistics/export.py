@@ -0,0 +1,154 @@
+"""
+Streaming CSV exports. An export is a header and an iterable of rows,
+written out as the rows come: to a file (for the export management
+commands) or to a StreamingHttpResponse (for the views). The rows
+should come from .values_list(...) queries read with iterate(), with
+anything else they need looked up in dicts built up front, so
+that memory stays flat and the time linear however many rows there
+are.
+"""
+from __future__ import unicode_literals
+from builtins import object, range
+from functools import reduce
+import csv
+import io
+import operator
+
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+
+EXPORT_CHUNK_SIZE = 2000
+EXCEL_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def excel_date(date):
+    return date.strftime(EXCEL_DATE_FORMAT) if date else ''
+
+
+def _key_ordering(model, ordering):
+    # order by foreign keys' own columns, not the related model's ordering,
+    # so that the key values read back are what the rows are ordered by
+    fields = dict((f.name, f) for f in model._meta.concrete_fields)
+    key_ordering = []
+    for field in ordering:
+        name = field.lstrip('-')
+        if name in fields and fields[name].is_relation:
+            field = field.replace(name, fields[name].attname)
+        key_ordering.append(field)
+    if not key_ordering or key_ordering[-1].lstrip('-') != 'pk':
+        key_ordering.append('pk')
+    return key_ordering
+
+
+def _after(ordering, key):
+    # the rows that come after the key in the ordering
+    conditions = []
+    for i, field in enumerate(ordering):
+        lookup = '%s__%s' % (field.lstrip('-'), 'lt' if field.startswith('-') else 'gt')
+        condition = Q(**{lookup: key[i]})
+        for previous, value in zip(ordering[:i], key):
+            condition &= Q(**{previous.lstrip('-'): value})
+        conditions.append(condition)
+    return reduce(operator.or_, conditions)
+
+
+def iterate(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    The rows of the queryset, fetched a chunk at a time and not cached.
+
+    The chunks are paged by key on the queryset's order_by fields, which
+    must not be null, and then the pk. Foreign keys are ordered by their
+    ids, not by the related model's ordering. QuerySet.iterator() can't
+    be used for this: MySQLdb reads the whole result into memory whatever
+    the chunk size.
+    """
+    ordering = _key_ordering(queryset.model, queryset.query.order_by)
+    rows = queryset.order_by(*ordering)
+    keys = rows.values_list(*[field.lstrip('-') for field in ordering])
+    key = None
+    while True:
+        chunk = list((keys if key is None else keys.filter(_after(ordering, key)))[:chunk_size])
+        if not chunk:
+            return
+        for row in rows.filter(pk__in=[k[-1] for k in chunk]):
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        key = chunk[-1]
+
+
+class _Echo(object):
+    # the file-like object csv.writer writes a line at a time to
+    def write(self, value):
+        return value
+
+
+def csv_lines(header, rows):
+    """
+    The CSV lines of the header and rows, one at a time.
+    """
+    writer = csv.writer(_Echo())
+    if header:
+        yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_csv(filename, header, rows, progress=None, progress_every=10000):
+    """
+    Write the header and rows to the file as they come, returning the
+    number of rows. progress, if given, is called with the number of
+    rows written every progress_every rows.
+    """
+    count = 0
+    with io.open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+            if progress and count % progress_every == 0:
+                progress(count)
+    return count
+
+
+def csv_response(filename, header, rows):
+    """
+    A response that streams the header and rows as a CSV attachment.
+    """
+    response = StreamingHttpResponse(csv_lines(header, rows), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+
+class SupplyPointLookup(object):
+    """
+    The names, codes and parents of all the supply points, read in one
+    query, for exports that show where each row is in the hierarchy.
+    """
+
+    def __init__(self, queryset=None):
+        from logistics.models import SupplyPoint
+        if queryset is None:
+            queryset = SupplyPoint.objects.all()
+        self._supply_points = dict(
+            (pk, (name, code, parent_id)) for pk, name, code, parent_id in
+            iterate(queryset.order_by().values_list('pk', 'name', 'code', 'supplied_by_id'))
+        )
+
+    def name(self, pk, default='-'):
+        return self._supply_points[pk][0] if pk in self._supply_points else default
+
+    def code(self, pk):
+        return self._supply_points[pk][1] if pk in self._supply_points else None
+
+    def parent(self, pk, levels=1):
+        """
+        The id of the supply point *levels* above, or None.
+        """
+        for i in range(levels):
+            if pk not in self._supply_points:
+                return None
+            pk = self._supply_points[pk][2]
+        return pk
@@ -1,11 +1,15 @@
 from __future__ import print_function
 from __future__ import unicode_literals
-import csv
-from logistics.models import StockTransaction
+from collections import namedtuple
+from logistics.export import SupplyPointLookup, excel_date, iterate, write_csv
+from logistics.models import Product, StockTransaction
 from datetime import datetime
 from django.core.management.base import LabelCommand
 
 
+_Transaction = namedtuple('_Transaction', 'supply_point product date ending_balance pk')
+
+
 class Command(LabelCommand):
     help = "Exports a table of all stockouts ever"
 
@@ -15,7 +19,8 @@ class Command(LabelCommand):
         product    district    facility    has    start date    end date    length
         """
         END_DATE = datetime.utcnow()
-        EXCEL_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+        supply_points = SupplyPointLookup()
+        product_names = dict(Product.objects.values_list('pk', 'name'))
 
         def _is_stockout(trans):
             if trans.ending_balance < 0:
@@ -26,10 +31,8 @@ class Command(LabelCommand):
                     start_trans.product == end_trans.product)
 
         def _get_row(start, end):
-            def _ignore(supply_point):
-                return 'deprecated' in supply_point.code
-
-            if _ignore(start.supply_point):
+            supply_point_code = supply_points.code(start.supply_point)
+            if 'deprecated' in supply_point_code:
                 return []
 
             if end is not None:
@@ -40,67 +43,58 @@ class Command(LabelCommand):
             else:
                 enddate = END_DATE
 
-            def _parent(supply_point):
-                return supply_point.supplied_by if supply_point else None
-
-            def _display(supply_point):
-                return supply_point.name if supply_point else '-'
-
-            facility = _parent(start.supply_point)
-            district = _parent(facility)
+            facility = supply_points.parent(start.supply_point)
+            district = supply_points.parent(facility)
 
             return [
-                start.product.name,
-                _display(district),
-                _display(facility),
-                _display(start.supply_point),
-                start.supply_point.code,
-                start.date.strftime(EXCEL_DATE_FORMAT),
-                enddate.strftime(EXCEL_DATE_FORMAT),
+                product_names[start.product],
+                supply_points.name(district),
+                supply_points.name(facility),
+                supply_points.name(start.supply_point),
+                supply_point_code,
+                excel_date(start.date),
+                excel_date(enddate),
                 enddate == END_DATE,
                 (enddate - start.date).days,
                 (enddate - start.date).seconds,
             ]
 
-        def _write_row(outfile, period_start, trans):
-            row = _get_row(period_start, trans)
-            if row:
-                outfile.writerow(row)
+        def _iter_rows():
+            transactions = StockTransaction.objects.order_by('product', 'supply_point', 'date')\
+                .values_list(*_Transaction._fields)
+            count = StockTransaction.objects.count()
+            period_start = None
 
-        if len(args) == 0:
-            print('please specify a filename')
-            return
-        filename = args[0]
-        f = file(filename, 'w')
-        out = csv.writer(f)
-        out.writerow(['Product', 'District', 'Facility', 'HSA', 'HSA Code', 'Start Date', 'End Date',
-                      'Ongoing', 'Duration (days)', 'Duration (seconds)'])
-        transactions = StockTransaction.objects.order_by('product', 'supply_point', 'date')
-        count = StockTransaction.objects.count()
-        period_start = None
-
-        i = 0
-        for trans in transactions:
-            if period_start is None:
-                if _is_stockout(trans):
-                    # new period
-                    period_start = trans
-                else:
-                    # nothing to do
-                    pass
-            elif _is_match(period_start, trans):
-                # still in the same period, check if still stocked out or period is ending
-                if _is_stockout(trans):
-                    # nothing to do
-                    pass
+            i = 0
+            for trans in iterate(transactions):
+                trans = _Transaction(*trans)
+                if period_start is None:
+                    if _is_stockout(trans):
+                        # new period
+                        period_start = trans
+                    else:
+                        # nothing to do
+                        pass
+                elif _is_match(period_start, trans):
+                    # still in the same period, check if still stocked out or period is ending
+                    if _is_stockout(trans):
+                        # nothing to do
+                        pass
+                    else:
+                        yield _get_row(period_start, trans)
+                        period_start = None
                 else:
-                    _write_row(out, period_start, trans)
+                    # we ran out of matches, just end it with the current date
+                    yield _get_row(period_start, None)
                     period_start = None
-            else:
-                # we ran out of matches, just end it with the current date
-                _write_row(out, period_start, None)
-                period_start = None
 
-            i += 1
-            if i % 500 == 0:
-                print('processed %s/%s transactions' % (i, count))
+                i += 1
+                if i % 500 == 0:
+                    print('processed %s/%s transactions' % (i, count))
+
+        if len(args) == 0:
+            print('please specify a filename')
+            return
+        write_csv(args[0], ['Product', 'District', 'Facility', 'HSA', 'HSA Code', 'Start Date', 'End Date',
+                            'Ongoing', 'Duration (days)', 'Duration (seconds)'],
+                  (row for row in _iter_rows() if row))
@@ -0,0 +1,38 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand, CommandError
+from rapidsms.contrib.locations.models import location_closure
+from logistics.models import supply_point_closure
+
+
+CLOSURES = (
+    ("supply point", supply_point_closure),
+    ("location", location_closure),
+)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the supply point and location closure tables, or checks them with --check."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', default=False,
+                            help="Only check the tables against the hierarchy, and fail if they don't match.")
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            for name, closure in CLOSURES:
+                closure.rebuild()
+                print("%s closure rebuilt: %s rows" % (name, closure.model.objects.count()))
+            return
+
+        consistent = True
+        for name, closure in CLOSURES:
+            missing, extra = closure.check()
+            print("%s closure: %s rows missing, %s extra" % (name, len(missing), len(extra)))
+            for ancestor, descendant, depth in missing[:20]:
+                print("  missing: %s -> %s (%s)" % (ancestor, descendant, depth))
+            for ancestor, descendant, depth in extra[:20]:
+                print("  extra: %s -> %s (%s)" % (ancestor, descendant, depth))
+            consistent = consistent and not (missing or extra)
+        if not consistent:
+            raise CommandError("The closure tables are out of date; run rebuild_closures to fix them.")
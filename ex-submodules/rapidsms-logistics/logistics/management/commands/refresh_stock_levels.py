@@ -0,0 +1,12 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+from logistics.models import ProductStock
+
+
+class Command(BaseCommand):
+    help = "Refreshes the denormalized stock levels and status of every product stock."
+
+    def handle(self, *args, **options):
+        stocks = ProductStock.objects.select_related('supply_point', 'supply_point__type', 'product')
+        print("%s product stocks updated" % ProductStock.bulk_refresh_stock_levels(stocks.iterator()))
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.12 on 2026-10-18 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0004_auto_20220505_1519'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productstock',
+            name='cached_emergency_level',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='productstock',
+            name='cached_maximum_level',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='productstock',
+            name='cached_monthly_consumption',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='productstock',
+            name='cached_reorder_level',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='productstock',
+            name='stock_status',
+            field=models.CharField(blank=True, choices=[('no_data', 'no_data'), ('stockout', 'stockout'), ('emergency', 'emergency'), ('low', 'low'), ('good', 'good'), ('overstock', 'overstock'), ('other', 'other')], db_index=True, max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.12 on 2026-10-18 15:43
+
+from django.db import migrations
+
+
+def rebuild_historical_stock_cache(apps, schema_editor):
+    """
+    The cache used to be empty or only partially populated, so build it
+    once here. From now on it is kept up to date as transactions are saved.
+    """
+    HistoricalStockCache = apps.get_model('logistics', 'HistoricalStockCache')
+    StockTransaction = apps.get_model('logistics', 'StockTransaction')
+    HistoricalStockCache.objects.all().delete()
+    rows = StockTransaction.objects.order_by('supply_point', 'product', '-date', '-pk')\
+        .values_list('supply_point', 'product', 'date', 'ending_balance')
+    month_ends = {}
+    for supply_point_id, product_id, date, ending_balance in rows.iterator():
+        month_ends.setdefault((supply_point_id, product_id, date.year, date.month), ending_balance)
+    HistoricalStockCache.objects.bulk_create([
+        HistoricalStockCache(supply_point_id=supply_point_id, product_id=product_id,
+                             year=year, month=month, stock=stock)
+        for (supply_point_id, product_id, year, month), stock in month_ends.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0005_productstock_stock_levels'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='historicalstockcache',
+            index_together={('supply_point', 'product', 'year', 'month')},
+        ),
+        migrations.RunPython(rebuild_historical_stock_cache, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.12 on 2026-10-18 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_supply_point_closure(apps, schema_editor):
+    from logistics.closure import Closure
+    Closure(apps.get_model('logistics', 'SupplyPointClosure'), 'supplied_by_id').rebuild()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0006_historicalstockcache_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SupplyPointClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='logistics.supplypoint')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='logistics.supplypoint')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_supply_point_closure, migrations.RunPython.noop),
+    ]
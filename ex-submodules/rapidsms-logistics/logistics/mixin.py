@@ -1,9 +1,39 @@
 from __future__ import unicode_literals
 from builtins import object
-from datetime import timedelta
+from datetime import date, timedelta
 from rapidsms.conf import settings
 from django.core.cache import cache
-from django.db.models import Sum
+from django.db.models import Sum, Count, Case, When, Q, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _stock_count_conditions():
+    """
+    The conditions for each of the stock counts, on a stock_quantity
+    annotation and the stock levels saved on the ProductStock. These
+    match the checks in logistics.models.StockLevels.
+    """
+    emergency = F('cached_emergency_level')
+    reorder = F('cached_reorder_level')
+    maximum = F('cached_maximum_level')
+    has_emergency = Q(cached_emergency_level__isnull=False)
+    has_reorder = Q(cached_reorder_level__isnull=False)
+    has_maximum = Q(cached_maximum_level__isnull=False)
+    return [
+        ('stocked_count', Q(stock_quantity__gt=0)),
+        ('other_count', Q(cached_monthly_consumption__isnull=True, stock_quantity__gt=0)),
+        ('stockout_count', Q(stock_quantity=0)),
+        ('emergency_stock_count', has_emergency & Q(stock_quantity__lte=emergency)),
+        ('low_stock_count', has_reorder & has_emergency &
+            Q(stock_quantity__lte=reorder, stock_quantity__gt=emergency)),
+        ('emergency_plus_low', has_reorder & Q(stock_quantity__lte=reorder, stock_quantity__gt=0)),
+        ('good_supply_count', has_maximum & has_reorder &
+            Q(stock_quantity__gt=reorder, stock_quantity__lte=maximum)),
+        ('adequate_supply_count', has_maximum & has_emergency &
+            Q(stock_quantity__gt=emergency, stock_quantity__lte=maximum)),
+        ('overstocked_count', has_maximum & Q(stock_quantity__gt=maximum)),
+    ]
+
 
 class StockCacheMixin(object):
     """
@@ -18,69 +48,35 @@ class StockCacheMixin(object):
         refreshes all the stock count values in the cache in bulk
         returns None
         """
+        from logistics.models import ProductStock, StockTransaction
         stocks = self._filtered_stock(product, producttype)\
-                  .filter(supply_point__in=facilities)\
-                  .select_related("supply_point", "supply_point__type", "product")
-        # TODO: when datespan is None, stockouts can be queried more efficiently 
-        # at the db level. 
-        #nonzero_stocks = all_stocks.filter(quantity__gt=0)
-        stockout_count = 0
-        stocked_count = 0
-        emergency_stock_count = 0
-        low_stock_count = 0
-        emergency_plus_low = 0
-        good_supply_count = 0
-        adequate_supply_count = 0
-        overstocked_count = 0
-        other_count = 0
-        for stock in stocks:
-            if datespan and not datespan.is_default:
-                historical_stock = stock.supply_point.historical_stock_by_date(stock.product, 
-                                                                               datespan.end_of_end_day - timedelta(days=1), 
-                                                                               default_value=None)
-                if historical_stock is not None:
-                    stock.quantity = historical_stock
-            if stock.quantity == 0:
-                stockout_count = stockout_count + 1
-            elif stock.quantity > 0:
-                stocked_count = stocked_count + 1
-            if stock.is_other():
-                other_count = other_count + 1
-            if stock.is_below_emergency_level():
-                emergency_stock_count = emergency_stock_count + 1
-            if stock.is_below_low_supply_but_above_emergency_level():
-                low_stock_count = low_stock_count + 1
-            if stock.is_below_low_supply():
-                emergency_plus_low = emergency_plus_low + 1
-            if stock.is_in_good_supply():
-                good_supply_count = good_supply_count + 1
-            if stock.is_in_adequate_supply():
-                adequate_supply_count = adequate_supply_count + 1
-            if stock.is_overstocked():
-                overstocked_count = overstocked_count + 1
-        cache.set(self._cache_key('stocked_count', product, producttype, datespan), 
-                  stocked_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('other_count', product, producttype, datespan), 
-                  other_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('stockout_count', product, producttype, datespan), 
-                  stockout_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        cache.set(self._cache_key('emergency_stock_count', product, producttype, datespan), 
-                  emergency_stock_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('low_stock_count', product, producttype, datespan), 
-                  low_stock_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('emergency_plus_low', product, producttype, datespan), 
-                  emergency_plus_low, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('good_supply_count', product, producttype, datespan), 
-                  good_supply_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('adequate_supply_count', product, producttype, datespan), 
-                  adequate_supply_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('overstocked_count', product, producttype, datespan), 
-                  overstocked_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        consumption = stocks.exclude(manual_monthly_consumption=None).aggregate(consumption=Sum('manual_monthly_consumption'))['consumption']
+                  .filter(supply_point__in=facilities)
+        # the counts are taken against the stock levels saved on each
+        # stock, so make sure none are missing
+        ProductStock.bulk_refresh_stock_levels(
+            stocks.filter(stock_status=None).select_related("supply_point", "supply_point__type", "product")
+        )
+        if datespan and not datespan.is_default:
+            # the last balance up to the end of the datespan, where there is one
+            end = datespan.end_of_end_day - timedelta(days=1)
+            historical = StockTransaction.objects.filter(
+                supply_point=OuterRef('supply_point'), product=OuterRef('product'),
+                date__lte=date(end.year, end.month, end.day) + timedelta(days=1),
+            ).order_by("-date", "-pk").values('ending_balance')[:1]
+            stocks = stocks.annotate(stock_quantity=Coalesce(Subquery(historical), 'quantity'))
+        else:
+            stocks = stocks.annotate(stock_quantity=F('quantity'))
+
+        counts = stocks.aggregate(
+            consumption=Sum('manual_monthly_consumption'),
+            **dict((name, Count(Case(When(condition, then=1))))
+                   for name, condition in _stock_count_conditions())
+        )
         # NB: we do not yet support historical consumption, 
         # since that's its own giant bag of worms
-        cache.set(self._cache_key('consumption', product, producttype, datespan), 
-                  consumption, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
+        cache.set_many(dict((self._cache_key(name, product, producttype, datespan), value)
+                            for name, value in counts.items()),
+                       settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
     
     def _get_stock_count_for_facilities(self, facilities, operation, product, producttype, datespan=None):
         """ 
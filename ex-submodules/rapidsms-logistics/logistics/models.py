@@ -16,8 +16,8 @@ from dateutil.relativedelta import relativedelta
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models, transaction
-from django.db.models.signals import post_save
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save, post_delete
 from django.db.models.fields import PositiveIntegerField
 from django.utils.translation import gettext as _
 
@@ -27,12 +27,16 @@ from rapidsms.contrib.locations.models import Location
 from rapidsms.contrib.messaging.utils import send_message
 from logistics_project.utils.dates import get_day_of_month
 from logistics.signals import post_save_product_report, create_user_profile,\
-    stockout_resolved, stockout_reported, post_save_stock_transaction
+    stockout_resolved, stockout_reported, post_save_stock_transaction, \
+    update_historical_stock_cache, stock_reports_saved, stock_requests_saved, \
+    refresh_product_stock_levels, refresh_supply_point_type_stock_levels
 from logistics.errors import *
-from logistics.const import Reports
+from logistics.const import Reports, StockStatus
 from logistics.util import config, parse_report
 from logistics.mixin import StockCacheMixin
-from logistics.consumption import daily_consumption
+from logistics.closure import Closure
+from logistics.catalog import get_catalog, invalidate_catalog
+from logistics.consumption import daily_consumption, daily_consumptions
 from static.malawi.config import BaseLevel
 
 try:
@@ -66,19 +70,32 @@ class Product(models.Model):
     # products which we recognize but aren't required for reporting)
     is_active = models.BooleanField(default=True, db_index=True)
     
+    # the product stock level columns are derived from these
+    STOCK_LEVEL_FIELDS = ['average_monthly_consumption', 'emergency_order_level']
+
     class Meta(object):
         ordering = ['name']
         
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Product, cls).from_db(db, field_names, values)
+        # so that saving the product only refreshes its stocks if needed
+        instance._loaded_stock_levels = [instance.__dict__.get(f) for f in cls.STOCK_LEVEL_FIELDS]
+        return instance
+
     @property
     def code(self):
         return self.sms_code
     
     @classmethod
     def by_code(cls, code):
-        return cls.objects.get(sms_code=code)
+        product = get_catalog().get(code)
+        if product is None:
+            raise cls.DoesNotExist("No product with the code %s" % code)
+        return product
     
     @transaction.atomic
     def deactivate(self):
@@ -294,6 +311,35 @@ class SupplyPointBase(models.Model, StockCacheMixin):
             return Product.objects.filter(is_active=True)
         raise ImproperlyConfigured("LOGISTICS_STOCKED_BY setting is not configured correctly")
 
+    @classmethod
+    def commodities_stocked_by_supply_point(cls, supply_points):
+        """
+        The ids of the commodities_stocked of each of the supply points,
+        keyed by supply point id, without a query per supply point.
+        """
+        ids = [sp.pk for sp in supply_points]
+        stocked = dict((pk, set()) for pk in ids)
+        if not ids:
+            return stocked
+        if settings.LOGISTICS_STOCKED_BY == settings.STOCKED_BY_USER:
+            pairs = Product.objects.filter(is_active=True,
+                                           reported_by__supply_point__in=ids,
+                                           reported_by__is_active=True)\
+                .values_list('reported_by__supply_point', 'pk')
+        elif settings.LOGISTICS_STOCKED_BY == settings.STOCKED_BY_FACILITY:
+            pairs = ProductStock.objects.filter(supply_point__in=ids,
+                                                is_active=True,
+                                                product__is_active=True)\
+                .values_list('supply_point', 'product')
+        elif settings.LOGISTICS_STOCKED_BY == settings.STOCKED_BY_PRODUCT:
+            products = set(Product.objects.filter(is_active=True).values_list('pk', flat=True))
+            return dict((pk, set(products)) for pk in ids)
+        else:
+            raise ImproperlyConfigured("LOGISTICS_STOCKED_BY setting is not configured correctly")
+        for supply_point_id, product_id in pairs.order_by():
+            stocked[supply_point_id].add(product_id)
+        return stocked
+
     def commodities_not_stocked(self):
         return list(set(Product.objects.filter(is_active=True)) - set(self.commodities_stocked()))
 
@@ -372,32 +418,14 @@ class SupplyPointBase(models.Model, StockCacheMixin):
     
     def historical_stock_by_date(self, product, date, default_value=0):
         """ assume the 'date' is standardized to utc """
-        cache_key = ("log-hs-%(supply_point)s-%(product)s-%(datetime)s-%(default)s" % \
-                    {"supply_point": self.code, "product": product.sms_code, 
-                     "datetime": date, "default": default_value}).replace(" ", "-")
-        return self._historical_stock(product, cache_key, date.year, date.month, 
-                                      date.day, default_value)
+        deadline = datetime(date.year, date.month, date.day) + timedelta(days=1)
+        return HistoricalStockCache.stock_as_of([self.pk], [product.pk], deadline, inclusive=True)\
+            .get((self.pk, product.pk), default_value)
         
     def historical_stock(self, product, year, month, default_value=0):
         """ assume the 'date' is standardized to utc """
-        def _cache_key():
-            return ("log-hs-%(supply_point)s-%(product)s-%(year)s-%(month)s-%(default)s" % \
-                    {"supply_point": self.code, "product": product.sms_code, 
-                     "year": year, "month": month, "default": default_value}).replace(" ", "-")
-        return self._historical_stock(product, _cache_key(), year, month, 
-                                      default_value=default_value)
-    
-    def _historical_stock(self, product, cache_key, year, month, day=None, default_value=0):
-        if settings.LOGISTICS_USE_SPOT_CACHING: 
-            from_cache = cache.get(cache_key)
-            if from_cache:
-                return from_cache
-        srs = transactions_before_or_during(year, month, day).\
-                filter(supply_point=self, product=product).order_by("-date","-pk")
-        ret = srs[0].ending_balance if srs.exists() else default_value
-        if settings.LOGISTICS_USE_SPOT_CACHING: 
-            cache.set(cache_key, ret, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        return ret
+        return HistoricalStockCache.stock_at_month_end([self.pk], [product.pk], year, month)\
+            .get((self.pk, product.pk), default_value)
 
     def _cache_key(self, key, product, producttype, cdatetime=None):
         return ("SP-%(supplypoint)s-%(key)s-%(product)s-%(producttype)s-%(datetime)s" % \
@@ -582,6 +610,26 @@ class SupplyPoint(SupplyPointBase):
 
         return super(SupplyPoint, self).commodities_stocked()
 
+    @classmethod
+    def commodities_stocked_by_supply_point(cls, supply_points):
+        supply_points = list(supply_points)
+        others = [sp for sp in supply_points if sp.type_id != config.SupplyPointCodes.FACILITY]
+        stocked = super(SupplyPoint, cls).commodities_stocked_by_supply_point(others)
+        if any(sp.type_id == config.SupplyPointCodes.HSA for sp in others):
+            hsa_products = set(Product.objects.filter(type__base_level=config.BaseLevel.HSA)
+                               .values_list('pk', flat=True))
+            for sp in others:
+                if sp.type_id == config.SupplyPointCodes.HSA:
+                    stocked[sp.pk] &= hsa_products
+        if len(others) < len(supply_points):
+            facility_products = set(Product.objects.filter(is_active=True,
+                                                           type__base_level=config.BaseLevel.FACILITY)
+                                    .values_list('pk', flat=True))
+            for sp in supply_points:
+                if sp.type_id == config.SupplyPointCodes.FACILITY:
+                    stocked[sp.pk] = set(facility_products)
+        return stocked
+
     def commodities_not_stocked(self):
         if self.type_id == config.SupplyPointCodes.HSA:
             return list(
@@ -599,6 +647,23 @@ class SupplyPoint(SupplyPointBase):
         return super(SupplyPoint, self).commodities_not_stocked()
 
 
+class SupplyPointClosure(models.Model):
+    """
+    The supply chain (supplied_by) hierarchy, materialized: a row for
+    every supply point and each of the supply points above it (see
+    logistics.closure).
+    """
+    ancestor = models.ForeignKey(SupplyPoint, related_name="descendant_links", on_delete=models.CASCADE)
+    descendant = models.ForeignKey(SupplyPoint, related_name="ancestor_links", on_delete=models.CASCADE)
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta(object):
+        unique_together = (('ancestor', 'descendant'),)
+
+
+supply_point_closure = Closure(SupplyPointClosure, 'supplied_by_id')
+
+
 class LogisticsProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     designation = models.CharField(max_length=255, blank=True, null=True)
@@ -616,6 +681,99 @@ class LogisticsProfile(models.Model):
         return u"%s (%s, %s)" % (self.user.username, self.location, self.supply_point)
 
 
+class StockLevels(object):
+    """
+    The stock thresholds of a ProductStock, see ProductStock.stock_levels.
+    The checks take the quantity so that they can also be used for
+    historical stock.
+    """
+
+    def __init__(self, monthly_consumption, emergency_reorder_level, reorder_level, maximum_level):
+        self.monthly_consumption = monthly_consumption
+        self.emergency_reorder_level = emergency_reorder_level
+        self.reorder_level = reorder_level
+        self.maximum_level = maximum_level
+
+    def reorder_amount(self, quantity):
+        if self.maximum_level is not None and quantity is not None:
+            return max(self.maximum_level - quantity, 0)
+        return None
+
+    def months_remaining(self, quantity):
+        if self.monthly_consumption is not None and self.monthly_consumption > 0 \
+          and quantity is not None:
+            return float(quantity) / float(self.monthly_consumption)
+        elif quantity == 0:
+            return 0
+        return None
+
+    def is_below_emergency_level(self, quantity):
+        if self.emergency_reorder_level is not None:
+            if quantity <= self.emergency_reorder_level:
+                return True
+        return False
+
+    def is_below_low_supply_but_above_emergency_level(self, quantity):
+        if self.reorder_level is not None and self.emergency_reorder_level is not None:
+            if quantity <= self.reorder_level and quantity > self.emergency_reorder_level:
+                return True
+        return False
+
+    def is_below_low_supply(self, quantity):
+        if self.reorder_level is not None:
+            if quantity <= self.reorder_level and quantity > 0:
+                return True
+        return False
+
+    def is_above_low_supply(self, quantity):
+        if self.reorder_level is not None:
+            if quantity > self.reorder_level:
+                return True
+        return False
+
+    def is_in_good_supply(self, quantity):
+        if self.maximum_level is not None and self.reorder_level is not None:
+            if quantity > self.reorder_level and quantity <= self.maximum_level:
+                return True
+        return False
+
+    def is_other(self, quantity):
+        if self.monthly_consumption is None and quantity > 0:
+            return True
+        return False
+
+    def is_in_adequate_supply(self, quantity):
+        if self.maximum_level is not None and self.emergency_reorder_level is not None:
+            if quantity > self.emergency_reorder_level and quantity <= self.maximum_level:
+                return True
+        return False
+
+    def is_overstocked(self, quantity):
+        if self.maximum_level is not None:
+            if quantity > self.maximum_level:
+                return True
+        return False
+
+    def status(self, quantity):
+        """
+        The one StockStatus a quantity falls into, checked in order of
+        severity.
+        """
+        if quantity is None:
+            return StockStatus.NO_DATA
+        if quantity <= 0:
+            return StockStatus.STOCKOUT
+        if self.is_below_emergency_level(quantity):
+            return StockStatus.EMERGENCY
+        if self.monthly_consumption is None:
+            return StockStatus.OTHER
+        if self.is_below_low_supply(quantity):
+            return StockStatus.LOW
+        if self.is_overstocked(quantity):
+            return StockStatus.OVERSTOCK
+        return StockStatus.GOOD
+
+
 class ProductStock(models.Model):
     """
     Indicates supply point-specific information about a product (such as monthly consumption rates)
@@ -633,6 +791,17 @@ class ProductStock(models.Model):
     manual_monthly_consumption = models.PositiveIntegerField(default=None, blank=True, null=True)
     auto_monthly_consumption = models.PositiveIntegerField(default=None, blank=True, null=True)
     use_auto_consumption = models.BooleanField(default=settings.LOGISTICS_USE_AUTO_CONSUMPTION)
+    # denormalized from stock_levels() on save, so that stocks can be
+    # filtered and counted by status in the database
+    stock_status = models.CharField(max_length=20, choices=StockStatus.STATUS_CHOICES,
+                                    null=True, blank=True, db_index=True)
+    cached_monthly_consumption = models.FloatField(null=True, blank=True)
+    cached_emergency_level = models.IntegerField(null=True, blank=True)
+    cached_reorder_level = models.IntegerField(null=True, blank=True)
+    cached_maximum_level = models.IntegerField(null=True, blank=True)
+
+    STOCK_LEVEL_FIELDS = ['stock_status', 'cached_monthly_consumption', 'cached_emergency_level',
+                          'cached_reorder_level', 'cached_maximum_level']
 
     class Meta(object):
         unique_together = (('supply_point', 'product'),)
@@ -666,6 +835,25 @@ class ProductStock(models.Model):
             self.auto_monthly_consumption = math.ceil(d * 30)
             self.save()
 
+    @classmethod
+    def update_auto_consumptions(cls, product_stocks):
+        """
+        update_auto_consumption for many product stocks at once, reading
+        all the transactions in one go and saving in bulk.
+        """
+        product_stocks = list(product_stocks)
+        consumptions = daily_consumptions([(ps.supply_point_id, ps.product_id) for ps in product_stocks])
+        updated = []
+        for ps in product_stocks:
+            d = consumptions[(ps.supply_point_id, ps.product_id)]
+            if d:
+                ps.auto_monthly_consumption = math.ceil(d * 30)
+                ps.refresh_stock_levels()
+                updated.append(ps)
+        cls.objects.bulk_update(updated, ['auto_monthly_consumption'] + cls.STOCK_LEVEL_FIELDS,
+                                batch_size=500)
+        return updated
+
     @property
     def daily_consumption(self):
         return self.get_daily_consumption()
@@ -673,54 +861,97 @@ class ProductStock(models.Model):
     def get_daily_consumption(self, datespan=None):
         return daily_consumption(self.supply_point, self.product, datespan)
         
+    def _static_emergency_level(self):
+        # if you use static levels you only get the product's data or nothing
+        return self.product.emergency_order_level
+
+    def _levels_in_months(self, names):
+        if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
+            return dict((name, getattr(settings, "LOGISTICS_%s_IN_MONTHS" % name)) for name in names)
+        policy = self.supply_point.type.policy()
+        return dict((name, policy[name]) for name in names)
+
+    def stock_levels(self):
+        """
+        The emergency, reorder and maximum levels of this stock, evaluating
+        the monthly consumption (and the stock level policy) only once.
+        """
+        monthly_consumption = self.monthly_consumption
+        static = settings.LOGISTICS_USE_STATIC_EMERGENCY_LEVELS
+        emergency_level = self._static_emergency_level() if static else None
+        reorder_level = maximum_level = None
+        if monthly_consumption is not None:
+            names = ["REORDER_LEVEL", "MAXIMUM_LEVEL"] + ([] if static else ["EMERGENCY_LEVEL"])
+            levels = dict((name, int(monthly_consumption*months)) for name, months in
+                          self._levels_in_months(names).items())
+            reorder_level, maximum_level = levels["REORDER_LEVEL"], levels["MAXIMUM_LEVEL"]
+            if not static:
+                emergency_level = levels["EMERGENCY_LEVEL"]
+        return StockLevels(monthly_consumption, emergency_level, reorder_level, maximum_level)
+
+    def refresh_stock_levels(self):
+        """
+        Update the denormalized stock level columns. Called on every save,
+        and for all the affected stocks when a product or supply point type
+        they are based on is saved; policy changes in the settings need
+        the refresh_stock_levels command.
+        """
+        try:
+            levels = self.stock_levels()
+        except ImproperlyConfigured:
+            # static emergency levels don't depend on the policy
+            emergency_level = self._static_emergency_level() \
+                if settings.LOGISTICS_USE_STATIC_EMERGENCY_LEVELS else None
+            levels = StockLevels(None, emergency_level, None, None)
+        self.cached_monthly_consumption = levels.monthly_consumption
+        self.cached_emergency_level = levels.emergency_reorder_level
+        self.cached_reorder_level = levels.reorder_level
+        self.cached_maximum_level = levels.maximum_level
+        self.stock_status = levels.status(self.quantity)
+
+    @classmethod
+    def bulk_refresh_stock_levels(cls, product_stocks, batch_size=500):
+        """
+        Refresh the stock level columns of many product stocks, writing
+        only the ones that changed. Returns the number updated.
+        """
+        updated = []
+        for ps in product_stocks:
+            before = [getattr(ps, f) for f in cls.STOCK_LEVEL_FIELDS]
+            ps.refresh_stock_levels()
+            if before != [getattr(ps, f) for f in cls.STOCK_LEVEL_FIELDS]:
+                updated.append(ps)
+        cls.objects.bulk_update(updated, cls.STOCK_LEVEL_FIELDS, batch_size=batch_size)
+        return len(updated)
+
+    def save(self, *args, **kwargs):
+        self.refresh_stock_levels()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | set(self.STOCK_LEVEL_FIELDS)
+        super(ProductStock, self).save(*args, **kwargs)
+
     @property
     def emergency_reorder_level(self):
-        # if you use static levels you only get the product's data or nothing
-        if settings.LOGISTICS_USE_STATIC_EMERGENCY_LEVELS:
-            return self.product.emergency_order_level
-        
-        elif self.monthly_consumption is not None:
-            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
-                return int(self.monthly_consumption*settings.LOGISTICS_EMERGENCY_LEVEL_IN_MONTHS)
-            else: 
-                return int(self.monthly_consumption*self.supply_point.type.policy()["EMERGENCY_LEVEL"])
-        return None
+        return self.stock_levels().emergency_reorder_level
 
     @property
     def reorder_level(self):
-        if self.monthly_consumption is not None:
-            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
-                return int(self.monthly_consumption*settings.LOGISTICS_REORDER_LEVEL_IN_MONTHS)
-            else: 
-                return int(self.monthly_consumption*self.supply_point.type.policy()["REORDER_LEVEL"])
-        return None
+        return self.stock_levels().reorder_level
 
     @property
     def maximum_level(self):
-        if self.monthly_consumption is not None:
-            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
-                return int(self.monthly_consumption*settings.LOGISTICS_MAXIMUM_LEVEL_IN_MONTHS)
-            else: 
-                return int(self.monthly_consumption*self.supply_point.type.policy()["MAXIMUM_LEVEL"])
-        return None
+        return self.stock_levels().maximum_level
 
     @property
     def reorder_amount(self):
-        if self.maximum_level is not None and self.quantity is not None:
-            return max(self.maximum_level - self.quantity, 0)
-        return None
+        return self.stock_levels().reorder_amount(self.quantity)
     
     @property
     def months_remaining(self):
         return self.calculate_months_remaining(self.quantity)
         
     def calculate_months_remaining(self, quantity):
-        if self.monthly_consumption is not None and self.monthly_consumption > 0 \
-          and quantity is not None:
-            return float(quantity) / float(self.monthly_consumption)
-        elif quantity == 0:
-            return 0
-        return None
+        return self.stock_levels().months_remaining(quantity)
 
     def is_stocked_out(self):
         if self.quantity is not None:
@@ -739,51 +970,28 @@ class ProductStock(models.Model):
         Returns False if a) below emergency levels, or
         b) emergency levels not yet defined
         """
-        if self.emergency_reorder_level is not None:
-            if self.quantity <= self.emergency_reorder_level:
-                return True
-        return False
+        return self.stock_levels().is_below_emergency_level(self.quantity)
 
     def is_below_low_supply_but_above_emergency_level(self):
-        if self.reorder_level is not None and self.emergency_reorder_level is not None:
-            if self.quantity <= self.reorder_level and self.quantity > self.emergency_reorder_level:
-                return True
-        return False
+        return self.stock_levels().is_below_low_supply_but_above_emergency_level(self.quantity)
 
     def is_below_low_supply(self):
-        if self.reorder_level is not None:
-            if self.quantity <= self.reorder_level and self.quantity > 0:
-                return True
-        return False
+        return self.stock_levels().is_below_low_supply(self.quantity)
 
     def is_above_low_supply(self):
-        if self.reorder_level is not None:
-            if self.quantity > self.reorder_level:
-                return True
-        return False
+        return self.stock_levels().is_above_low_supply(self.quantity)
 
     def is_in_good_supply(self):
-        if self.maximum_level is not None and self.reorder_level is not None:
-            if self.quantity > self.reorder_level and self.quantity <= self.maximum_level:
-                return True
-        return False
+        return self.stock_levels().is_in_good_supply(self.quantity)
 
     def is_other(self):
-        if self.monthly_consumption is None and self.quantity > 0:
-            return True
-        return False
+        return self.stock_levels().is_other(self.quantity)
 
     def is_in_adequate_supply(self):
-        if self.maximum_level is not None and self.emergency_reorder_level is not None:
-            if self.quantity > self.emergency_reorder_level and self.quantity <= self.maximum_level:
-                return True
-        return False
+        return self.stock_levels().is_in_adequate_supply(self.quantity)
 
     def is_overstocked(self):
-        if self.maximum_level is not None:
-            if self.quantity > self.maximum_level:
-                return True
-        return False
+        return self.stock_levels().is_overstocked(self.quantity)
     
     def set_auto_consumption(self):
         self.use_auto_consumption = True
@@ -978,15 +1186,16 @@ class StockRequest(models.Model):
         self.response_status = status
         self.save()
         
-    def receive(self, by, amt, on):
+    def receive(self, by, amt, on, save=True):
         assert(self.is_pending())  # we should only receive pending requests
         self.received_by = by
         self.amount_received = amt
         self.received_on = on
         self.status = StockRequestStatus.RECEIVED
-        self.save()
+        if save:
+            self.save()
         
-    def cancel(self, canceled_for):
+    def cancel(self, canceled_for, save=True):
         """
         Cancel a supply request, in lieu of a newer one
         """
@@ -994,7 +1203,8 @@ class StockRequest(models.Model):
         self.status = StockRequestStatus.CANCELED
         self.canceled_for = canceled_for
         self.amount_received = 0  # if you cancel it, you didn't get it
-        self.save()
+        if save:
+            self.save()
     
     def sms_format(self):
         assert(self.status != StockRequestStatus.CANCELED)
@@ -1012,50 +1222,93 @@ class StockRequest(models.Model):
     def pending_requests(cls):
         return cls.objects.filter(status__in=StockRequestStatus.CHOICES_PENDING)
     
+    @classmethod
+    def _pending_at(cls, supply_point):
+        return list(cls.pending_requests().filter(supply_point=supply_point)
+                    .select_related('product').order_by('-received_on'))
+
+    @classmethod
+    @transaction.atomic
+    def _reconcile(cls, supply_point, created, changed):
+        """
+        Save the requests that create_from_report or
+        close_pending_from_receipt_report worked out: insert the *created*
+        ones and write the *changed* ones (received or canceled) in bulk.
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            cls.objects.bulk_create(created)
+            saved_in_bulk = list(created)
+        else:
+            # the canceled requests need the ids of the ones that replace
+            # them, which a bulk insert doesn't give back on this database
+            for req in created:
+                req.save()
+            saved_in_bulk = []
+        canceled_for = cls._meta.get_field('canceled_for')
+        for req in changed:
+            # set the id now that the new request has one
+            if canceled_for.is_cached(req) and req.canceled_for is not None:
+                req.canceled_for_id = req.canceled_for.pk
+        cls.objects.bulk_update(changed, ['status', 'canceled_for', 'amount_received',
+                                          'received_by', 'received_on'])
+        saved_in_bulk.extend(changed)
+        if saved_in_bulk:
+            stock_requests_saved.send(sender="stock_request", supply_point=supply_point,
+                                      requests=saved_in_bulk)
+
     @classmethod
     def create_from_report(cls, stock_report, contact):
         """
         From a stock report helper object, create any pending stock requests.
         """
+        supply_point = stock_report.supply_point
+        stocks = {}
+        for ps in ProductStock.objects.filter(supply_point=supply_point).select_related('product'):
+            ps.supply_point = supply_point
+            stocks[ps.product_id] = ps
+        pending = cls._pending_at(supply_point)
+
         requests = []
+        canceled = []
         now = datetime.utcnow()
         for product_code, stock in list(stock_report.product_stock.items()):
             product = stock_report.get_product(product_code)
             
-            current_stock = ProductStock.objects.get(supply_point=stock_report.supply_point, 
-                                                     product=product)
+            current_stock = stocks.get(product.pk)
+            if current_stock is None:
+                raise ProductStock.DoesNotExist("%s doesn't stock %s" % (supply_point, product))
             if current_stock.maximum_level and current_stock.maximum_level > stock:
                 # confusingly, we don't flag emergencies unless it is an 
                 # emergency level AND an emergency order. this logic
                 # is probably not ideal
                 is_emergency = stock_report.report_type == Reports.EMERGENCY_SOH and \
                                current_stock.is_below_emergency_level()
-                req = StockRequest.objects.create(product=product, 
-                                                  supply_point=stock_report.supply_point,
-                                                  status=StockRequestStatus.REQUESTED,
-                                                  requested_by=contact,
-                                                  amount_requested=current_stock.maximum_level - stock,
-                                                  requested_on=now, 
-                                                  is_emergency=is_emergency,
-                                                  balance=stock)
+                req = StockRequest(product=product,
+                                   supply_point=supply_point,
+                                   status=StockRequestStatus.REQUESTED,
+                                   requested_by=contact,
+                                   amount_requested=current_stock.maximum_level - stock,
+                                   requested_on=now, 
+                                   is_emergency=is_emergency,
+                                   balance=stock)
                 requests.append(req)
-                pending_requests = StockRequest.pending_requests().filter(supply_point=stock_report.supply_point,
-                                                                          product=product).exclude(pk=req.pk)
                 
                 # close/delete existing pending stock requests. 
                 # The latest one trumps them.
-                assert(pending_requests.count() <= 1) # we should never have more than one pending request
-                for pending in pending_requests:
-                    pending.cancel(req)
+                for_product = [p for p in pending if p.product_id == product.pk]
+                assert(len(for_product) <= 1) # we should never have more than one pending request
+                for p in for_product:
+                    p.cancel(req, save=False)
+                    pending.remove(p)
+                    canceled.append(p)
 
         # when not using back orders, every soh report should close out all other pending requests
         if not settings.LOGISTICS_USE_BACKORDERS:
-            created_ids = [req.pk for req in requests]
-            pending_requests = StockRequest.pending_requests().filter(
-                supply_point=stock_report.supply_point).exclude(pk__in=created_ids)
-            for pending in pending_requests:
-                pending.cancel(None)
+            for p in pending:
+                p.cancel(None, save=False)
+                canceled.append(p)
 
+        cls._reconcile(supply_point, requests, canceled)
         return requests
     
     @classmethod
@@ -1064,31 +1317,30 @@ class StockRequest(models.Model):
         From a stock report helper object, close any pending stock requests.
         """
         requests = []
-        pending_reqs = StockRequest.pending_requests().filter(
-            supply_point=stock_report.supply_point,
-            product__sms_code__in=list(stock_report.product_stock.keys())
-        ).order_by('-received_on')
+        pending = cls._pending_at(stock_report.supply_point)
         now = datetime.utcnow()
         ps = set(stock_report.product_stock.keys())
-        for req in pending_reqs:
+        for req in [p for p in pending if p.product.sms_code in stock_report.product_stock]:
             if req.product.sms_code in ps:
                 req.receive(
                     contact,
                     stock_report.product_stock[req.product.sms_code],
-                    now
+                    now,
+                    save=False,
                 )
                 ps.remove(req.product.sms_code)
             else:
-                req.receive(contact, 0, now)
+                req.receive(contact, 0, now, save=False)
             requests.append(req)
 
         # if not using backorders also close out orders for non-matching products
         if not settings.LOGISTICS_USE_BACKORDERS:
-            requests_to_cancel = StockRequest.pending_requests().filter(
-                supply_point=stock_report.supply_point
-            ).order_by('-received_on')
-            for req in requests_to_cancel:
-                req.cancel(None)
+            for req in pending:
+                if req.is_pending():
+                    req.cancel(None, save=False)
+                    requests.append(req)
+
+        cls._reconcile(stock_report.supply_point, [], requests)
 
     
 class ProductReportType(models.Model):
@@ -1151,12 +1403,13 @@ class ProductReport(models.Model):
         I guess 1+3 could go on a stocktransaction signal. 
         Something to consider if we start saving stocktransactions anywhere else.
         """
-        if not created:
+        if not created or getattr(self, '_batched', False):
+            # a ProductReportBatch does all this for its reports
             return
 
         # 1. Update the facility report date information
         self.supply_point.last_reported = datetime.utcnow()
-        self.supply_point.save()
+        self.supply_point.save(update_fields=['last_reported'])
         # 2. update the stock information at the given facility """
         beginning_balance = self.supply_point.stock(self.product)
         if self.report_type.code in [Reports.SOH, Reports.EMERGENCY_SOH]:
@@ -1195,6 +1448,14 @@ class StockTransaction(models.Model):
     class Meta(object):
         verbose_name = "Stock Transaction"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(StockTransaction, cls).from_db(db, field_names, values)
+        # so that the historical stock cache can also update the month a
+        # transaction is moved out of
+        instance._loaded_date = instance.__dict__.get('date')
+        return instance
+
     def __str__(self):
         return u"%s - %s (%s->%s on %s)" % \
             (self.supply_point.name, self.product.name, self.beginning_balance, 
@@ -1263,6 +1524,106 @@ class ContactRole(models.Model):
     def __str__(self):
         return _(self.name)
 
+class ProductReportBatch(object):
+    """
+    Several product reports from a supply point (e.g. all the products in
+    one SMS), saved together. The supply point's stocks are read once and
+    the balances, transactions and stock updates worked out in memory,
+    then everything is written in bulk. The end result is the same as
+    saving the reports one by one, which runs ProductReport.post_save and
+    the StockTransaction signals for every product.
+    """
+
+    def __init__(self, supply_point, message=None, date=None):
+        self.supply_point = supply_point
+        self.message = message
+        self.date = date if date else datetime.utcnow()
+        self.reports = []
+        self.transactions = []
+        self.stocks = {}
+        for ps in ProductStock.objects.filter(supply_point=supply_point).select_related('product'):
+            ps.supply_point = supply_point
+            self.stocks[ps.product_id] = ps
+        self._changed_stocks = {}
+        self._report_types = {}
+
+    def balance(self, product):
+        """
+        The stock of the product, including the reports so far.
+        """
+        ps = self.stocks.get(product.pk)
+        if ps is None or ps.quantity is None:
+            return 0
+        return ps.quantity
+
+    def _report_type(self, report_type):
+        if isinstance(report_type, ProductReportType):
+            return report_type
+        if report_type not in self._report_types:
+            self._report_types[report_type] = ProductReportType.objects.get(code=report_type)
+        return self._report_types[report_type]
+
+    def report(self, product, report_type, quantity):
+        """
+        Add a report of the product (report_type can be a code), updating
+        the balance. Nothing is saved until save().
+        """
+        pr = ProductReport(product=product, report_type=self._report_type(report_type),
+                           quantity=quantity, message=self.message,
+                           supply_point=self.supply_point, report_date=self.date)
+        st = StockTransaction.from_product_report(pr, self.balance(product))
+        ps = self.stocks.get(product.pk)
+        if ps is None:
+            ps = self.stocks[product.pk] = ProductStock(
+                is_active=settings.LOGISTICS_DEFAULT_PRODUCT_ACTIVATION_STATUS,
+                supply_point=self.supply_point, product=product)
+        ps.last_modified = datetime.utcnow()
+        ps.quantity = st.ending_balance
+        self._changed_stocks[product.pk] = ps
+        self.reports.append(pr)
+        self.transactions.append(st)
+        return pr
+
+    def _save_reports(self):
+        if connection.features.can_return_rows_from_bulk_insert:
+            ProductReport.objects.bulk_create(self.reports)
+        else:
+            # the transactions need the reports' ids, which a bulk insert
+            # doesn't give back on this database
+            for pr in self.reports:
+                pr._batched = True
+                pr.save()
+
+    @transaction.atomic
+    def save(self):
+        if not self.reports:
+            return
+        self.supply_point.last_reported = datetime.utcnow()
+        self.supply_point.save(update_fields=['last_reported'])
+        self._save_reports()
+
+        stocks = list(self._changed_stocks.values())
+        existing = [ps for ps in stocks if ps.pk is not None]
+        for ps in existing:
+            ps.refresh_stock_levels()
+        ProductStock.objects.bulk_update(
+            existing, ['quantity', 'last_modified'] + ProductStock.STOCK_LEVEL_FIELDS)
+        for ps in stocks:
+            if ps.pk is None:
+                # a product stocked for the first time, which is rare
+                # enough to be saved the usual way
+                ps.save()
+        StockTransaction.objects.bulk_create(self.transactions)
+
+        # what the transactions' signals would have done
+        ProductStock.update_auto_consumptions(stocks)
+        HistoricalStockCache.update_months(
+            (st.supply_point_id, st.product_id, st.date.year, st.date.month) for st in self.transactions)
+        stock_reports_saved.send(sender="product_report", supply_point=self.supply_point,
+                                 reports=self.reports, transactions=self.transactions,
+                                 product_stocks=stocks)
+
+
 class Validator(object):
     """ This validator is used by the ProductReportsHelper
     in order to check whether a given set of stock reports submitted at the same
@@ -1292,6 +1653,7 @@ class ProductReportsHelper(object):
         self.timestamp = timestamp if timestamp else datetime.utcnow()
         self.errors = []
         self.validator = validator
+        self.catalog = get_catalog()
     
     def validate(self):
         self.validator.validate(supply_point=self.supply_point, 
@@ -1342,11 +1704,11 @@ class ProductReportsHelper(object):
     
     def clean_product_code(self, code):
         code = code.lower()
-        if hasattr(settings, "LOGISTICS_PRODUCT_ALIASES"):
-            # support aliases for product codes.
-            if code in settings.LOGISTICS_PRODUCT_ALIASES:
-                assert(not Product.objects.filter(sms_code__iexact=code).exists()) 
-                code = settings.LOGISTICS_PRODUCT_ALIASES[code]
+        # support aliases for product codes.
+        alias_for = self.catalog.resolve_alias(code)
+        if alias_for != code:
+            assert(self.catalog.get(code) is None)
+            code = alias_for
         return code
     
     def newparse(self, string, delimiters=" "):
@@ -1422,30 +1784,23 @@ class ProductReportsHelper(object):
     def save(self):
         stockouts_reported = []
         stockouts_resolved = []
+        batch = ProductReportBatch(self.supply_point, message=self.message, date=self.timestamp)
         # NOTE: receipts should be processed BEFORE stock levels
         # (so that after someone reports jd10.3, we record that
         # we've received 3 jd this past week and the current stock
         # level is 10)
         for stock_code in self.product_received:
-            self._record_product_report(self.get_product(stock_code), 
-                                        self.product_received[stock_code], 
-                                        Reports.REC)
+            batch.report(self.get_product(stock_code), Reports.REC,
+                         self.product_received[stock_code])
         for stock_code in self.product_stock:
-            try:
-                original_quantity = ProductStock.objects.get(supply_point=self.supply_point, 
-                                                             product__sms_code=stock_code).quantity
-            except ProductStock.DoesNotExist:
-                original_quantity = 0
-
-            if original_quantity is None:
-                original_quantity = 0
-
+            product = self.get_product(stock_code)
+            original_quantity = batch.balance(product)
             new_quantity = self.product_stock[stock_code]
 
             if original_quantity == 0 and new_quantity == 0 and settings.LOGISTICS_IGNORE_EMPTY_STOCKS:
                 continue
 
-            self._record_product_report(self.get_product(stock_code), new_quantity, self.report_type)
+            batch.report(product, self.report_type, new_quantity)
 
             # in the case of transfers out this logic is broken
             # for now that's ok, since malawi doesn't do anything with this
@@ -1453,6 +1808,7 @@ class ProductReportsHelper(object):
                 stockouts_resolved.append(stock_code)
             if original_quantity > 0 and new_quantity == 0:
                 stockouts_reported.append(stock_code)
+        batch.save()
         reporter = self.message.connection.contact if self.message \
             and self.message.connection \
             and self.message.connection.contact else None
@@ -1481,10 +1837,10 @@ class ProductReportsHelper(object):
         Gets a product by code, or raises an UnknownCommodityCodeError 
         if the product can't be found.
         """
-        try:
-            return Product.objects.get(sms_code__icontains=product_code)
-        except (Product.DoesNotExist, Product.MultipleObjectsReturned):
+        products = self.catalog.matching(product_code)
+        if len(products) != 1:
             raise UnknownCommodityCodeError(product_code)
+        return products[0]
     
     def add_product_stock(self, product_code, stock, save=False, consumption=None):
         if isinstance(stock, basestring) and stock.isdigit():
@@ -1634,4 +1990,12 @@ def transactions_before_or_during(year, month, day=None):
 from .warehouse_models import *
 
 post_save.connect(post_save_product_report, sender=ProductReport)
+for model in (Product, ProductType):
+    post_save.connect(invalidate_catalog, sender=model)
+    post_delete.connect(invalidate_catalog, sender=model)
+post_save.connect(supply_point_closure.post_save, sender=SupplyPoint)
+post_save.connect(refresh_product_stock_levels, sender=Product)
+post_save.connect(refresh_supply_point_type_stock_levels, sender=SupplyPointType)
 post_save.connect(post_save_stock_transaction, sender=StockTransaction)
+post_save.connect(update_historical_stock_cache, sender=StockTransaction)
+post_delete.connect(update_historical_stock_cache, sender=StockTransaction)
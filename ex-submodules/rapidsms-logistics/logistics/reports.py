@@ -2,14 +2,15 @@ from __future__ import division
 from __future__ import unicode_literals
 import sentry_sdk
 from past.utils import old_div
-from builtins import object
+from builtins import object, range
 import json
+from collections import defaultdict
 from datetime import timedelta, datetime
 from django.core.exceptions import ObjectDoesNotExist
 from django.urls import reverse
 from django.db.models.expressions import F
 from django.shortcuts import render
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef, Subquery
 from rapidsms.conf import settings
 from logistics_project.utils.dates import DateSpan
 from logistics.models import ProductReport, \
@@ -55,39 +56,50 @@ def _seconds(td):
     """
     return td.days * 24 * 60 * 60 + td.seconds
 
+def _chunks(items, size=500):
+    """
+    The items in lists of at most *size*, to keep "in" lookups small.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 class ReportingBreakdown(object):
     """
     Given a query set of supply points, get an object for displaying reporting
     information.
+
+    The stock on hand reports in the datespan are fetched once, ordered by
+    supply point, product and date, and everything is worked out from them
+    in a single pass.
     """
-    
+
     def __init__(self, supply_points, datespan=None, include_late=False,
                  days_for_late=5, MNE=False, request=None):
-        
+
         self.supply_points = supply_points = supply_points.filter(active=True)
-        
+
         if not datespan:
             datespan = DateSpan.since(30)
         self.datespan = datespan
-        
+
         self._request = request
         self.include_late = include_late
         self.days_for_late = days_for_late
         date_for_late = datespan.startdate + timedelta(days=days_for_late)
-        
+
         reports_in_range = ProductReport.objects.filter\
             (report_type__code=Reports.SOH,
              report_date__gte=datespan.startdate,
              report_date__lte=datespan.enddate,
              supply_point__in=supply_points)
-        
+
         reported_in_range = reports_in_range.values_list\
             ("supply_point", flat=True).distinct()
-        
+
         reported_on_time_in_range = reports_in_range.filter\
             (report_date__lte=date_for_late).values_list\
             ("supply_point", flat=True).distinct()
-        
+
         non_reporting = supply_points.exclude(pk__in=reported_in_range)
         reported = SupplyPoint.objects.filter(pk__in=reported_in_range)
         reported_late = reported.exclude(pk__in=reported_on_time_in_range)
@@ -106,56 +118,20 @@ class ReportingBreakdown(object):
             emergency_requesters = emergency_requests.values_list("supply_point", flat=True).distinct()
 
             filled_requests = requests_in_range.exclude(received_on=None).exclude(status='canceled')
-            discrepancies = filled_requests.exclude(amount_requested=F('amount_received'))
-            discrepancies_list = discrepancies.values_list("product", flat=True) #not distinct!
-            orders_list = filled_requests.values_list("product", flat=True)
-
-            # We could save a lot of time here if the primary key for Product were its sms_code.
-            # Unfortunately, it isn't, so we have to remap keys->codes.
-            _p = {}
-            for p in Product.objects.filter(pk__in=orders_list.distinct()): _p[p.pk] = p.sms_code
-            def _map_codes(dict):
-                nd = {}
-                for d in dict:
-                    nd[_p[d]] = dict[d]
-                return nd
-
-            # Discrepancies are defined as a difference of 20% or more in an order.
-
-            self.discrepancies_p = {}
-            self.discrepancies_tot_p = {}
-            self.discrepancies_pct_p = {}
-            self.discrepancies_avg_p = {}
-            self.filled_orders_p = {}
-            for product in orders_list.distinct():
-                self.discrepancies_p[product] = len([r for r in [x for x in discrepancies if x.product.pk == product] if (r.amount_received >= (1.2 * r.amount_requested) or
-                                                                      r.amount_received <= (.8 * r.amount_requested))])
-
-                z = [r.amount_requested - r.amount_received for r in \
-                     discrepancies.filter(product__pk=product)]
-                self.discrepancies_tot_p[product] = sum(z)
-                if self.discrepancies_p[product]: 
-                    self.discrepancies_avg_p[product] = \
-                        old_div(self.discrepancies_tot_p[product], self.discrepancies_p[product])
-                
-                self.filled_orders_p[product] = len([x for x in orders_list if x == product])
-                self.discrepancies_pct_p[product] = calc_percentage\
-                    (self.discrepancies_p[product], self.filled_orders_p[product])
-
+            self._discrepancies(filled_requests)
 
-            self.discrepancies_p = _map_codes(self.discrepancies_p)
-            self.discrepancies_tot_p = _map_codes(self.discrepancies_tot_p)
-            self.discrepancies_pct_p = _map_codes(self.discrepancies_pct_p)
-            self.discrepancies_avg_p = _map_codes(self.discrepancies_avg_p)
-            self.filled_orders_p = _map_codes(self.filled_orders_p)
+        # every report in range, as supply point -> product -> [(id, date, quantity)]
+        found = defaultdict(lambda: defaultdict(list))
+        for report in reports_in_range.order_by('supply_point', 'product', 'report_date', 'pk')\
+                .values_list('supply_point', 'product', 'pk', 'report_date', 'quantity'):
+            found[report[0]][report[1]].append(report[2:])
 
-
-            self.avg_req_time = None
-            self.req_times = []
-            if filled_requests:
-                secs = [_seconds(f.received_on - f.requested_on) for f in filled_requests]
-                self.avg_req_time = timedelta(seconds=(old_div(sum(secs), len(secs))))
-                self.req_times = secs
+        reporters = list(reported.all())
+        stocked = SupplyPoint.commodities_stocked_by_supply_point(reporters)
+        # in the default Product ordering, as iterated over below
+        products = dict((p.pk, p) for p in Product.objects.filter(
+            pk__in=set(p for sp_reports in found.values() for p in sp_reports)))
+        product_order = list(products)
 
         # fully reporting / non reporting
         full = []
@@ -168,11 +144,10 @@ class ReportingBreakdown(object):
         totals_p = {}
         stockouts_duration_p = {}
         stockouts_avg_duration_p = {}
-        for sp in reported.all():
-            
-            found_reports = reports_in_range.filter(supply_point=sp)
-            found_products = set(found_reports.values_list("product", flat=True).distinct())
-            needed_products = set([c.pk for c in sp.commodities_stocked()])
+        for sp in reporters:
+            found_reports = found[sp.pk]
+            found_products = set(found_reports)
+            needed_products = stocked[sp.pk]
             if needed_products:
                 if needed_products - found_products:
                     partial.append(sp)
@@ -181,61 +156,30 @@ class ReportingBreakdown(object):
             else:
                 unconfigured.append(sp)
             if MNE:
-                prods = Product.objects.filter(pk__in=list(found_products))
+                prods = [products[p] for p in product_order if p in found_products]
                 for p in prods:
                     if not p.code in stockouts_p: stockouts_p[p.sms_code] = 0
                     if not p.code in no_stockouts_p: no_stockouts_p[p.sms_code] = 0
                     if not p.code in totals_p: totals_p[p.sms_code] = 0
-                    if found_reports.filter(product=p, quantity=0):
+                    if any(quantity == 0 for pk, date, quantity in found_reports[p.pk]):
                         stockouts_p[p.sms_code] += 1
                     else:
                         no_stockouts_p[p.sms_code] += 1
                     totals_p[p.sms_code] += 1
 
-                if found_reports.filter(quantity=0):
+                if any(quantity == 0 for p in prods for pk, date, quantity in found_reports[p.pk]):
                     stockouts.append(sp.pk)
-#                    prods = found_reports.values_list("product", flat=True).distinct()
-                    for p in prods:
-                        duration = 0
-                        count = 0
-                        last_stockout = None
-                        ordered_reports = found_reports.filter(product=p).order_by("report_date")
-                        if ordered_reports.count():
-                            # Check if a stockout carried over from last period.
-                            last_prev_report = ProductReport.objects.filter(product=p,
-                                                                            supply_point=sp,
-                                                                            report_date__lt=ordered_reports[0].report_date).order_by("-report_date")
-                            if last_prev_report.count() and last_prev_report[0].quantity == 0:
-                                last_stockout = datespan.startdate
-
-                            # Check if a stockout carries over into next period.
-
-
-                        for r in ordered_reports:
-                            if last_stockout and r.quantity > 0: # Stockout followed by receipt.
-                                duration += _seconds(r.report_date - last_stockout)
-                                last_stockout = None
-                                count += 1
-                            elif not last_stockout and r.quantity == 0: # Beginning of a stockout period.
-                                last_stockout = r.report_date
-                            else: # In the middle of a stock period, or the middle of a stockout period; either way, we don't care.
-                                pass
-
-                        if last_stockout:
-                            first_next_report = ProductReport.objects.filter(product=p,
-                                supply_point=sp,
-                                quantity__gt=0,
-                                report_date__gt=ordered_reports.order_by("-report_date")[0].report_date)
-                            if first_next_report.count() and first_next_report[0].quantity > 0:
-                                duration += _seconds(datespan.enddate - last_stockout)
-
-                        if p.sms_code in stockouts_duration_p and duration:
-                            stockouts_duration_p[p.sms_code] += [duration]
-                        elif duration:
-                            stockouts_duration_p[p.sms_code] = [duration]
                 else:
                     no_stockouts.append(sp.pk)
+
         if MNE:
+            durations = self._stockout_durations(found, stockouts)
+            for sp_id in stockouts:
+                for p in product_order:
+                    duration = durations.get((sp_id, p))
+                    if duration:
+                        stockouts_duration_p.setdefault(products[p].sms_code, []).append(duration)
+
             no_stockouts_pct_p = {}
 
             for key in no_stockouts_p:
@@ -254,17 +198,116 @@ class ReportingBreakdown(object):
             self.totals_p = totals_p
             self.stockouts_duration_p = stockouts_duration_p
             self.stockouts_avg_duration_p = stockouts_avg_duration_p
-        # ro 10/14/11 - not sure why querysets are necessary. 
+        # ro 10/14/11 - not sure why querysets are necessary.
         # something changed in the djtables tables spec with the new ordering features?
         self.full = SupplyPoint.objects.filter(pk__in=[f.pk for f in full])
         self.partial = SupplyPoint.objects.filter(pk__in=[p.pk for p in partial])
         self.unconfigured = unconfigured
-        
+
         self.non_reporting = non_reporting
         self.reported = reported
         self.reported_on_time = reported_on_time
         self.reported_late = reported_late
 
+    def _discrepancies(self, filled_requests):
+        """
+        Discrepancies between the amounts requested and received, by product.
+        Discrepancies are defined as a difference of 20% or more in an order.
+        """
+        filled = list(filled_requests.values_list('product', 'amount_requested', 'amount_received',
+                                                  'requested_on', 'received_on'))
+        discrepancies = set(filled_requests.exclude(amount_requested=F('amount_received'))
+                            .values_list('pk', flat=True))
+        # the product ids and (amount requested, amount received) of each discrepancy
+        discrepancy_amounts = defaultdict(list)
+        filled_orders = defaultdict(int)
+        for pk, product, requested, received in filled_requests.values_list(
+                'pk', 'product', 'amount_requested', 'amount_received'):
+            filled_orders[product] += 1
+            if pk in discrepancies:
+                discrepancy_amounts[product].append((requested, received))
+
+        # We could save a lot of time here if the primary key for Product were its sms_code.
+        # Unfortunately, it isn't, so we have to remap keys->codes.
+        _p = dict(Product.objects.filter(pk__in=list(filled_orders)).values_list('pk', 'sms_code'))
+
+        self.discrepancies_p = {}
+        self.discrepancies_tot_p = {}
+        self.discrepancies_pct_p = {}
+        self.discrepancies_avg_p = {}
+        self.filled_orders_p = {}
+        for product, orders in filled_orders.items():
+            code = _p[product]
+            amounts = discrepancy_amounts[product]
+            self.discrepancies_p[code] = len([1 for requested, received in amounts
+                                              if (received >= (1.2 * requested) or
+                                                  received <= (.8 * requested))])
+            self.discrepancies_tot_p[code] = sum(requested - received for requested, received in amounts)
+            if self.discrepancies_p[code]:
+                self.discrepancies_avg_p[code] = \
+                    old_div(self.discrepancies_tot_p[code], self.discrepancies_p[code])
+            self.filled_orders_p[code] = orders
+            self.discrepancies_pct_p[code] = calc_percentage\
+                (self.discrepancies_p[code], self.filled_orders_p[code])
+
+        self.avg_req_time = None
+        self.req_times = []
+        if filled:
+            secs = [_seconds(received_on - requested_on) for p, ar, rr, requested_on, received_on in filled]
+            self.avg_req_time = timedelta(seconds=(old_div(sum(secs), len(secs))))
+            self.req_times = secs
+
+    def _stockout_durations(self, found, stockouts):
+        """
+        The seconds each product was stocked out for in the datespan, keyed
+        by (supply point id, product id), for the supply points that had a
+        stockout.
+
+        A stockout carries over from the last period if the last report
+        (of any kind) before the first one in range was a stockout, and into
+        the next period if there is a later report with stock.
+        """
+        datespan = self.datespan
+        first_reports = [reports[0][0] for sp_id in stockouts for reports in found[sp_id].values()]
+        carried_over = set()
+        for chunk in _chunks(first_reports):
+            last_before = ProductReport.objects.filter(
+                supply_point=OuterRef('supply_point'), product=OuterRef('product'),
+                report_date__lt=OuterRef('report_date'),
+            ).order_by('-report_date', '-pk').values('quantity')[:1]
+            carried_over.update(
+                ProductReport.objects.filter(pk__in=chunk)
+                .annotate(last_quantity=Subquery(last_before))
+                .filter(last_quantity=0)
+                .values_list('supply_point', 'product'))
+
+        durations = {}
+        ongoing = {}    # (supply point, product) -> (start of stockout, last report in range)
+        for sp_id in stockouts:
+            for product_id, reports in found[sp_id].items():
+                duration = 0
+                last_stockout = datespan.startdate if (sp_id, product_id) in carried_over else None
+                for pk, report_date, quantity in reports:
+                    if last_stockout and quantity > 0:  # Stockout followed by receipt.
+                        duration += _seconds(report_date - last_stockout)
+                        last_stockout = None
+                    elif not last_stockout and quantity == 0:  # Beginning of a stockout period.
+                        last_stockout = report_date
+                durations[(sp_id, product_id)] = duration
+                if last_stockout:
+                    ongoing[(sp_id, product_id)] = (last_stockout, reports[-1][0])
+
+        # Check if a stockout carries over into next period.
+        for chunk in _chunks(list(ongoing.values())):
+            next_with_stock = ProductReport.objects.filter(
+                supply_point=OuterRef('supply_point'), product=OuterRef('product'),
+                quantity__gt=0, report_date__gt=OuterRef('report_date'))
+            for key in ProductReport.objects.filter(pk__in=[last for start, last in chunk])\
+                    .annotate(restocked=Exists(next_with_stock)).filter(restocked=True)\
+                    .values_list('supply_point', 'product'):
+                durations[key] += _seconds(datespan.enddate - ongoing[key][0])
+        return durations
+
     @property
     def on_time(self):
         """
@@ -481,32 +524,22 @@ class ProductAvailabilitySummaryByFacilitySP(ProductAvailabilitySummary):
 
         products = Product.objects.all().order_by('sms_code')
         data = []
-        
-        for p in products:
 
-            # once we want to use the cache we can use these to populate
-            # this object, but for now disable it
-            if False:
-                relevant = HistoricalStockCache.objects.filter(product=p,
-                                                               year=year, 
-                                                               month=month)
-                with_stock = relevant.filter(stock__gt=0).count()
-                without_stock = relevant.filter(stock=0).count()
-                without_data = total - with_stock - without_stock
-            else:
-                # TODO This is ludicrously inefficient.
-            
-                with_stock = 0
-                without_stock = 0
-                without_data = 0
-                for f in facilities:
-                    stock = f.historical_stock(p, year, month, default_value=-1)
-                    if stock > 0:
-                        with_stock += 1
-                    elif stock == 0:
-                        without_stock += 1
-                    else:
-                        without_data += 1
+        stock = HistoricalStockCache.stock_at_month_end(
+            [f.pk for f in facilities], [p.pk for p in products], year, month
+        )
+        for p in products:
+            with_stock = 0
+            without_stock = 0
+            without_data = 0
+            for f in facilities:
+                product_stock = stock.get((f.pk, p.pk), -1)
+                if product_stock > 0:
+                    with_stock += 1
+                elif product_stock == 0:
+                    without_stock += 1
+                else:
+                    without_data += 1
             data.append({"product": p,
                          "total": total,
                          "with_stock": with_stock,
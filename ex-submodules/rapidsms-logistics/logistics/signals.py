@@ -4,6 +4,13 @@ from django.dispatch import Signal
 
 stockout_reported = Signal()
 stockout_resolved = Signal()
+# sent after a ProductReportBatch is saved, with the supply_point and the
+# reports, transactions and product_stocks it saved (in bulk, so without
+# their post_save signals)
+stock_reports_saved = Signal()
+# sent after stock requests are created, received or canceled in bulk,
+# with the supply_point and the requests saved without their post_save
+stock_requests_saved = Signal()
 
 def notify_suppliees_of_stockouts_resolved(sender, supply_point, products, resolved_by, **kwargs):
     supply_point.notify_suppliees_of_stockouts_resolved([p.code for p in products], 
@@ -20,6 +27,51 @@ def post_save_stock_transaction(sender, instance, created, **kwargs):
                                   product=instance.product)
     ps.update_auto_consumption()
 
+def update_historical_stock_cache(sender, instance, **kwargs):
+    """
+    Keep the month end stock in the HistoricalStockCache up to date as
+    transactions are saved and deleted, including the month a transaction
+    was moved out of.
+    """
+    from logistics.models import HistoricalStockCache
+    deleted = 'created' not in kwargs
+    dates = set([instance.date, getattr(instance, '_loaded_date', None)])
+    for year, month in set((d.year, d.month) for d in dates if d is not None):
+        # never create rows on delete, the supply point may be on its way out too
+        HistoricalStockCache.update_month(instance.supply_point_id, instance.product_id,
+                                          year, month, create=not deleted)
+    instance._loaded_date = instance.date
+
+def refresh_product_stock_levels(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Refresh the stock level columns of a product's stocks when its
+    average monthly consumption or emergency order level changes.
+    """
+    from logistics.models import ProductStock
+    if created:
+        return
+    if update_fields is not None and not set(update_fields) & set(instance.STOCK_LEVEL_FIELDS):
+        return
+    levels = [getattr(instance, f) for f in instance.STOCK_LEVEL_FIELDS]
+    if levels == getattr(instance, '_loaded_stock_levels', None):
+        return
+    ProductStock.bulk_refresh_stock_levels(
+        ProductStock.objects.filter(product=instance)
+        .select_related('supply_point', 'supply_point__type', 'product').iterator())
+    instance._loaded_stock_levels = levels
+
+def refresh_supply_point_type_stock_levels(sender, instance, created, **kwargs):
+    """
+    Refresh the stock level columns of every stock at supply points of a
+    type, since the type's consumption defaults and policy feed them.
+    """
+    from logistics.models import ProductStock
+    if created:
+        return
+    ProductStock.bulk_refresh_stock_levels(
+        ProductStock.objects.filter(supply_point__type=instance)
+        .select_related('supply_point', 'supply_point__type', 'product').iterator())
+
 @transaction.atomic
 def post_save_product_report(sender, instance, created, **kwargs):
     """
@@ -1,3 +1,8 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 from .consumption import *
+from .stock_counts import *
+from .historical_stock import *
+from .report_batch import *
+from .stock_requests import *
+from .catalog import *
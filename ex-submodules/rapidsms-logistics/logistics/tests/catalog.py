@@ -0,0 +1,61 @@
+from __future__ import unicode_literals
+from django.core.cache import cache
+from django.db import transaction
+from rapidsms.tests.scripted import TestScript
+from logistics.catalog import get_catalog, _catalog_version, CATALOG_VERSION_KEY
+from logistics.const import Reports
+from logistics.errors import UnknownCommodityCodeError
+from logistics.models import Location, SupplyPoint, Product, ProductStock, ProductType, \
+    ProductReportsHelper
+from logistics.tests.util import load_test_data
+
+
+class TestProductCatalog(TestScript):
+
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.ov = Product.objects.get(sms_code='ov')
+
+    def testParseWithoutQueries(self):
+        ml = Product.objects.get(sms_code='ml')
+        get_catalog()
+        with self.assertNumQueries(0):
+            helper = ProductReportsHelper(self.sp, Reports.SOH)
+            helper.newparse("OV 10 ml 5")
+            self.assertEqual([self.ov, ml],
+                             [helper.get_product(code) for code in ('ov', 'm')])
+            self.assertEqual(self.ov, Product.by_code('ov'))
+            self.assertEqual('fp', helper.get_product('ov').type.code)
+        self.assertRaises(UnknownCommodityCodeError, helper.get_product, 'xx')
+        self.assertRaises(Product.DoesNotExist, Product.by_code, 'xx')
+
+    def testInvalidation(self):
+        self.assertEqual(self.ov, get_catalog().get('ov', active=True))
+        self.ov.deactivate()
+        self.assertIsNone(get_catalog().get('ov', active=True))
+
+        other = ProductType.objects.create(code='other', name='Other', base_level='f')
+        Product.objects.create(sms_code='zz', name='Zz', units='each', type=other)
+        self.assertEqual(other, get_catalog().get('ZZ', base_level='f').type)
+        self.assertIsNone(get_catalog().get('zz', base_level='h'))
+        other.base_level = 'h'
+        other.save()
+        self.assertIsNotNone(get_catalog().get('zz', base_level='h'))
+
+    def testVersionBumpedOnCommit(self):
+        version = _catalog_version()
+        with transaction.atomic():
+            self.ov.deactivate()
+            # the other processes keep the version until the commit
+            self.assertEqual(version, cache.get(CATALOG_VERSION_KEY))
+        self.assertNotEqual(version, cache.get(CATALOG_VERSION_KEY))
+        self.assertIsNone(get_catalog().get('ov', active=True))
+
+    def tearDown(self):
+        Location.objects.all().delete()
+        SupplyPoint.objects.all().delete()
+        Product.objects.all().delete()
+        ProductStock.objects.all().delete()
+        TestScript.tearDown(self)
@@ -8,7 +8,8 @@ from logistics.models import Location, SupplyPointType, SupplyPoint, \
     ProductReportType
 from logistics.models import SupplyPoint as Facility
 from logistics.tests.util import load_test_data, fake_report
-from logistics.const import Reports
+from logistics.const import Reports, StockStatus
+from logistics.consumption import daily_consumption, daily_consumptions
 
 class TestConsumption (TestScript):
     def setUp(self):
@@ -392,6 +393,51 @@ class TestConsumption (TestScript):
         self.ps = self._report(5, 5, Reports.SOH)
         self.assertEqual(1, self.ps.daily_consumption)
 
+    def testBulkConsumptions(self):
+        other = Product.objects.exclude(pk=self.pr.pk)[0]
+        for amount, days_ago, report_type in [(40, 60, Reports.SOH), (30, 50, Reports.REC),
+                                              (20, 50, Reports.SOH), (10, 40, Reports.SOH)]:
+            self._report(amount, days_ago, report_type)
+        fake_report(self.sp, other, 100, 30, Reports.SOH)
+        fake_report(self.sp, other, 0, 20, Reports.SOH)
+        fake_report(self.sp, other, 50, 10, Reports.SOH)
+        pairs = [(self.sp.pk, self.pr.pk), (self.sp.pk, other.pk), (self.sp.pk, 0)]
+        consumptions = daily_consumptions(pairs)
+        self.assertEqual(3, consumptions[(self.sp.pk, self.pr.pk)])
+        self.assertEqual(None, consumptions[(self.sp.pk, 0)])
+        for sp_id, product_id in pairs[:2]:
+            self.assertEqual(daily_consumption(SupplyPoint.objects.get(pk=sp_id),
+                                               Product.objects.get(pk=product_id)),
+                             consumptions[(sp_id, product_id)])
+
+    def testStockLevels(self):
+        self.ps = self._report(30, 30, Reports.SOH)
+        self.ps = self._report(20, 20, Reports.SOH)
+        self.ps = self._report(10, 10, Reports.SOH)
+        levels = self.ps.stock_levels()
+        self.assertEqual(30, levels.monthly_consumption)
+        self.assertEqual(self.ps.emergency_reorder_level, levels.emergency_reorder_level)
+        self.assertEqual(self.ps.reorder_level, levels.reorder_level)
+        self.assertEqual(self.ps.maximum_level, levels.maximum_level)
+        self.assertEqual(levels.reorder_level, self.ps.cached_reorder_level)
+        for quantity in range(0, levels.maximum_level + 2):
+            status = levels.status(quantity)
+            self.assertEqual(quantity == 0, status == StockStatus.STOCKOUT)
+            self.assertEqual(levels.is_below_emergency_level(quantity) and quantity > 0,
+                             status == StockStatus.EMERGENCY)
+            self.assertEqual(levels.is_below_low_supply(quantity) and
+                             not levels.is_below_emergency_level(quantity),
+                             status == StockStatus.LOW)
+            self.assertEqual(levels.is_in_good_supply(quantity), status == StockStatus.GOOD)
+            self.assertEqual(levels.is_overstocked(quantity), status == StockStatus.OVERSTOCK)
+
+        self.ps.quantity = 0
+        self.ps.save()
+        self.assertEqual(1, ProductStock.objects.filter(pk=self.ps.pk, stock_status=StockStatus.STOCKOUT).count())
+        ProductStock.objects.filter(pk=self.ps.pk).update(stock_status=None)
+        self.assertEqual(1, ProductStock.bulk_refresh_stock_levels(ProductStock.objects.filter(pk=self.ps.pk)))
+        self.assertEqual(StockStatus.STOCKOUT, ProductStock.objects.get(pk=self.ps.pk).stock_status)
+
     def _report(self, amount, days_ago, report_type):
         self.ps = fake_report(self.sp, self.pr, amount, days_ago, report_type)[1]
         return self.ps
@@ -0,0 +1,79 @@
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+from rapidsms.tests.scripted import TestScript
+from logistics.models import Location, SupplyPoint, Product, ProductStock, \
+    StockTransaction, ProductReport, HistoricalStockCache
+from logistics.reports import ProductAvailabilitySummaryByFacilitySP
+from logistics.tests.util import load_test_data, fake_report
+from logistics.const import Reports
+
+
+class TestHistoricalStock(TestScript):
+
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.all()[0]
+        self.pr = Product.objects.get(sms_code='ov')
+        self.other = Product.objects.get(sms_code='ml')
+        for amount, date in [(100, datetime(2012, 1, 10)), (80, datetime(2012, 1, 25)),
+                             (50, datetime(2012, 3, 5)), (20, datetime(2012, 3, 20))]:
+            fake_report(self.sp, self.pr, amount, 0, Reports.SOH, date=date)
+        fake_report(self.sp, self.other, 7, 0, Reports.SOH, date=datetime(2012, 2, 1))
+
+    def _expected(self, product, before, default_value=0):
+        txs = StockTransaction.objects.filter(supply_point=self.sp, product=product,
+                                              date__lt=before).order_by('-date', '-pk')
+        return txs[0].ending_balance if txs.exists() else default_value
+
+    def testMonthEnds(self):
+        self.assertEqual(3, HistoricalStockCache.objects.filter(supply_point=self.sp).count())
+        for year, month in [(2011, 12), (2012, 1), (2012, 2), (2012, 3), (2012, 4), (2013, 1)]:
+            next_month = datetime(year + month // 12, month % 12 + 1, 1)
+            for product in (self.pr, self.other):
+                self.assertEqual(self._expected(product, next_month, -1),
+                                 self.sp.historical_stock(product, year, month, default_value=-1))
+
+    def testByDate(self):
+        for date in [datetime(2012, 1, 9), datetime(2012, 1, 10), datetime(2012, 2, 15),
+                     datetime(2012, 3, 5), datetime(2012, 3, 19), datetime(2012, 5, 1)]:
+            self.assertEqual(self._expected(self.pr, date + timedelta(days=2)),
+                             self.sp.historical_stock_by_date(self.pr, date))
+
+    def testBulkLookup(self):
+        stock = HistoricalStockCache.stock_as_of([self.sp.pk], [self.pr.pk, self.other.pk],
+                                                 datetime(2012, 3, 10))
+        self.assertEqual({(self.sp.pk, self.pr.pk): 50, (self.sp.pk, self.other.pk): 7}, stock)
+
+    def testMovedAndDeletedTransactions(self):
+        tx = StockTransaction.objects.get(supply_point=self.sp, product=self.pr, ending_balance=20)
+        tx.date = datetime(2012, 4, 2)
+        tx.save()
+        self.assertEqual(50, self.sp.historical_stock(self.pr, 2012, 3))
+        self.assertEqual(20, self.sp.historical_stock(self.pr, 2012, 4))
+        StockTransaction.objects.get(supply_point=self.sp, product=self.pr, ending_balance=50).delete()
+        self.assertEqual(80, self.sp.historical_stock(self.pr, 2012, 3))
+        before = list(HistoricalStockCache.objects.order_by('year', 'month', 'product')
+                      .values_list('product', 'year', 'month', 'stock'))
+        HistoricalStockCache.rebuild([self.sp])
+        self.assertEqual(before, list(HistoricalStockCache.objects.order_by('year', 'month', 'product')
+                                      .values_list('product', 'year', 'month', 'stock')))
+
+    def testAvailabilitySummary(self):
+        facilities = SupplyPoint.objects.filter(pk=self.sp.pk)
+        summary = ProductAvailabilitySummaryByFacilitySP(facilities, month=2, year=2012)
+        data = dict((d["product"].sms_code, d) for d in summary.data)
+        for product in (self.pr, self.other):
+            stock = self.sp.historical_stock(product, 2012, 2, default_value=-1)
+            self.assertEqual((1, int(stock > 0), int(stock == 0), int(stock < 0)),
+                             tuple(data[product.sms_code][k] for k in
+                                   ("total", "with_stock", "without_stock", "without_data")))
+
+    def tearDown(self):
+        Location.objects.all().delete()
+        SupplyPoint.objects.all().delete()
+        Product.objects.all().delete()
+        ProductStock.objects.all().delete()
+        StockTransaction.objects.all().delete()
+        ProductReport.objects.all().delete()
+        TestScript.tearDown(self)
@@ -0,0 +1,99 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rapidsms.tests.scripted import TestScript
+from logistics.models import Location, SupplyPoint, Product, ProductStock, ProductType, \
+    StockTransaction, ProductReport, ProductReportType, HistoricalStockCache, \
+    ProductReportBatch, ProductReportsHelper
+from logistics.signals import stockout_reported, stockout_resolved
+from logistics.tests.util import load_test_data
+from logistics.const import Reports
+
+
+class TestProductReportBatch(TestScript):
+
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.one_by_one = SupplyPoint.objects.get(code='dedh')
+        self.batched = SupplyPoint.objects.get(code='garms')
+        self.ov = Product.objects.get(sms_code='ov')
+        self.ml = Product.objects.get(sms_code='ml')
+        self.cd = Product.objects.create(sms_code='cd', name='Condom', units='each',
+                                         type=ProductType.objects.get(code='fp'),
+                                         average_monthly_consumption=10)
+        for product in (self.ov, self.ml):
+            ProductStock.objects.get_or_create(product=product, supply_point=self.batched,
+                                               use_auto_consumption=False)
+        for sp in (self.one_by_one, self.batched):
+            sp.report_stock(self.ov, 5)
+            sp.report_stock(self.ml, 8)
+        self.date = datetime(2012, 3, 5)
+        self.reports = [(self.ov, Reports.REC, 10), (self.ov, Reports.SOH, 12),
+                        (self.ml, Reports.SOH, 0), (self.cd, Reports.SOH, 3),
+                        (self.ml, Reports.GIVE, 2)]
+
+    def _state(self, sp):
+        return (
+            sorted(ProductStock.objects.filter(supply_point=sp)
+                   .values_list('product__sms_code', 'quantity', 'is_active', 'stock_status',
+                                'cached_reorder_level', 'auto_monthly_consumption')),
+            list(StockTransaction.objects.filter(supply_point=sp, date=self.date).order_by('pk')
+                 .values_list('product__sms_code', 'quantity', 'beginning_balance',
+                              'ending_balance', 'date', 'product_report__quantity',
+                              'product_report__report_type__code')),
+            sorted(HistoricalStockCache.objects.filter(supply_point=sp)
+                   .values_list('product__sms_code', 'year', 'month', 'stock')),
+        )
+
+    def _report_one_by_one(self):
+        for product, code, quantity in self.reports:
+            self.one_by_one.report(product, ProductReportType.objects.get(code=code),
+                                   quantity, date=self.date)
+
+    def _report_batched(self):
+        batch = ProductReportBatch(self.batched, date=self.date)
+        for product, code, quantity in self.reports:
+            batch.report(product, code, quantity)
+        batch.save()
+
+    def testSameAsOneByOne(self):
+        with CaptureQueriesContext(connection) as one_by_one:
+            self._report_one_by_one()
+        with CaptureQueriesContext(connection) as batched:
+            self._report_batched()
+        self.assertEqual(self._state(self.one_by_one), self._state(self.batched))
+        self.assertEqual(5, ProductReport.objects.filter(supply_point=self.batched,
+                                                         report_date=self.date).count())
+        self.assertIsNotNone(SupplyPoint.objects.get(pk=self.batched.pk).last_reported)
+        self.assertLess(len(batched), len(one_by_one) / 2)
+
+    def testHelperStockouts(self):
+        received = {}
+        def _record(signal):
+            def _receiver(sender, products, **kwargs):
+                received[signal] = sorted(p.sms_code for p in products)
+            return _receiver
+        reported, resolved = _record('reported'), _record('resolved')
+        stockout_reported.connect(reported)
+        stockout_resolved.connect(resolved)
+        try:
+            self.batched.report_stock(self.cd, 0)
+            helper = ProductReportsHelper(self.batched, Reports.SOH)
+            helper.newparse("ov 0 ml 3 cd 4")
+            helper.save()
+        finally:
+            stockout_reported.disconnect(reported)
+            stockout_resolved.disconnect(resolved)
+        self.assertEqual({'reported': ['ov'], 'resolved': ['cd']}, received)
+        self.assertEqual(3, self.batched.stock(self.ml))
+
+    def tearDown(self):
+        Location.objects.all().delete()
+        SupplyPoint.objects.all().delete()
+        Product.objects.all().delete()
+        ProductStock.objects.all().delete()
+        StockTransaction.objects.all().delete()
+        ProductReport.objects.all().delete()
+        TestScript.tearDown(self)
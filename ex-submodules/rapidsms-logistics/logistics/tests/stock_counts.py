@@ -0,0 +1,109 @@
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.test.utils import override_settings
+from rapidsms.tests.scripted import TestScript
+from logistics.models import Location, SupplyPoint, Product, ProductStock, \
+    StockTransaction, ProductReport
+from logistics.tests.util import load_test_data, fake_report
+from logistics.const import Reports
+from logistics_project.utils.dates import DateSpan
+
+COUNTS = ['stockout_count', 'emergency_stock_count', 'low_stock_count', 'emergency_plus_low',
+          'good_supply_count', 'adequate_supply_count', 'overstocked_count', 'other_count']
+
+
+class TestStockCounts(TestScript):
+    """
+    The stock counts are taken in the database, so check them against
+    the checks on the stocks themselves.
+    """
+
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        cache.clear()
+        self.sp = SupplyPoint.objects.all()[0]
+        self.ov = Product.objects.get(sms_code='ov')
+        self.ml = Product.objects.get(sms_code='ml')
+        ml_stock = ProductStock.objects.get(supply_point=self.sp, product=self.ml)
+        ml_stock.use_auto_consumption = True
+        ml_stock.save()
+        Product.objects.filter(pk=self.ml.pk).update(average_monthly_consumption=None)
+
+    def _expected(self, quantities):
+        expected = dict((name, 0) for name in COUNTS)
+        for stock in ProductStock.objects.filter(supply_point=self.sp):
+            quantity = quantities.get(stock.product_id, stock.quantity)
+            levels = stock.stock_levels()
+            expected['stockout_count'] += quantity == 0
+            expected['emergency_stock_count'] += levels.is_below_emergency_level(quantity)
+            expected['low_stock_count'] += levels.is_below_low_supply_but_above_emergency_level(quantity)
+            expected['emergency_plus_low'] += levels.is_below_low_supply(quantity)
+            expected['good_supply_count'] += levels.is_in_good_supply(quantity)
+            expected['adequate_supply_count'] += levels.is_in_adequate_supply(quantity)
+            expected['overstocked_count'] += levels.is_overstocked(quantity)
+            expected['other_count'] += levels.is_other(quantity)
+        return expected
+
+    def _counts(self, datespan=None):
+        cache.clear()
+        return dict((name, getattr(self.sp, name)(datespan=datespan)) for name in COUNTS)
+
+    def testCurrentCounts(self):
+        fake_report(self.sp, self.ml, 40, 0, Reports.SOH)
+        for quantity in range(0, 20):
+            fake_report(self.sp, self.ov, quantity, 0, Reports.SOH)
+            self.assertEqual(self._expected({}), self._counts())
+
+    def testMissingLevelsAreFilledIn(self):
+        fake_report(self.sp, self.ov, 1, 0, Reports.SOH)
+        fake_report(self.sp, self.ml, 40, 0, Reports.SOH)
+        ProductStock.objects.update(stock_status=None, cached_emergency_level=None,
+                                    cached_reorder_level=None, cached_maximum_level=None)
+        self.assertEqual(self._expected({}), self._counts())
+        self.assertEqual(1, self.sp.emergency_plus_low())
+
+    @override_settings(LOGISTICS_USE_STATIC_EMERGENCY_LEVELS=True,
+                       LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY=False)
+    def testStaticEmergencyLevelWithoutPolicy(self):
+        # there's no stock level policy configured for the tests
+        Product.objects.filter(pk=self.ov.pk).update(emergency_order_level=7)
+        stock = ProductStock.objects.get(supply_point=self.sp, product=self.ov)
+        self.assertIsNotNone(stock.monthly_consumption)
+        stock.save()
+        stock.refresh_from_db()
+        self.assertEqual((7, None), (stock.cached_emergency_level, stock.cached_reorder_level))
+
+    def testProductChangesRefreshLevels(self):
+        fake_report(self.sp, self.ov, 10, 0, Reports.SOH)
+        fake_report(self.sp, self.ml, 40, 0, Reports.SOH)
+        for amc in [5, 10, 100]:
+            ov = Product.objects.get(pk=self.ov.pk)
+            ov.average_monthly_consumption = amc
+            ov.save()
+            stock = ProductStock.objects.get(supply_point=self.sp, product=self.ov)
+            self.assertEqual(amc, stock.cached_monthly_consumption)
+            self.assertEqual(stock.stock_levels().status(stock.quantity), stock.stock_status)
+            self.assertEqual(self._expected({}), self._counts())
+
+    def testHistoricalCounts(self):
+        fake_report(self.sp, self.ov, 100, 60, Reports.SOH)
+        fake_report(self.sp, self.ov, 5, 45, Reports.SOH)
+        fake_report(self.sp, self.ov, 0, 30, Reports.SOH)
+        fake_report(self.sp, self.ml, 40, 0, Reports.SOH)
+        now = datetime.utcnow()
+        for days_ago, ov_quantity in [(55, 100), (40, 5), (20, 0)]:
+            end = now - timedelta(days=days_ago)
+            datespan = DateSpan(end - timedelta(days=30), end)
+            # ml has no transactions yet, so it keeps its current quantity
+            self.assertEqual(self._expected({self.ov.pk: ov_quantity}), self._counts(datespan))
+
+    def tearDown(self):
+        Location.objects.all().delete()
+        SupplyPoint.objects.all().delete()
+        Product.objects.all().delete()
+        ProductStock.objects.all().delete()
+        StockTransaction.objects.all().delete()
+        ProductReport.objects.all().delete()
+        TestScript.tearDown(self)
@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+from django.test.utils import override_settings
+from rapidsms.tests.scripted import TestScript
+from logistics.models import Location, SupplyPoint, Product, ProductStock, \
+    StockTransaction, ProductReport, ProductReportsHelper, StockRequest, StockRequestStatus
+from logistics.tests.util import load_test_data
+from logistics.const import Reports
+
+
+class TestStockRequests(TestScript):
+
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.ov = Product.objects.get(sms_code='ov')
+        self.ml = Product.objects.get(sms_code='ml')
+
+    def _report(self, report_type, text):
+        helper = ProductReportsHelper(self.sp, report_type)
+        helper.newparse(text)
+        helper.save()
+        return helper
+
+    def _status(self):
+        return sorted(StockRequest.objects.filter(supply_point=self.sp)
+                      .values_list('product__sms_code', 'status', 'amount_requested', 'amount_received'))
+
+    @override_settings(LOGISTICS_USE_BACKORDERS=True)
+    def testLatestRequestTrumps(self):
+        first = StockRequest.create_from_report(self._report(Reports.SOH, "ov 1 ml 2"), None)
+        self.assertEqual(2, len(first))
+        self.assertTrue(all(r.pk for r in first))
+
+        second = StockRequest.create_from_report(self._report(Reports.SOH, "ov 3"), None)
+        self.assertEqual([self.ov], [r.product for r in second])
+        canceled = StockRequest.objects.get(status=StockRequestStatus.CANCELED)
+        self.assertEqual((self.ov, second[0], 0),
+                         (canceled.product, canceled.canceled_for, canceled.amount_received))
+        self.assertEqual(2, StockRequest.pending_requests().filter(supply_point=self.sp).count())
+
+    @override_settings(LOGISTICS_USE_BACKORDERS=False)
+    def testNoBackorders(self):
+        StockRequest.create_from_report(self._report(Reports.SOH, "ov 1 ml 2"), None)
+        # without back orders the new report closes the pending ml request too
+        StockRequest.create_from_report(self._report(Reports.SOH, "ov 3"), None)
+        self.assertEqual([('ml', StockRequestStatus.CANCELED, 8, 0),
+                          ('ov', StockRequestStatus.CANCELED, 9, 0),
+                          ('ov', StockRequestStatus.REQUESTED, 7, None)], self._status())
+
+        StockRequest.close_pending_from_receipt_report(self._report(Reports.REC, "ov 10"), None)
+        self.assertEqual([('ml', StockRequestStatus.CANCELED, 8, 0),
+                          ('ov', StockRequestStatus.CANCELED, 9, 0),
+                          ('ov', StockRequestStatus.RECEIVED, 7, 10)], self._status())
+
+    def tearDown(self):
+        Location.objects.all().delete()
+        SupplyPoint.objects.all().delete()
+        Product.objects.all().delete()
+        ProductStock.objects.all().delete()
+        StockTransaction.objects.all().delete()
+        ProductReport.objects.all().delete()
+        TestScript.tearDown(self)
@@ -1,11 +1,36 @@
 from __future__ import unicode_literals
 from builtins import object
-from django.db import models
-from datetime import datetime
+from django.db import models, transaction
+from datetime import datetime, timedelta
+
+def _first_of_month(date):
+    return datetime(date.year, date.month, 1)
+
+
+def _first_of_next_month(year, month):
+    return datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def _latest_by_pair(rows):
+    """
+    The first value seen for every (supply point, product) pair, from rows
+    of (supply point id, product id, value) ordered newest first.
+    """
+    latest = {}
+    for supply_point_id, product_id, value in rows:
+        latest.setdefault((supply_point_id, product_id), value)
+    return latest
+
 
 class HistoricalStockCache(models.Model):
     """
     A simple class to cache historical stock levels by month/year per product/facility
+
+    There is a row for every month a supply point had a transaction for a
+    product, with the balance at the end of that month. The stock at the
+    end of any month is the one in the latest row up to that month. The
+    rows are kept up to date as transactions are saved and deleted (see
+    logistics.signals.update_historical_stock_cache).
     """        
     supply_point = models.ForeignKey('logistics.SupplyPoint', on_delete=models.CASCADE)
     product = models.ForeignKey('logistics.Product', on_delete=models.CASCADE,  null=True)
@@ -13,6 +38,136 @@ class HistoricalStockCache(models.Model):
     month = models.PositiveIntegerField()
     stock = models.IntegerField(null=True)
 
+    class Meta(object):
+        index_together = (('supply_point', 'product', 'year', 'month'),)
+
+    @classmethod
+    def update_month(cls, supply_point_id, product_id, year, month, create=True):
+        """
+        Set the month end stock of a supply point and product from its
+        transactions in that month, removing the row if there are none.
+        """
+        from logistics.models import StockTransaction
+        start = datetime(year, month, 1)
+        last = StockTransaction.objects.filter(
+            supply_point=supply_point_id, product=product_id,
+            date__gte=start, date__lt=_first_of_next_month(year, month),
+        ).order_by('-date', '-pk').values_list('ending_balance', flat=True).first()
+        rows = cls.objects.filter(supply_point=supply_point_id, product=product_id,
+                                  year=year, month=month)
+        if last is None:
+            rows.delete()
+        elif not rows.update(stock=last) and create:
+            cls.objects.create(supply_point_id=supply_point_id, product_id=product_id,
+                               year=year, month=month, stock=last)
+
+    @classmethod
+    def update_months(cls, keys):
+        """
+        update_month for many (supply point id, product id, year, month)
+        keys at once, e.g. after a batch of transactions was saved in bulk.
+        """
+        from logistics.models import StockTransaction
+        keys = set(keys)
+        if not keys:
+            return
+        supply_point_ids = set(k[0] for k in keys)
+        product_ids = set(k[1] for k in keys)
+        months = set((k[2], k[3]) for k in keys)
+        rows = StockTransaction.objects.filter(
+            supply_point__in=supply_point_ids, product__in=product_ids,
+            date__gte=datetime(*min(months) + (1,)),
+            date__lt=_first_of_next_month(*max(months)),
+        ).order_by('-date', '-pk').values_list('supply_point', 'product', 'date', 'ending_balance')
+        last = {}
+        for supply_point_id, product_id, date, ending_balance in rows:
+            last.setdefault((supply_point_id, product_id, date.year, date.month), ending_balance)
+
+        existing = {}
+        for row in cls.objects.filter(supply_point__in=supply_point_ids, product__in=product_ids,
+                                      year__in=set(m[0] for m in months),
+                                      month__in=set(m[1] for m in months)):
+            existing.setdefault((row.supply_point_id, row.product_id, row.year, row.month), []).append(row)
+
+        updated, created, removed = [], [], []
+        for key in keys:
+            stock = last.get(key)
+            rows = existing.get(key, [])
+            if stock is None:
+                removed.extend(row.pk for row in rows)
+            elif rows:
+                for row in rows:
+                    row.stock = stock
+                updated.extend(rows)
+            else:
+                supply_point_id, product_id, year, month = key
+                created.append(cls(supply_point_id=supply_point_id, product_id=product_id,
+                                   year=year, month=month, stock=stock))
+        if removed:
+            cls.objects.filter(pk__in=removed).delete()
+        cls.objects.bulk_update(updated, ['stock'], batch_size=500)
+        cls.objects.bulk_create(created, batch_size=500)
+
+    @classmethod
+    def rebuild(cls, supply_points):
+        """
+        Rebuild all the rows of the supply points from their transactions.
+        """
+        from logistics.models import StockTransaction
+        for supply_point in supply_points:
+            rows = StockTransaction.objects.filter(supply_point=supply_point)\
+                .order_by('product', '-date', '-pk')\
+                .values_list('product', 'date', 'ending_balance')
+            month_ends = {}
+            for product_id, date, ending_balance in rows.iterator():
+                month_ends.setdefault((product_id, date.year, date.month), ending_balance)
+            with transaction.atomic():
+                cls.objects.filter(supply_point=supply_point).delete()
+                cls.objects.bulk_create([
+                    cls(supply_point=supply_point, product_id=product_id,
+                        year=year, month=month, stock=stock)
+                    for (product_id, year, month), stock in month_ends.items()
+                ], batch_size=500)
+
+    @classmethod
+    def stock_at_month_end(cls, supply_point_ids, product_ids, year, month):
+        """
+        The stock at the end of a month for every supply point and product
+        that had a transaction by then, as {(supply point id, product id): stock}
+        in a single query.
+        """
+        rows = cls.objects.filter(
+            supply_point__in=supply_point_ids, product__in=product_ids,
+        ).filter(
+            models.Q(year__lt=year) | models.Q(year=year, month__lte=month)
+        ).order_by('supply_point', 'product', '-year', '-month')\
+            .values_list('supply_point', 'product', 'stock')
+        return _latest_by_pair(rows)
+
+    @classmethod
+    def stock_as_of(cls, supply_point_ids, product_ids, cutoff, inclusive=False):
+        """
+        The last balance before the cutoff (or up to it, if inclusive) for
+        every supply point and product that had a transaction by then. This
+        is the month end stock of the month before, plus any transactions
+        from the start of the cutoff's month.
+        """
+        from logistics.models import StockTransaction
+        month_start = _first_of_month(cutoff)
+        previous_month = month_start - timedelta(days=1)
+        stock = cls.stock_at_month_end(supply_point_ids, product_ids,
+                                       previous_month.year, previous_month.month)
+        if inclusive or cutoff > month_start:
+            rows = StockTransaction.objects.filter(
+                supply_point__in=supply_point_ids, product__in=product_ids,
+                date__gte=month_start,
+            ).filter(
+                **{'date__lte' if inclusive else 'date__lt': cutoff}
+            ).order_by('supply_point', 'product', '-date', '-pk')\
+                .values_list('supply_point', 'product', 'ending_balance')
+            stock.update(_latest_by_pair(rows))
+        return stock
+
 class BaseReportingModel(models.Model):
     """
     A model to encapsulate aggregate (data warehouse) data used by a report.
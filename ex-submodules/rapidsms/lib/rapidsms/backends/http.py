@@ -6,9 +6,16 @@ available backends, like so:
                 "port": 8888,
                 "gateway_url": "http://www.smsgateway.com",
                 "params_outgoing": "user=my_username&password=my_password&id=%(phone_number)s&text=%(message)s",
-                "params_incoming": "id=%(phone_number)s&text=%(message)s"
+                "params_incoming": "id=%(phone_number)s&text=%(message)s",
+                "send_workers": 4,
         }
 
+With send_workers, outgoing messages are queued and sent in the background
+by that many threads over keep-alive connections (see sendqueue.py), and
+send returns as soon as the message is queued. Failed requests are retried
+send_retries times, backing off from send_backoff seconds. Without it,
+messages are sent one at a time on the thread calling send.
+
 """
 from __future__ import absolute_import
 from __future__ import unicode_literals
@@ -30,6 +37,7 @@ from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler
 
 from rapidsms.log.mixin import LoggerMixin
 from rapidsms.backends.base import BackendBase
+from rapidsms.backends.sendqueue import SendQueue, GatewayError
 
 
 class RapidWSGIHandler(WSGIHandler, LoggerMixin):
@@ -75,7 +83,8 @@ class RapidHttpBackend(BackendBase):
     def configure(self, host="localhost", port=8080, 
                   gateway_url="http://smsgateway.com", 
                   params_outgoing="user=my_username&password=my_password&id=%(phone_number)s&text=%(message)s", 
-                  params_incoming="id=%(phone_number)s&text=%(message)s"):
+                  params_incoming="id=%(phone_number)s&text=%(message)s",
+                  send_workers=0, send_retries=3, send_backoff=1, send_timeout=30):
         self.host = host
         self.port = port
         self.handler = RapidWSGIHandler()
@@ -93,6 +102,20 @@ class RapidHttpBackend(BackendBase):
             elif val == "%(message)s":
                 self.incoming_message_param = key
 
+        self.send_queue = None
+        if send_workers:
+            self.send_queue = SendQueue(self, workers=send_workers, retries=send_retries,
+                                        backoff=send_backoff, timeout=send_timeout)
+
+    def start(self):
+        if self.send_queue is not None:
+            self.send_queue.start()
+        try:
+            super(RapidHttpBackend, self).start()
+        finally:
+            if self.send_queue is not None:
+                self.send_queue.stop()
+
     def run(self):
         server_address = (self.host, int(self.port))
         self.info('Starting HTTP server on {0}:{1}'.format(*server_address))
@@ -123,8 +146,10 @@ class RapidHttpBackend(BackendBase):
         self.route(msg)
         return HttpResponse('OK') 
     
-    def send(self, message):
-        self.info('Sending message: %s' % message)
+    def send_url(self, message):
+        """
+        The gateway url that sends this message.
+        """
         text = message.text
         if isinstance(text, str):
             text = text.encode('utf-8')
@@ -133,7 +158,33 @@ class RapidHttpBackend(BackendBase):
         http_params_outgoing = self.http_params_outgoing.replace('%(message)s', urllib.parse.quote(text))
         http_params_outgoing = http_params_outgoing.replace('%(phone_number)s',
                                                             urllib.parse.quote(message.connection.identity))
-        url = "%s?%s" % (self.gateway_url, http_params_outgoing)
+        return "%s?%s" % (self.gateway_url, http_params_outgoing)
+
+    def check_response(self, status, body):
+        """
+        Raise GatewayError if the gateway didn't accept the message.
+        """
+        if status >= 400:
+            raise GatewayError(status, body)
+
+    def metrics(self):
+        """
+        The delivery counts and timings of the send queue, if there is one.
+        """
+        if self.send_queue is None:
+            return None
+        metrics = self.send_queue.stats.summary()
+        metrics["workers"] = self.send_queue.workers
+        metrics["queue_depths"] = self.send_queue.depths()
+        return metrics
+
+    def send(self, message):
+        self.info('Sending message: %s' % message)
+        if self.send_queue is not None and self.send_queue.running:
+            # sent_at is set again by the worker once it's delivered
+            self.send_queue.put(message)
+            return True
+        url = self.send_url(message)
         try:
             self.debug('Sending: %s' % url)
             with urllib.request.urlopen(url) as response:
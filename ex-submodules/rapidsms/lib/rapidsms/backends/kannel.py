@@ -15,6 +15,7 @@ INSTALLED_BACKENDS.update({
         "coding": 0,
         "charset": "ascii",
         "encode_errors": "ignore", # strip out unknown (unicode) characters
+        "send_workers": 4, # send from a queue in the background, see http.py
     }
 })
     
@@ -55,7 +56,6 @@ standard_library.install_aliases()
 from builtins import str
 import copy
 import urllib.request, urllib.parse, urllib.error
-from urllib.request import urlopen
 
 from datetime import datetime
 
@@ -104,21 +104,11 @@ class KannelBackend(RapidHttpBackend):
         self.route(msg)
         return HttpResponse('') # any response would get sent to the user
 
-    def send(self, message):
-        self.info('Sending message: %s' % message)
+    def send_url(self, message):
         url_args = copy.copy(self.sendsms_params)
         url_args['to'] = message.connection.identity
         url_args['text'] = message.text.encode(self.charset,
                                                self.encode_errors)
         url_args['coding'] = self.coding
         url_args['charset'] = self.charset
-        url = '?'.join([self.sendsms_url, urllib.parse.urlencode(url_args)])
-        try:
-            self.debug('Opening URL: %s' % url)
-            with urlopen(url) as response:
-                self.info('SENT')
-                self.debug('response body: %s' % response.read())
-                return True
-        except Exception:
-            self.exception('Failed to send message')
-            return
+        return '?'.join([self.sendsms_url, urllib.parse.urlencode(url_args)])
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+An outbound queue for HTTP backends, so that sending a message doesn't
+block the thread that sent it (usually the router's) on the gateway.
+
+Messages are sharded over a pool of worker threads by recipient, so the
+messages to one phone are still sent in order. Each worker keeps its own
+keep-alive connection to the gateway, and retries failed requests with
+an exponential backoff.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object, range
+from datetime import datetime
+import http.client
+import queue
+import threading
+import time
+import urllib.parse
+import zlib
+
+
+class GatewayError(Exception):
+    """
+    The gateway answered with an error status.
+    """
+
+    def __init__(self, status, body):
+        super(GatewayError, self).__init__("Gateway returned %s: %s" % (status, body))
+        self.status = status
+        self.body = body
+
+    @property
+    def retryable(self):
+        # client errors (bad credentials, bad number) won't go away by
+        # sending the same request again
+        return not 400 <= self.status < 500
+
+
+class KeepAliveClient(object):
+    """
+    Makes GET requests over persistent connections, one per host. Not
+    thread safe: each thread should have its own client.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._connections = {}
+
+    def _connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self._connections:
+            cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            self._connections[key] = cls(netloc, timeout=self.timeout)
+        return self._connections[key]
+
+    def get(self, url):
+        """
+        GET the url, returning the (status, body) of the response.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        conn = self._connection(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            body = response.read()
+        except Exception:
+            # the connection may be half-used; start afresh next time
+            self.close(parts.scheme, parts.netloc)
+            raise
+        if response.will_close:
+            self.close(parts.scheme, parts.netloc)
+        return response.status, body
+
+    def close(self, scheme=None, netloc=None):
+        keys = [(scheme, netloc)] if scheme else list(self._connections)
+        for key in keys:
+            conn = self._connections.pop(key, None)
+            if conn is not None:
+                conn.close()
+
+
+class SendStats(object):
+    """
+    Delivery counts and timings for a SendQueue.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.queued = 0
+            self.sent = 0
+            self.failed = 0
+            self.retries = 0
+            self.wait = {"count": 0, "total": 0.0, "max": 0.0}
+            self.request = {"count": 0, "total": 0.0, "max": 0.0}
+
+    @staticmethod
+    def _add(timing, secs):
+        timing["count"] += 1
+        timing["total"] += secs
+        timing["max"] = max(timing["max"], secs)
+
+    def record_queued(self):
+        with self._lock:
+            self.queued += 1
+
+    def record_request(self, secs):
+        with self._lock:
+            self._add(self.request, secs)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_done(self, sent, wait):
+        with self._lock:
+            if sent:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._add(self.wait, wait)
+
+    def summary(self):
+        """
+        A copy of the counts and timings, with the mean of each timing added.
+        """
+        def _summary(timing):
+            timing = dict(timing)
+            timing["mean"] = timing["total"] / timing["count"] if timing["count"] else 0.0
+            return timing
+
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "wait": _summary(self.wait),
+                "request": _summary(self.request),
+            }
+
+
+class SendQueue(object):
+    """
+    Sends the messages handed to SendQueue.put from a pool of workers.
+
+    The backend builds the request for each message (send_url) and
+    decides what to do with the response (check_response); the queue
+    does the sending, retrying up to *retries* more times, waiting
+    *backoff*, 2 * *backoff*, 4 * *backoff*, ... seconds in between.
+    """
+
+    def __init__(self, backend, workers=4, retries=3, backoff=1, timeout=30):
+        self.backend = backend
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stats = SendStats()
+        self._queues = []
+        self._threads = []
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self):
+        self._stopping.clear()
+        self._queues = [queue.Queue() for n in range(self.workers)]
+        self._threads = []
+        for n, worker_queue in enumerate(self._queues):
+            worker = threading.Thread(
+                name="%s-sender-%s" % (self.backend._logger_name(), n),
+                target=self._work,
+                args=(worker_queue,))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self, drain=True):
+        """
+        Stop the workers. With *drain*, they first send everything that is
+        already queued; otherwise they stop after the message in hand, and
+        don't wait to retry it.
+        """
+        if not drain:
+            self._stopping.set()
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for worker in self._threads:
+            worker.join()
+        self._queues = []
+        self._threads = []
+
+    def join(self):
+        """
+        Block until every message queued so far has been sent or given up on.
+        """
+        for worker_queue in list(self._queues):
+            worker_queue.join()
+
+    def _shard(self, message):
+        connection = message.connection
+        key = "%s/%s" % (getattr(connection, "backend_id", None),
+                         getattr(connection, "identity", connection))
+        return zlib.crc32(key.encode("utf-8")) % self.workers
+
+    def put(self, message):
+        self.stats.record_queued()
+        self._queues[self._shard(message)].put((time.time(), message))
+
+    def depths(self):
+        return [q.qsize() for q in self._queues]
+
+    def _work(self, worker_queue):
+        client = KeepAliveClient(self.timeout)
+        try:
+            while True:
+                item = worker_queue.get()
+                try:
+                    if item is None:
+                        break
+                    queued_at, message = item
+                    sent = self._deliver(client, message)
+                    if sent:
+                        message.sent = True
+                        message.sent_at = datetime.now()
+                    self.stats.record_done(sent, time.time() - queued_at)
+                except Exception:
+                    self.backend.exception("Error sending message")
+                finally:
+                    worker_queue.task_done()
+        finally:
+            client.close()
+
+    def _deliver(self, client, message):
+        url = self.backend.send_url(message)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats.record_retry()
+                if self._stopping.wait(self.backoff * 2 ** (attempt - 1)):
+                    break
+            started = time.time()
+            try:
+                status, body = client.get(url)
+                self.backend.check_response(status, body)
+                self.backend.debug("SENT %s" % message)
+                return True
+            except GatewayError as e:
+                self.backend.warning("Sending %s failed: %s" % (message, e))
+                if not e.retryable:
+                    break
+            except Exception as e:
+                self.backend.warning("Sending %s failed: %s" % (message, e))
+            finally:
+                self.stats.record_request(time.time() - started)
+        self.backend.error("Giving up on sending %s" % message)
+        return False
@@ -5,6 +5,7 @@
 from __future__ import unicode_literals
 from rapidsms.apps.base import AppBase
 from .utils import get_handlers
+from .dispatch import DispatchIndex
 
 
 class App(AppBase):
@@ -14,6 +15,7 @@ class App(AppBase):
         """
 
         self.handlers = get_handlers()
+        self.index = DispatchIndex(self.handlers)
 
         if len(self.handlers):
             class_names = [cls.__name__ for cls in self.handlers]
@@ -21,14 +23,14 @@ class App(AppBase):
 
     def handle(self, msg):
         """
-        Forwards the *msg* to every handler, and short-circuits the
-        phase if any of them accept it. The first to accept it will
-        block the others, and there's deliberately no way to predict
-        the order that they're called in. (This is intended to force
-        handlers to be as reluctant as possible.)
+        Forwards the *msg* to every handler that could accept it (see
+        DispatchIndex), and short-circuits the phase if any of them
+        do. The first to accept it will block the others. Handlers
+        should still be as reluctant as possible, rather than relying
+        on the order that they're called in.
         """
 
-        for handler in self.handlers:
+        for handler in self.index.candidates(msg.text):
             if handler.dispatch(self.router, msg):
                 self.info("Incoming message handled by %s" % handler.__name__)
                 return True
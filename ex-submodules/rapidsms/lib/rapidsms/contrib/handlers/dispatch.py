@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+
+from __future__ import unicode_literals
+from builtins import object
+import re
+from .handlers.keyword import KeywordHandler
+
+
+LEADING_WORD = re.compile(r"^\s*([^\s,;:]*)", re.UNICODE)
+
+
+def _uses_keyword_dispatch(handler):
+    return issubclass(handler, KeywordHandler) and \
+        getattr(handler.dispatch, "__func__", None) is KeywordHandler.dispatch.__func__
+
+
+class DispatchIndex(object):
+    """
+    Narrows down the handlers that could accept a message, so that only
+    those need to be dispatched to. The candidates for a message are
+    always returned in the order the handlers were registered in.
+
+    Keyword handlers with plain keywords (see
+    KeywordHandler.literal_keywords) are indexed by each of their words,
+    and are only candidates for messages that start with one of them.
+    Other keyword handlers are screened with a single regular expression
+    combining all of their keywords. Any other handler, including keyword
+    handlers with their own dispatch, is a candidate for every message.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self.by_keyword = {}
+        self.patterned = []
+        self.always = []
+
+        for position, handler in enumerate(self.handlers):
+            entry = (position, handler)
+            if not _uses_keyword_dispatch(handler) or not hasattr(handler, "keyword"):
+                self.always.append(entry)
+                continue
+
+            words = handler.literal_keywords()
+            if words is None:
+                self.patterned.append(entry)
+                continue
+
+            for word in words:
+                entries = self.by_keyword.setdefault(word, [])
+                if entry not in entries:
+                    entries.append(entry)
+
+        self.pattern = None
+        if self.patterned:
+            # matches whenever any of the handlers' own keyword patterns
+            # would, since those also need a separator or the end of the
+            # message after the keyword.
+            try:
+                self.pattern = re.compile(
+                    r"^\s*(?:%s)(?:[\s,;:]|$)" %
+                        "|".join("(?:%s)" % handler.keyword
+                                 for position, handler in self.patterned),
+                    re.IGNORECASE)
+            except re.error:
+                self.always.extend(self.patterned)
+                self.always.sort(key=lambda entry: entry[0])
+                self.patterned = []
+
+    def candidates(self, text):
+        """
+        The handlers that might accept a message with this text.
+        """
+        text = text or ""
+        word = LEADING_WORD.match(text).group(1).lower()
+        entries = list(self.by_keyword.get(word, []))
+        if self.pattern is not None and self.pattern.match(text):
+            entries.extend(self.patterned)
+        entries.extend(self.always)
+        return [handler for position, handler in sorted(entries, key=lambda entry: entry[0])]
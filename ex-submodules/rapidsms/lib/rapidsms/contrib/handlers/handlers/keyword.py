@@ -9,6 +9,9 @@ from django.core.exceptions import ObjectDoesNotExist
 from .base import BaseHandler
 
 
+LITERAL_KEYWORDS = re.compile(r"^\w+(?:\|\w+)*$", re.UNICODE)
+
+
 class KeywordHandler(BaseHandler):
 
     """
@@ -44,8 +47,25 @@ class KeywordHandler(BaseHandler):
     @classmethod
     def _keyword(cls):
         if hasattr(cls, "keyword"):
-            prefix = r"^\s*(?:%s)(?:[\s,;:]+(.+))?$" % (cls.keyword)
-            return re.compile(prefix, re.IGNORECASE)
+            # compile once per class (and keyword), not for every message
+            compiled = cls.__dict__.get("_compiled_keyword")
+            if compiled is None or compiled[0] != cls.keyword:
+                prefix = r"^\s*(?:%s)(?:[\s,;:]+(.+))?$" % (cls.keyword)
+                compiled = (cls.keyword, re.compile(prefix, re.IGNORECASE))
+                cls._compiled_keyword = compiled
+            return compiled[1]
+
+    @classmethod
+    def literal_keywords(cls):
+        """
+        The (lowercased) words this handler answers to, if its keyword is
+        a plain word or an alternation of them (like "soh|rec"), or None
+        if it is any other regular expression.
+        """
+        keyword = getattr(cls, "keyword", None)
+        if keyword is None or not LITERAL_KEYWORDS.match(keyword):
+            return None
+        return [word.lower() for word in keyword.split("|")]
 
     @classmethod
     def dispatch(cls, router, msg):
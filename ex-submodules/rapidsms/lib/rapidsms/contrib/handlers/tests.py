@@ -47,3 +47,50 @@ class HandlerTest(TestCase):
         # always restore pre-test settings.
         finally:
             settings.INSTALLED_APPS, settings.INSTALLED_HANDLERS, settings.EXCLUDED_HANDLERS = _settings
+
+
+class DispatchIndexTest(TestCase):
+
+    def test_candidates(self):
+        from .dispatch import DispatchIndex
+        from .handlers.base import BaseHandler
+        from .handlers.keyword import KeywordHandler
+        from .handlers.pattern import PatternHandler
+
+        class StockHandler(KeywordHandler):
+            keyword = "soh|stock"
+
+        class ReceiptHandler(KeywordHandler):
+            keyword = "rec|receipts"
+
+        class CodeHandler(KeywordHandler):
+            keyword = r"c\d+"
+
+        class CustomHandler(KeywordHandler):
+            keyword = "soh"
+
+            @classmethod
+            def dispatch(cls, router, msg):
+                return False
+
+        class SumHandler(PatternHandler):
+            pattern = r"^(\d+) plus (\d+)$"
+
+        class AnyHandler(BaseHandler):
+            pass
+
+        handlers = [StockHandler, CodeHandler, ReceiptHandler, CustomHandler, SumHandler, AnyHandler]
+        index = DispatchIndex(handlers)
+        always = [CustomHandler, SumHandler, AnyHandler]
+
+        self.assertEqual(index.candidates("soh zi 10"), [StockHandler] + always)
+        self.assertEqual(index.candidates("  STOCK, zi 10"), [StockHandler] + always)
+        self.assertEqual(index.candidates("receipts"), [ReceiptHandler] + always)
+        self.assertEqual(index.candidates("c12 hello"), [CodeHandler] + always)
+        self.assertEqual(index.candidates("sohzi 10"), always)
+        self.assertEqual(index.candidates(""), always)
+
+        # every handler whose own keyword matches must be a candidate
+        for text in ["soh", "soh:zi", "rec\nzi 10", "c1", "C2;x", "cx", "stockout", "1 plus 2"]:
+            expected = [h for h in handlers if h in always or h._keyword().match(text)]
+            self.assertEqual([h for h in index.candidates(text) if h in expected], expected)
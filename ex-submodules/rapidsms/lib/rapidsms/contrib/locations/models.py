@@ -4,9 +4,11 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_save
 from django.utils.html import escape
 import uuid
 
+from logistics.closure import Closure
 from logistics.mixin import StockCacheMixin
 
 
@@ -118,17 +120,13 @@ class Location(models.Model, StockCacheMixin):
         """ This signature gets overriden by mptt when mptt is used
         It must return a queryset
         """
-        def _get_descendent_pks(node):
-            pks = []
-            for c in node.get_children():
-                pks.append(c.pk)
-                pks.extend(_get_descendent_pks(c))
-            return pks
-        pks = _get_descendent_pks(self)
-        if include_self:
-            pks.append(self.pk)
-        ret = Location.objects.filter(id__in=pks, is_active=True)
-        return ret
+        # like walking down get_children, skip everything below an
+        # inactive location
+        below = LocationClosure.objects.filter(ancestor=self, depth__gt=0)
+        hidden = LocationClosure.objects.filter(
+            ancestor__in=below.filter(descendant__is_active=False).values('descendant'))
+        ret = location_closure.descendants(self, include_self=include_self)
+        return ret.filter(is_active=True).exclude(pk__in=hidden.values('descendant'))
 
     def get_descendants_plus_self(self):
         # utility to facilitate calling function from django template
@@ -210,3 +208,20 @@ class Location(models.Model, StockCacheMixin):
         self.code = new_code
         self.is_active = False
         self.save()
+
+
+class LocationClosure(models.Model):
+    """
+    The location hierarchy, materialized: a row for every location and
+    each of the locations above it (see logistics.closure).
+    """
+    ancestor = models.ForeignKey(Location, related_name="descendant_links", on_delete=models.CASCADE)
+    descendant = models.ForeignKey(Location, related_name="ancestor_links", on_delete=models.CASCADE)
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta(object):
+        unique_together = (('ancestor', 'descendant'),)
+
+
+location_closure = Closure(LocationClosure, 'parent_id')
+post_save.connect(location_closure.post_save, sender=Location)
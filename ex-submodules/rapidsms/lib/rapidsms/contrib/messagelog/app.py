@@ -1,10 +1,30 @@
 from __future__ import unicode_literals
 import datetime
 from rapidsms.apps.base import AppBase
+from rapidsms.conf import settings
 from .models import Message
+from .writer import MessageLogWriter
 
 
 class App(AppBase):
+    writer = None
+
+    def start(self):
+        # with MESSAGELOG_BUFFERED, the outgoing messages and the contacts'
+        # last messages are written in batches off the router's thread.
+        # incoming messages are still written straight away, since
+        # handlers refer to them (msg.logger_msg) in other rows.
+        if getattr(settings, "MESSAGELOG_BUFFERED", False):
+            self.writer = MessageLogWriter(
+                batch_size=getattr(settings, "MESSAGELOG_BATCH_SIZE", 100),
+                flush_interval=getattr(settings, "MESSAGELOG_FLUSH_INTERVAL", 1))
+            self.writer.start()
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+
     def _who(self, msg):
         to_return = {}
         if msg.contact:
@@ -15,20 +35,33 @@ class App(AppBase):
             raise ValueError
         return to_return
 
-    def _log(self, direction, who, text):
-        return Message.objects.create(
+    def _message(self, direction, who, text):
+        return Message(
             date=datetime.datetime.utcnow(),
             direction=direction,
             text=text,
             **who)
 
+    def _log(self, direction, who, text):
+        message = self._message(direction, who, text)
+        message.save()
+        return message
+
     def parse(self, msg):
         # annotate the message as we log them in case any other apps
         # want a handle to them
         msg.logger_msg = self._log("I", self._who(msg), msg.raw_text)
         if msg.contact:
             msg.contact.last_message = msg.logger_msg
-            msg.contact.save()
+            if self.writer is not None:
+                self.writer.set_last_message(msg.contact, msg.logger_msg)
+            else:
+                msg.contact.save()
 
     def outgoing(self, msg): 
-        msg.logger_msg = self._log("O", self._who(msg), msg.text)
+        if self.writer is not None:
+            # NB: this isn't saved (and has no pk) until the next flush
+            msg.logger_msg = self._message("O", self._who(msg), msg.text)
+            self.writer.log(msg.logger_msg)
+        else:
+            msg.logger_msg = self._log("O", self._who(msg), msg.text)
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.12 on 2026-10-18 18:05
+
+from datetime import datetime, timedelta
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_recent_messages(apps, schema_editor):
+    # only the recent incoming messages are looked up by their hash, so
+    # there's no need to go through the whole log
+    Message = apps.get_model('messagelog', 'Message')
+    messages = []
+    for message in Message.objects.filter(direction='I',
+                                          date__gt=datetime.utcnow() - timedelta(days=1)).iterator():
+        normalized = " ".join(message.text.lower().split())
+        message.text_hash = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        messages.append(message)
+    Message.objects.bulk_update(messages, ['text_hash'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagelog', '0002_alter_message_direction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='text_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together={('connection', 'text_hash', 'date')},
+        ),
+        migrations.RunPython(hash_recent_messages, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,6 @@
 from __future__ import unicode_literals
+import hashlib
+from builtins import object
 from django.db import models
 from django.core.exceptions import ValidationError
 from rapidsms.models import Contact, Connection
@@ -16,14 +18,39 @@ class Message(models.Model):
     direction = models.CharField(max_length=1, choices=DIRECTION_CHOICES)
     date = models.DateTimeField()
     text = models.TextField()
+    # hash of the normalized text, so that repeats of a message can be
+    # looked up by index (see resend.py)
+    text_hash = models.CharField(max_length=40, null=True, blank=True)
     tags = TaggableManager()
 
+    class Meta(object):
+        index_together = (('connection', 'text_hash', 'date'),)
+
+    @classmethod
+    def hash_text(cls, text):
+        """
+        The text_hash of a message: the same for texts that only differ in
+        case and whitespace.
+        """
+        normalized = " ".join(text.lower().split())
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
     def save(self, *args, **kwargs):
         """
         Verifies that one (not both) of the contact or connection fields
         have been populated (raising ValidationError if not), and saves
         the object as usual.
         """
+        self.set_who()
+        self.text_hash = Message.hash_text(self.text)
+        # all is well; save the object as usual
+        models.Model.save(self, *args, **kwargs)
+
+    def set_who(self):
+        """
+        The checks save does on the contact and connection, for messages
+        that are written without it (see writer.MessageLogWriter).
+        """
 
         if (self.contact or self.connection) is None:
             raise ValidationError(
@@ -44,9 +71,6 @@ class Message(models.Model):
             # we still might want to know who it originally came
             # in from.  
             self.contact = self.connection.contact
-        
-        # all is well; save the object as usual
-        models.Model.save(self, *args, **kwargs)
 
     @property
     def who(self):
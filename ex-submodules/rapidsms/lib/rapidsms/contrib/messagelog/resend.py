@@ -0,0 +1,53 @@
+"""
+Spotting incoming messages that repeat one sent shortly before from the
+same connection (e.g. someone sending a report again to force it
+through), without searching the message log by text.
+
+The last incoming message for each (connection, text hash) is kept in
+the cache for the length of the window. When it isn't there (the first
+time, or the cache was cleared or isn't shared between processes) the
+message log is checked through its (connection, text_hash, date) index.
+"""
+from __future__ import unicode_literals
+from datetime import timedelta
+
+from django.core.cache import cache
+
+from .models import Message
+
+
+RESEND_CACHE_PREFIX = "messagelog-resend"
+
+
+def _cache_key(message):
+    return "%s-%s-%s" % (RESEND_CACHE_PREFIX, message.connection_id, message.text_hash)
+
+
+def earlier_copies(message, window):
+    """
+    The incoming messages from the same connection, with the same text, in
+    the *window* seconds before the (logged, incoming) message.
+    """
+    if message.text_hash is None:
+        message.text_hash = Message.hash_text(message.text)
+    return Message.objects.filter(
+        direction="I", connection_id=message.connection_id,
+        text_hash=message.text_hash, date__gt=message.date - timedelta(seconds=window),
+    ).exclude(pk=message.pk)
+
+
+def is_resend(message, window):
+    """
+    Whether the (logged, incoming) message repeats one sent from the same
+    connection in the *window* seconds before it. Each call also records
+    the message for the next one.
+    """
+    cutoff = message.date - timedelta(seconds=window)
+    key = _cache_key(message)
+    last = cache.get(key)
+    if last is not None and last[0] != message.pk and last[1] > cutoff:
+        resend = True
+    else:
+        resend = earlier_copies(message, window).exists()
+    cache.set(key, (message.pk, message.date), window)
+    return resend
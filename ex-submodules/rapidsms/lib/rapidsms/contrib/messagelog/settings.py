@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from __future__ import unicode_literals
+# write outgoing messages and contacts' last messages in batches, from a
+# background thread. leave this off in tests, which expect every message
+# to be logged by the time the router has handled it.
+MESSAGELOG_BUFFERED = False
+MESSAGELOG_BATCH_SIZE = 100
+MESSAGELOG_FLUSH_INTERVAL = 1
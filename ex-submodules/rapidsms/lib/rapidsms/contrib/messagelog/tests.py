@@ -1,9 +1,16 @@
 from __future__ import unicode_literals
+import time
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.test.utils import override_settings
 
 from logistics_project.apps.malawi.tests import create_hsa, MalawiTestBase
 from rapidsms.tests.scripted import TestScript
+from rapidsms.contrib.messagelog.app import App as MessageLogApp
 from rapidsms.contrib.messagelog.models import Message
 from taggit.models import Tag
+from rapidsms.contrib.messagelog.writer import MessageLogWriter
+from rapidsms.contrib.messagelog.resend import is_resend
 
 
 class TestTags(TestScript):
@@ -58,3 +65,109 @@ class TestContactLastMessage(MalawiTestBase):
         """)
         contact.refresh_from_db()
         self.assertEqual('help again', contact.last_message.text)
+
+
+class TestMessageLogWriter(MalawiTestBase):
+
+    def test_batches(self):
+        contact = create_hsa(self, '+5558585', 'Logger Head')
+        start = Message.objects.count()
+        writer = MessageLogWriter(batch_size=3, flush_interval=60)
+        writer.start()
+        try:
+            for i in range(4):
+                writer.log(Message(date=datetime.utcnow(), direction='O',
+                                   text='out %s' % i, connection=contact.default_connection))
+                # nothing is written until the batch is full
+                self.assertEqual(start + (3 if i >= 2 else 0), Message.objects.count())
+            last = Message.objects.filter(text='out 0').get()
+            writer.set_last_message(contact, last)
+            contact.refresh_from_db()
+            self.assertNotEqual(last, contact.last_message)
+        finally:
+            writer.stop()
+        self.assertEqual(start + 4, Message.objects.count())
+        # the contact was filled in from the connection
+        self.assertEqual(4, Message.objects.filter(text__startswith='out ', contact=contact).count())
+        contact.refresh_from_db()
+        self.assertEqual(last, contact.last_message)
+
+    def test_unwritable_rows_dropped(self):
+        contact = create_hsa(self, '+5558585', 'Logger Head')
+        last = Message.objects.filter(contact=contact).latest('pk')
+        writer = MessageLogWriter(batch_size=10, flush_interval=60)
+        good = Message(date=datetime.utcnow(), direction='O', text='good',
+                       connection=contact.default_connection)
+        bad = Message(date=None, direction='O', text='bad', connection=contact.default_connection)
+        writer.log(good)
+        writer.log(bad)
+        writer.set_last_message(contact, last)
+        writer.flush()
+        # the rest of the batch is written a row at a time
+        self.assertEqual(['good'], list(Message.objects.filter(pk__gt=last.pk)
+                                        .values_list('text', flat=True)))
+        contact.refresh_from_db()
+        self.assertEqual(last, contact.last_message)
+        writer.flush()
+        self.assertEqual(1, Message.objects.filter(pk__gt=last.pk).count())
+
+    def test_failed_flush_kept(self):
+        contact = create_hsa(self, '+5558585', 'Logger Head')
+        start = Message.objects.count()
+        writer = MessageLogWriter(batch_size=1, flush_interval=60, max_attempts=3)
+        message = Message(date=None, direction='O', text='later', connection=contact.default_connection)
+        # nothing can be written, which the background thread retries
+        writer.log(message)
+        writer.log(Message(date=datetime.utcnow(), direction='O', text='waiting',
+                           connection=contact.default_connection))
+        self.assertEqual(start, Message.objects.count())
+        message.date = datetime.utcnow()
+        writer.flush()
+        self.assertEqual(start + 2, Message.objects.count())
+
+        # but only so many times
+        writer.log(Message(date=None, direction='O', text='never', connection=contact.default_connection))
+        writer.flush()
+        self.assertEqual(1, len(writer._messages))
+        writer.flush()
+        self.assertEqual([], writer._messages)
+
+    @override_settings(MESSAGELOG_BUFFERED=True)
+    def test_buffered_app(self):
+        contact = create_hsa(self, '+5558585', 'Logger Head')
+        self.runScript("""
+            +5558585 > help again
+        """)
+        # the router stops after the script, which flushes the writer (on
+        # the router's thread, after the script has returned)
+        app = [a for a in self.router.apps if isinstance(a, MessageLogApp)][0]
+        while app.writer is not None:
+            time.sleep(0.1)
+        self.assertEqual(1, Message.objects.filter(direction='I', text='help again').count())
+        self.assertEqual(contact, Message.objects.filter(direction='O').order_by('-pk')[0].contact)
+        contact.refresh_from_db()
+        self.assertEqual('help again', contact.last_message.text)
+
+
+class TestResend(MalawiTestBase):
+
+    def _incoming(self, text, minutes_ago=0):
+        message = Message(date=datetime.utcnow() - timedelta(minutes=minutes_ago), direction='I',
+                          text=text, connection=self.contact.default_connection)
+        message.save()
+        return message
+
+    def test_resend(self):
+        self.contact = create_hsa(self, '+5558585', 'Logger Head')
+        self.assertFalse(is_resend(self._incoming('soh zi 10', minutes_ago=90), 3600))
+        self.assertFalse(is_resend(self._incoming('soh zi 10'), 3600))
+        self.assertFalse(is_resend(self._incoming('soh zi 20'), 3600))
+        message = self._incoming('SOH  zi 10')
+        with self.assertNumQueries(0):
+            self.assertTrue(is_resend(message, 3600))
+
+        # without the cache it's looked up in the log
+        cache.clear()
+        message = self._incoming('soh zi 20 ')
+        with self.assertNumQueries(1):
+            self.assertTrue(is_resend(message, 3600))
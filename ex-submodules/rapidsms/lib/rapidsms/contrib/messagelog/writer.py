@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+
+from __future__ import unicode_literals
+from builtins import object
+import logging
+import threading
+from django.db import close_old_connections, connection
+from rapidsms.models import Contact
+from .models import Message
+
+
+class MessageLogWriter(object):
+    """
+    Buffers message log rows and contacts' last messages, and writes them
+    in batches: whenever batch_size messages are waiting, every
+    flush_interval seconds from a background thread, and when stopped.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=1, max_attempts=5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._messages = []
+        self._last_messages = {}
+        self._failed_flushes = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(name="messagelog-writer", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and write anything still waiting.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Error writing the message log")
+        connection.close()
+
+    def log(self, message):
+        """
+        Queue an (unsaved) Message to be written with the next batch.
+        """
+        message.set_who()
+        message.text_hash = Message.hash_text(message.text)
+        with self._lock:
+            self._messages.append(message)
+            # while writes are failing, leave retrying to the background thread
+            full = len(self._messages) >= self.batch_size and not self._failed_flushes
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                # the message being logged is still sent
+                logging.exception("Error writing the message log")
+
+    def set_last_message(self, contact, message):
+        with self._lock:
+            self._last_messages[contact.pk] = message.pk
+
+    def flush(self):
+        """
+        Write everything waiting. A batch that can't be written is retried
+        a row at a time, and the rows that still fail are logged and
+        dropped. If nothing at all can be written (e.g. the database is
+        down) it all goes back in the buffer, for up to max_attempts
+        flushes in a row before it is dropped too.
+        """
+        with self._lock:
+            messages, self._messages = self._messages, []
+            last_messages, self._last_messages = self._last_messages, {}
+        if not messages and not last_messages:
+            return
+        failed_messages = _write(messages, self._save_messages, _save_message)
+        failed_last_messages = _write(list(last_messages.items()),
+                                      self._save_last_messages, _save_last_message)
+
+        if len(failed_messages) + len(failed_last_messages) == len(messages) + len(last_messages):
+            with self._lock:
+                self._failed_flushes += 1
+                give_up = self._failed_flushes >= self.max_attempts
+                if give_up:
+                    self._failed_flushes = 0
+            if not give_up:
+                self._requeue(messages, last_messages)
+                return
+            logging.error("Couldn't write the message log %s times, giving up on %s messages "
+                          "and %s last messages" % (self.max_attempts, len(messages), len(last_messages)))
+        else:
+            with self._lock:
+                self._failed_flushes = 0
+        for message in failed_messages:
+            logging.error("Dropped a message log row that couldn't be written: %s %s %r" % (
+                message.direction, message.date, message.text))
+        for contact_id, message_id in failed_last_messages:
+            logging.error("Dropped the last message (%s) of contact %s, which couldn't be written" % (
+                message_id, contact_id))
+
+    def _save_messages(self, messages):
+        Message.objects.bulk_create(messages, batch_size=self.batch_size)
+
+    def _save_last_messages(self, last_messages):
+        Contact.objects.bulk_update(
+            [Contact(pk=contact_id, last_message_id=message_id)
+             for contact_id, message_id in last_messages],
+            ["last_message"], batch_size=self.batch_size)
+
+    def _requeue(self, messages, last_messages):
+        with self._lock:
+            self._messages = messages + self._messages
+            # any last messages set since are newer
+            last_messages.update(self._last_messages)
+            self._last_messages = last_messages
+
+
+def _save_message(message):
+    message.save()
+
+
+def _save_last_message(last_message):
+    contact_id, message_id = last_message
+    Contact.objects.filter(pk=contact_id).update(last_message=message_id)
+
+
+def _write(rows, save_all, save_one):
+    """
+    Save the rows in one go or, if that fails, one at a time. Returns the
+    rows that couldn't be saved.
+    """
+    if not rows:
+        return []
+    try:
+        save_all(rows)
+        return []
+    except Exception:
+        logging.exception("Error writing the message log, retrying a row at a time")
+    failed = []
+    for row in rows:
+        try:
+            save_one(row)
+        except Exception:
+            failed.append(row)
+    return failed
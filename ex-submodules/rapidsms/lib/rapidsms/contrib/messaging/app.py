@@ -3,6 +3,7 @@
 
 
 from __future__ import unicode_literals
+import json
 from rapidsms.apps.base import AppBase
 from rapidsms.models import Connection
 from rapidsms.messages.outgoing import OutgoingMessage
@@ -28,6 +29,38 @@ class App (AppBase):
         connection = Connection.objects.get(pk=form["connection_id"])
         return self._send_message(connection, form["text"])
         
+    def ajax_POST_send_messages(self, params, form):
+        '''
+        Sends a batch of messages, posted as a JSON list of
+        [connection_id, backend_id, identity, text] in the "messages"
+        field of:
+
+            ajax/messaging/send_messages
+
+        The backend and identity are only used when there's no connection
+        id, for connections that aren't saved. You can also call this from
+        a view with:
+
+            messaging.utils.send_messages([(connection, text), ...])
+
+        Returns whether each message was sent, in order.
+        '''
+        messages = json.loads(form["messages"])
+        connections = Connection.objects.select_related('backend', 'contact')\
+            .in_bulk(set(message[0] for message in messages if message[0] is not None))
+        results = []
+        for connection_id, backend_id, identity, text in messages:
+            if connection_id is None:
+                connection = Connection(backend_id=backend_id, identity=identity)
+            else:
+                connection = connections.get(connection_id)
+            if connection is None:
+                self.warning("No connection %s to send to" % connection_id)
+                results.append(False)
+            else:
+                results.append(bool(self._send_message(connection, text)))
+        return results
+
     def _send_message(self, connection, message_body):    
         '''Attempts to send a message through a given connection'''
         # attempt to send the message
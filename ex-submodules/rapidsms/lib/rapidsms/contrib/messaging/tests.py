@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+import json
+from logistics_project.apps.malawi.tests import create_hsa, MalawiTestBase
+from rapidsms.contrib.messaging.app import App
+
+
+class TestSendMessages(MalawiTestBase):
+
+    def test_send_messages(self):
+        wendy = create_hsa(self, '+16175551000', 'wendy')
+        steve = create_hsa(self, '+16175551001', 'steve', id="2")
+        app = [app for app in self.router.apps if isinstance(app, App)][0]
+        self.startRouter()
+        try:
+            results = app.ajax_POST_send_messages({}, {"messages": json.dumps([
+                [wendy.default_connection.pk, None, None, "hello wendy"],
+                [-1, None, None, "hello nobody"],
+                [steve.default_connection.pk, None, None, "hello steve"],
+                [None, wendy.default_connection.backend_id, "+16175551002", "hello stranger"],
+                [wendy.default_connection.pk, None, None, "bye wendy"],
+            ])})
+        finally:
+            self.stopRouter()
+        self.assertEqual([True, False, True, True, True], results)
+        self.assertEqual(
+            [("+16175551000", "hello wendy"), ("+16175551001", "hello steve"),
+             ("+16175551002", "hello stranger"), ("+16175551000", "bye wendy")],
+            [(m.connection.identity, m.text) for m in self.backend.outgoing_bucket])
@@ -3,6 +3,7 @@
 
 from __future__ import unicode_literals
 from builtins import str
+import json
 from rapidsms.contrib.ajax.utils import call_router
 
 def send_message(connection, text):
@@ -13,3 +14,18 @@ def send_message(connection, text):
     post = {"connection_id": str(connection.id), "text": text}
     return call_router("messaging", "send_message", **post)
 
+
+def send_messages(messages):
+    """
+    Send a batch of messages from the webui process to the router process
+    in a single request, via the ajax app. *messages* is a list of
+    (connection, text) tuples; returns whether each one was sent.
+    """
+    # connections that aren't saved (e.g. for USSD pushes) are sent by
+    # their backend and identity instead
+    messages = [(connection.id, connection.backend_id, connection.identity, text)
+                for connection, text in messages]
+    if not messages:
+        return []
+    post = {"messages": json.dumps(messages)}
+    return call_router("messaging", "send_messages", **post)
@@ -7,6 +7,7 @@ from builtins import range
 import threading
 import time
 import queue
+import zlib
 
 from django.dispatch import Signal
 
@@ -16,6 +17,56 @@ from .apps.base import AppBase
 from .conf import settings
 
 
+class RouterStats(object):
+    """
+    Timings for sizing the router's worker pool: how long incoming
+    messages waited in the queue, and how long each incoming phase took.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.wait = self._timing()
+            self.phases = {}
+
+    @staticmethod
+    def _timing():
+        return {"count": 0, "total": 0.0, "max": 0.0}
+
+    @staticmethod
+    def _add(timing, secs):
+        timing["count"] += 1
+        timing["total"] += secs
+        timing["max"] = max(timing["max"], secs)
+
+    def record_wait(self, secs):
+        with self._lock:
+            self._add(self.wait, secs)
+
+    def record_phase(self, phase, secs):
+        with self._lock:
+            self._add(self.phases.setdefault(phase, self._timing()), secs)
+
+    def summary(self):
+        """
+        A copy of the timings, with the mean of each added.
+        """
+        def _summary(timing):
+            timing = dict(timing)
+            timing["mean"] = timing["total"] / timing["count"] if timing["count"] else 0.0
+            return timing
+
+        with self._lock:
+            return {
+                "wait": _summary(self.wait),
+                "phases": dict((phase, _summary(timing))
+                               for phase, timing in list(self.phases.items())),
+            }
+
+
 class Router(LoggerMixin):
     """
     """
@@ -41,7 +92,21 @@ class Router(LoggerMixin):
         """TODO: Docs"""
 
         self._queue = queue.Queue()
-        """Pending incoming messages, populated by Router.incoming_message."""
+        """Pending incoming messages, populated by Router.incoming_message,
+           as (time queued, message) tuples."""
+
+        self.workers = getattr(settings, "RAPIDSMS_ROUTER_WORKERS", 1)
+        """The number of threads processing incoming messages. Messages
+           from the same connection are always handled by the same one, so
+           they stay in order."""
+
+        self.queue_timeout = getattr(settings, "RAPIDSMS_ROUTER_QUEUE_TIMEOUT", 0.5)
+        """How long (in seconds) to block waiting for an incoming message
+           before checking whether the router is still running."""
+
+        self.stats = RouterStats()
+        self._worker_queues = []
+        self._worker_threads = []
 
     def add_app(self, module_name):
         """
@@ -231,26 +296,30 @@ class Router(LoggerMixin):
         self.accepting = True
         self._starting_backends = False
 
+        if self.workers > 1:
+            self._start_workers()
+
         try:
             while self.running:
 
-                # fetch the next pending incoming message, if one is
-                # available immediately. this increments the number of
-                # "tasks" on the queue, which MUST be decremented later
-                # to avoid deadlock during graceful shutdown. (it calls
-                # _queue.join to ensure that all pending messages are
+                # wait (briefly, so that Router.stop is noticed) for the
+                # next pending incoming message. this increments the
+                # number of "tasks" on the queue, which MUST be decremented
+                # later to avoid deadlock during graceful shutdown. (it
+                # calls _queue.join to ensure that all pending messages are
                 # processed before stopping.).
                 #
                 # for more infomation on Queues, see:
                 # help(Queue.Queue.task_done)
                 try:
-                    self.incoming(self._queue.get(block=False))
-                    self._queue.task_done()
-
-                # if there were no messages waiting, wait a very short
-                # (in human terms) time before looping to check again.
+                    queued_at, msg = self._queue.get(timeout=self.queue_timeout)
                 except queue.Empty:
-                    time.sleep(0.1)
+                    continue
+
+                if self.workers > 1:
+                    self._worker_queues[self._shard(msg)].put((queued_at, msg))
+                else:
+                    self._process(queued_at, msg)
 
         # stopped via ctrl+c
         except KeyboardInterrupt:
@@ -268,10 +337,81 @@ class Router(LoggerMixin):
         self.accepting = False
 
         self.debug("Stopping...")
+        self._stop_workers()
         self._stop_all_backends()
         self._stop_all_apps()
         self.info("Stopped")
 
+    def _shard(self, msg):
+        """
+        The worker that handles messages from this message's connection.
+        """
+        connection = msg.connection
+        key = "%s/%s" % (getattr(connection, "backend_id", None),
+                         getattr(connection, "identity", connection))
+        # not hash(), which can differ from one process to the next
+        return zlib.crc32(key.encode("utf-8")) % self.workers
+
+    def _process(self, queued_at, msg):
+        """
+        Run an incoming message taken off the queue through the apps,
+        marking it done on the queue whatever happens.
+        """
+        self.stats.record_wait(time.time() - queued_at)
+        try:
+            self.incoming(msg)
+        finally:
+            self._queue.task_done()
+
+    def _work(self, worker_queue):
+        """
+        Process the messages sharded to one worker until it is handed None.
+        """
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                break
+            try:
+                self._process(*item)
+            except Exception:
+                self.exception("Error processing incoming message")
+        # each worker thread has its own database connection
+        connection.close()
+
+    def _start_workers(self):
+        self._worker_queues = [queue.Queue() for n in range(self.workers)]
+        self._worker_threads = []
+        for n, worker_queue in enumerate(self._worker_queues):
+            worker = threading.Thread(
+                name="%s-worker-%s" % (self._logger_name(), n),
+                target=self._work,
+                args=(worker_queue,))
+            worker.daemon = True
+            worker.start()
+            self._worker_threads.append(worker)
+
+    def _stop_workers(self):
+        """
+        Stop the worker threads once they have finished the messages
+        already handed to them.
+        """
+        for worker_queue in self._worker_queues:
+            worker_queue.put(None)
+        for worker in self._worker_threads:
+            worker.join()
+        self._worker_queues = []
+        self._worker_threads = []
+
+    def metrics(self):
+        """
+        The current queue depths, along with the RouterStats timings.
+        """
+        metrics = self.stats.summary()
+        metrics["workers"] = self.workers
+        metrics["queue_depth"] = self._queue.qsize()
+        metrics["worker_queue_depths"] = [q.qsize() for q in self._worker_queues]
+        return metrics
+
     def stop(self, graceful=False):
         """
         Stop the router, which unblocks the Router.start method as soon
@@ -316,7 +456,7 @@ class Router(LoggerMixin):
             return False
 
         try:
-            self._queue.put(msg)
+            self._queue.put((time.time(), msg))
             return True
 
         # if the queue is of a limited size, it may raise the Full
@@ -361,41 +501,11 @@ class Router(LoggerMixin):
                         self.debug("Skipping phase")
                         continue
 
-                for app in self.apps:
-                    self.debug("In %s app" % app)
-                    handled = False
-
-                    try:
-                        func = getattr(app, phase)
-                        handled = func(msg)
-
-                    except Exception as err:
-                        app.exception()
-
-                    # during the _filter_ phase, an app can return True
-                    # to abort ALL further processing of this message
-                    if phase == "filter":
-                        if handled is True:
-                            self.warning("Message filtered")
-                            raise (StopIteration)
-
-                    # during the _handle_ phase, apps can return True
-                    # to "short-circuit" this phase, preventing any
-                    # further apps from receiving the message
-                    elif phase == "handle":
-                        if handled is True:
-                            self.debug("Short-circuited")
-                            # mark the message handled to avoid the 
-                            # default phase firing unnecessarily
-                            msg.handled = True
-                            break
-
-                    elif phase == "default":
-                        # allow default phase of apps to short circuit
-                        # for prioritized contextual responses.   
-                        if handled is True:
-                            self.debug("Short-circuited default")
-                            break
+                started = time.time()
+                try:
+                    self._incoming_phase(phase, msg)
+                finally:
+                    self.stats.record_phase(phase, time.time() - started)
 
         except StopIteration:
             pass
@@ -407,6 +517,47 @@ class Router(LoggerMixin):
         # synchronous backends might be, so mark it as processed.
         msg.processed = True
 
+    def _incoming_phase(self, phase, msg):
+        """
+        Run one incoming phase of a message through the apps, raising
+        StopIteration if the message was filtered.
+        """
+        for app in self.apps:
+            self.debug("In %s app" % app)
+            handled = False
+
+            try:
+                func = getattr(app, phase)
+                handled = func(msg)
+
+            except Exception as err:
+                app.exception()
+
+            # during the _filter_ phase, an app can return True
+            # to abort ALL further processing of this message
+            if phase == "filter":
+                if handled is True:
+                    self.warning("Message filtered")
+                    raise (StopIteration)
+
+            # during the _handle_ phase, apps can return True
+            # to "short-circuit" this phase, preventing any
+            # further apps from receiving the message
+            elif phase == "handle":
+                if handled is True:
+                    self.debug("Short-circuited")
+                    # mark the message handled to avoid the 
+                    # default phase firing unnecessarily
+                    msg.handled = True
+                    break
+
+            elif phase == "default":
+                # allow default phase of apps to short circuit
+                # for prioritized contextual responses.   
+                if handled is True:
+                    self.debug("Short-circuited default")
+                    break
+
     def outgoing(self, msg):
         """
         """
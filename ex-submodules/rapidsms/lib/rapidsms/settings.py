@@ -5,3 +5,8 @@ from __future__ import unicode_literals
 PROJECT_NAME = "RapidSMS"
 PAGINATOR_OBJECTS_PER_PAGE = 12
 PAGINATOR_MAX_PAGE_LINKS = 5
+# the number of threads the router processes incoming messages with
+RAPIDSMS_ROUTER_WORKERS = 1
+# seconds to block waiting for an incoming message before checking
+# whether the router has been stopped
+RAPIDSMS_ROUTER_QUEUE_TIMEOUT = 0.5
@@ -2,3 +2,4 @@ from __future__ import unicode_literals
 from .test_base import *
 from .test_bucket import *
 from .test_http import *
+from .test_sendqueue import *
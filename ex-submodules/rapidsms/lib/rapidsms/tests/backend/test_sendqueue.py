@@ -0,0 +1,138 @@
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import threading
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from django.test import SimpleTestCase
+
+from rapidsms.tests.harness import MockRouter
+from rapidsms.backends.kannel import KannelBackend
+
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        to, text = params["to"][0], params["text"][0]
+        status = self.server.respond(to, text, self.client_address)
+        body = b"0: Accepted for delivery" if status < 400 else b"error"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGateway(ThreadingMixIn, HTTPServer):
+    """
+    A stand-in for Kannel's sendsms interface. Fails the first attempt at
+    any message with "flaky" in it, and always rejects "bad" ones.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeGatewayHandler)
+        self.lock = threading.Lock()
+        self.delivered = []
+        self.attempts = []
+        self.clients = set()
+
+    def respond(self, to, text, client_address):
+        with self.lock:
+            self.clients.add(client_address)
+            self.attempts.append(text)
+            if "bad" in text:
+                return 403
+            if "flaky" in text and self.attempts.count(text) == 1:
+                return 503
+            self.delivered.append((to, text))
+            return 202
+
+
+class FakeConnection(object):
+    backend_id = 1
+
+    def __init__(self, identity):
+        self.identity = identity
+
+
+class FakeMessage(object):
+    sent = False
+    sent_at = None
+
+    def __init__(self, identity, text):
+        self.connection = FakeConnection(identity)
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class SendQueueTest(SimpleTestCase):
+
+    def setUp(self):
+        self.gateway = FakeGateway()
+        threading.Thread(target=self.gateway.serve_forever).start()
+        self.backend = KannelBackend(
+            router=MockRouter(), name="kannel",
+            sendsms_url="http://127.0.0.1:%s/cgi-bin/sendsms" % self.gateway.server_address[1],
+            send_workers=2, send_retries=2, send_backoff=0.01)
+        self.backend.send_queue.start()
+
+    def tearDown(self):
+        self.backend.send_queue.stop()
+        self.gateway.shutdown()
+        self.gateway.server_close()
+
+    def test_queued_sends(self):
+        messages = [FakeMessage("+26599900%s" % (i % 3), "message %s" % i) for i in range(12)]
+        for message in messages:
+            self.assertTrue(self.backend.send(message))
+        self.backend.send_queue.join()
+
+        self.assertTrue(all(m.sent and m.sent_at for m in messages))
+        self.assertEqual(sorted((m.connection.identity, m.text) for m in messages),
+                         sorted(self.gateway.delivered))
+        # each recipient's messages arrive in the order they were sent
+        for number in set(m.connection.identity for m in messages):
+            self.assertEqual([m.text for m in messages if m.connection.identity == number],
+                             [text for to, text in self.gateway.delivered if to == number])
+        # over at most one connection per worker
+        self.assertTrue(len(self.gateway.clients) <= 2)
+
+        metrics = self.backend.metrics()
+        self.assertEqual(12, metrics["queued"])
+        self.assertEqual(12, metrics["sent"])
+        self.assertEqual(0, metrics["failed"])
+        self.assertEqual(12, metrics["request"]["count"])
+
+    def test_retries(self):
+        flaky = FakeMessage("+265999001", "flaky message")
+        bad = FakeMessage("+265999002", "bad message")
+        self.backend.send(flaky)
+        self.backend.send(bad)
+        self.backend.send_queue.join()
+
+        self.assertTrue(flaky.sent)
+        self.assertEqual(2, self.gateway.attempts.count("flaky message"))
+        # client errors aren't retried
+        self.assertFalse(bad.sent)
+        self.assertEqual(1, self.gateway.attempts.count("bad message"))
+
+        metrics = self.backend.metrics()
+        self.assertEqual(1, metrics["sent"])
+        self.assertEqual(1, metrics["failed"])
+        self.assertEqual(1, metrics["retries"])
+
+    def test_sends_synchronously_when_not_running(self):
+        self.backend.send_queue.stop()
+        message = FakeMessage("+265999001", "right away")
+        self.assertTrue(self.backend.send(message))
+        self.assertEqual([("+265999001", "right away")], self.gateway.delivered)
@@ -101,3 +101,64 @@ class RouterTest(TestCase):
         self.assertEqual("cc" in backend._config, True)
         self.assertEqual("B"  in backend._config, False)
         self.assertEqual("Cc" in backend._config, False)
+
+
+    def test_router_workers_keep_connection_order(self):
+        class MockConnection(object):
+            def __init__(self, identity):
+                self.identity = identity
+
+        class MockMessage(object):
+            def __init__(self, connection, text):
+                self.connection = connection
+                self.text = text
+                self.handled = False
+                self.processed = False
+
+            def flush_responses(self):
+                pass
+
+        class MockApp(AppBase):
+            def start(self):
+                self.seen = []
+                self.threads = set()
+
+            def handle(self, msg):
+                self.seen.append((msg.connection.identity, msg.text))
+                self.threads.add(threading.current_thread().name)
+                time.sleep(0.001)
+                return True
+
+        router = Router()
+        router.workers = 3
+        router.queue_timeout = 0.05
+        app = MockApp(router)
+        router.apps.append(app)
+
+        worker = threading.Thread(target=router.start)
+        worker.daemon = True
+        worker.start()
+        while not router.accepting:
+            time.sleep(0.1)
+
+        connections = [MockConnection("+%s" % n) for n in range(6)]
+        for i in range(20):
+            for conn in connections:
+                self.assertTrue(router.incoming_message(MockMessage(conn, "%s" % i)))
+        router.join()
+
+        metrics = router.metrics()
+        router.stop()
+        worker.join()
+
+        self.assertEqual(len(app.seen), 120)
+        for conn in connections:
+            texts = [text for identity, text in app.seen if identity == conn.identity]
+            self.assertEqual(texts, ["%s" % i for i in range(20)])
+        self.assertTrue(len(app.threads) > 1)
+        self.assertEqual(metrics["workers"], 3)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["wait"]["count"], 120)
+        self.assertEqual(metrics["phases"]["handle"]["count"], 120)
+        # handled messages skip the default phase
+        self.assertTrue("default" not in metrics["phases"])
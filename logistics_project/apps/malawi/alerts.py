@@ -1,19 +1,80 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 from datetime import datetime, timedelta
+from functools import wraps
+import uuid
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q, Subquery
 from django.db.models.expressions import F
 from alerts import Alert
 from logistics.models import StockRequest, SupplyPoint,\
-    SupplyPointType, ProductStock, StockRequestStatus
+    SupplyPointType, ProductStock, StockRequestStatus, Product
 from django.db.models.aggregates import Max
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from logistics.util import config
 from logistics.decorators import place_in_request
 from logistics_project.apps.malawi.nag import get_non_reporting_hsas
 from logistics_project.apps.malawi.util import get_facility_supply_points, hsas_below,\
-    hsa_supply_points_below, facility_supply_points_below, get_managed_products_for_contact
+    hsa_supply_points_below, facility_supply_points_below
 from logistics_project.apps.malawi.templatetags.malawi_tags import place_url
 
+ALERT_CACHE_TIMEOUT = 60 * 15
+ALERT_CACHE_VERSION_KEY = "malawi-alerts-version"
+
+
+def _version_key(location_code):
+    return "%s-%s" % (ALERT_CACHE_VERSION_KEY, location_code)
+
+
+def _alert_cache_versions(location_code):
+    # the version of all the alerts and that of the location's
+    keys = [ALERT_CACHE_VERSION_KEY, _version_key(location_code)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return "%s-%s" % tuple(versions[key] for key in keys)
+
+
+def invalidate_alert_cache(supply_point_ids=None):
+    """
+    Drop the cached alerts that the supply points can show up in: those of
+    their locations, the locations above them in the supply chain and the
+    whole country. With no supply points, drop every cached alert.
+    """
+    if supply_point_ids is None:
+        cache.set(ALERT_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+        return
+    codes = set(SupplyPoint.objects.filter(descendant_links__descendant__in=supply_point_ids)
+                .exclude(location=None).values_list('location__code', flat=True))
+    codes.add("")
+    cache.set_many(dict((_version_key(code), uuid.uuid4().hex) for code in codes), None)
+
+
+def cached_alerts(f):
+    """
+    Cache the alerts a generator returns for each location. See signals.py
+    for what invalidates them; changes that skip the signals (queryset
+    updates and bulk updates) are picked up when the cache times out.
+    """
+    @wraps(f)
+    def wrapper(request, *args, **kwargs):
+        code = request.location.code if request.location else ""
+        key = "malawi-alerts-%s-%s-%s" % (f.__name__, code, _alert_cache_versions(code))
+        alerts = cache.get(key)
+        if alerts is None:
+            alerts = f(request, *args, **kwargs)
+            cache.set(key, alerts, ALERT_CACHE_TIMEOUT)
+        return alerts
+    return wrapper
+
+
+def _pending_requests_for_stock():
+    return StockRequest.pending_requests().filter(supply_point=OuterRef('supply_point'),
+                                                  product=OuterRef('product'))
+
 class ProductStockAlert(Alert):
 
     def __init__(self, supply_point, product ):
@@ -35,10 +96,12 @@ class ProductStockAlert(Alert):
         return self._product
 
 @place_in_request()
+@cached_alerts
 def health_center_stockout(request):
     sps = facility_supply_points_below(request.location)
     return [ProductStockAlert(stock.supply_point, stock.product) for stock in \
-            ProductStock.objects.filter(is_active=True, supply_point__in=sps).filter(quantity=0)]
+            ProductStock.objects.filter(is_active=True, supply_point__in=sps).filter(quantity=0)\
+                .select_related('supply_point__location__type', 'product')]
 
 class HealthCenterUnableResupplyStockoutAlert(ProductStockAlert):
 
@@ -49,14 +112,20 @@ class HealthCenterUnableResupplyStockoutAlert(ProductStockAlert):
                  "product": self.product}
 
 @place_in_request()
+@cached_alerts
 def health_center_unable_resupply_stockout(request):
-    r = []
     hsas = hsa_supply_points_below(request.location)
-    for s in StockRequest.pending_requests().filter(supply_point__in=hsas,
-                                                    status=StockRequestStatus.STOCKED_OUT):
-        if s.supply_point.stock(s.product) == 0:
-            r += [HealthCenterUnableResupplyStockoutAlert(s.supply_point, s.product)]
-    return r
+    stock = ProductStock.objects.filter(supply_point=OuterRef('supply_point'),
+                                        product=OuterRef('product')).values('quantity')[:1]
+    # HSAs without a ProductStock count as stocked out, like SupplyPoint.stock
+    return [HealthCenterUnableResupplyStockoutAlert(s.supply_point, s.product)\
+            for s in StockRequest.pending_requests()\
+                            .filter(supply_point__in=hsas,
+                                    status=StockRequestStatus.STOCKED_OUT)\
+                            .annotate(stock=Coalesce(Subquery(stock), 0))\
+                            .filter(stock=0)\
+                            .select_related('supply_point__location__type', 'supply_point__supplied_by',
+                                            'product')]
 
 class HealthCenterUnableResupplyEmergencyAlert(ProductStockAlert):
 
@@ -67,13 +136,16 @@ class HealthCenterUnableResupplyEmergencyAlert(ProductStockAlert):
                  "product": self.product}
 
 @place_in_request()
+@cached_alerts
 def health_center_unable_resupply_emergency(request):
     hsas = hsa_supply_points_below(request.location)
     return [HealthCenterUnableResupplyEmergencyAlert(s.supply_point, s.product)\
             for s in StockRequest.pending_requests()\
                             .filter(is_emergency=True,
                                     status=StockRequestStatus.STOCKED_OUT,
-                                    supply_point__in=hsas)]
+                                    supply_point__in=hsas)\
+                            .select_related('supply_point__location__type', 'supply_point__supplied_by',
+                                            'product')]
     
 
 class NonReportingHSAAlert(Alert):
@@ -100,18 +172,19 @@ class HSABelowEmergencyQuantityAlert(ProductStockAlert):
                  "product": self.product.name}
 
 @place_in_request()
+@cached_alerts
 def hsa_below_emergency_quantity(request):
     '''
     This query finds HSA/product pairs where the product is below emergency level but there are no pending requests.
     '''
     hsas = hsa_supply_points_below(request.location)
-    r = []
-    for p in ProductStock.objects.filter(is_active=True,
-            supply_point__in=hsas,
-            quantity__lte = F('product__emergency_order_level')):
-        if not StockRequest.pending_requests().filter(product=p.product, supply_point=p.supply_point).exists():
-            r += [HSABelowEmergencyQuantityAlert(p.supply_point, p.product)]
-    return r
+    return [HSABelowEmergencyQuantityAlert(p.supply_point, p.product) for p in
+            ProductStock.objects.filter(is_active=True,
+                                        supply_point__in=hsas,
+                                        quantity__lte=F('product__emergency_order_level'))\
+                .annotate(pending=Exists(_pending_requests_for_stock()))\
+                .filter(pending=False)\
+                .select_related('supply_point__location__type', 'product')]
 
 
 class LateReportingAlert(Alert):
@@ -136,6 +209,7 @@ class LateReportingAlert(Alert):
 
 
 @place_in_request()
+@cached_alerts
 def late_reporting_receipt(request):
     """
     7 days after the "order ready" has been sent to the HSA
@@ -149,8 +223,10 @@ def late_reporting_receipt(request):
     bad_reqs = StockRequest.objects.filter(received_on=None, responded_on__lte=since, 
                                            supply_point__in=hsas,
                                            status=StockRequestStatus.APPROVED)\
-                    .values('supply_point').annotate(last_response=Max('responded_on'))
-    alerts = [LateReportingAlert(SupplyPoint.objects.get(pk=val["supply_point"]), val["last_response"]) \
+                    .values('supply_point').annotate(last_response=Max('responded_on')).order_by()
+    bad_reqs = list(bad_reqs)
+    supply_points = SupplyPoint.objects.in_bulk([val["supply_point"] for val in bad_reqs])
+    alerts = [LateReportingAlert(supply_points[val["supply_point"]], val["last_response"]) \
               for val in bad_reqs]
     return alerts
 
@@ -171,10 +247,17 @@ def hsas_no_supervision(request):
             for fac in orphaned_facilities_with_hsas]
 
 @place_in_request()
+@cached_alerts
 def hsas_no_products(request):
-    hsas = hsas_below(request.location)
+    # the products managed are as in get_managed_products_for_contact,
+    # where facility contacts manage all the facility level products
+    at_facility = Q(supply_point__type__code=config.SupplyPointCodes.FACILITY)
+    if Product.objects.filter(is_active=True, type__base_level=config.BaseLevel.FACILITY).exists():
+        hsas = hsas_below(request.location).filter(commodities__isnull=True).exclude(at_facility)
+    else:
+        hsas = hsas_below(request.location).filter(Q(commodities__isnull=True) | at_facility)
     return [Alert(config.Alerts.HSA_NO_PRODUCTS % {"hsa": hsa.name}, _hsa_url(hsa.supply_point)) \
-                  for hsa in hsas.all() if get_managed_products_for_contact(hsa).count() == 0]
+                  for hsa in hsas.select_related('supply_point').distinct()]
     
 def _facility_url(supply_point):
     return reverse("malawi_facility", args=[supply_point.code])
@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 from django.db import transaction
-from logistics.models import Product
+from logistics.catalog import get_catalog
 from logistics.util import config
 from logistics_project.decorators import validate_base_level
 from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
@@ -16,13 +16,14 @@ class BaseProductHandler(KeywordHandler):
             return self.help()
 
         self.hsa = self.msg.logistics_contact.supply_point
+        catalog = get_catalog()
         products = []
         for code in words:
-            try:
-                products.append(Product.objects.get(sms_code__iexact=code, type__base_level=self.base_level))
-            except Product.DoesNotExist:
+            product = catalog.get(code, base_level=self.base_level)
+            if product is None:
                 self.respond_error(config.Messages.UNKNOWN_CODE, product=code)
                 return
+            products.append(product)
 
         self.handle_products(products)
 
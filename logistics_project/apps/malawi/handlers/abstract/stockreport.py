@@ -1,5 +1,4 @@
 from __future__ import unicode_literals
-from datetime import datetime, timedelta
 
 import sentry_sdk
 from django.db import transaction
@@ -13,7 +12,7 @@ from logistics.shortcuts import create_stock_report
 from logistics_project.apps.malawi.validators import (check_max_levels_malawi, get_base_level_validator,
     combine_validators, require_working_refrigerator)
 from logistics_project.decorators import validate_base_level, malawi_managed_products_required
-from rapidsms.contrib.messagelog.models import Message
+from rapidsms.contrib.messagelog.resend import is_resend
 
 
 class StockReportBaseHandler(RecordResponseHandler):
@@ -45,12 +44,8 @@ class StockReportBaseHandler(RecordResponseHandler):
         try:
             # bit of a hack, also check if there was a recent message
             # that matched this and if so force it through
-            cutoff = datetime.utcnow() - timedelta(seconds=60 * 60)
-            msgs = Message.objects.filter(direction="I",
-                                          connection=self.msg.connection,
-                                          text__iexact=self.msg.raw_text,
-                                          date__gt=cutoff)
-            validation_function = check_max_levels_malawi if msgs.count() <= 1 else None
+            validation_function = None if is_resend(self.msg.logger_msg, 60 * 60) \
+                else check_max_levels_malawi
 
             validators = [
                 get_base_level_validator(self.base_level)
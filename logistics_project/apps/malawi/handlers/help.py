@@ -3,7 +3,7 @@ from collections import OrderedDict
 
 from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
 from logistics.decorators import logistics_contact_required
-from logistics.models import Product
+from logistics.catalog import get_catalog
 from logistics.util import config
 
 
@@ -24,11 +24,8 @@ class Help(KeywordHandler):
         if topic == 'stock':
             self.respond(config.Messages.SOH_HELP_MESSAGE)
         elif 'code' in topic:
-            products = Product.objects.filter(is_active=True).select_related('type').order_by("type__id", "sms_code")
-
             # Only show HSA-level products to HSAs; show all products to everyone else
-            if is_hsa:
-                products = products.filter(type__base_level=config.BaseLevel.HSA)
+            products = get_catalog().active(config.BaseLevel.HSA if is_hsa else None)
 
             grouped_codes = OrderedDict()
             for p in products:
@@ -42,15 +39,13 @@ class Help(KeywordHandler):
 
             self.respond("; ".join(messages))
         else:
-            try:
-                if is_hsa:
-                    p = Product.objects.get(sms_code=topic, is_active=True, type__base_level=config.BaseLevel.HSA)
-                else:
-                    p = Product.objects.get(sms_code=topic, is_active=True)
+            p = get_catalog().get(topic, base_level=config.BaseLevel.HSA if is_hsa else None,
+                                  active=True)
+            if p is None:
+                self.respond(config.Messages.HELP_TEXT)
+            else:
                 msg = "%s is the code for %s product %s" % (topic, p.type.name, p.name)
                 if p.units:
                     msg = msg + " (%s)" % p.units
 
                 self.respond(msg)
-            except Product.DoesNotExist:
-                self.respond(config.Messages.HELP_TEXT)
@@ -13,7 +13,7 @@ from logistics.util import config, ussd_msg_response
 from logistics_project.apps.malawi.validators import get_base_level_validator, check_max_levels_malawi
 from logistics_project.decorators import validate_base_level
 from rapidsms.conf import settings
-from rapidsms.contrib.messagelog.models import Message
+from rapidsms.contrib.messagelog.resend import earlier_copies
 
 
 class ReceiptHandler(KeywordHandler, TaggingHandler):
@@ -29,13 +29,9 @@ class ReceiptHandler(KeywordHandler, TaggingHandler):
     @logistics_contact_and_permission_required(config.Operations.REPORT_RECEIPT)
     @validate_base_level([config.BaseLevel.HSA, config.BaseLevel.FACILITY])
     def handle(self, text):
-        dupes = Message.objects.filter(direction="I",
-                                       connection=self.msg.connection,
-                                       text__iexact=self.msg.raw_text).exclude(pk=self.msg.logger_msg.pk)
         if settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN:
-            dupe_ignore_threshold = datetime.utcnow() - timedelta(seconds=settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN)
-            ignore = dupes.filter(date__gte=dupe_ignore_threshold)
-            if ignore.count() and ProductReport.objects.filter(message__in=dupes).count():
+            dupes = earlier_copies(self.msg.logger_msg, settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN)
+            if ProductReport.objects.filter(message__in=dupes).exists():
                 self.respond(_("Your receipt message was a duplicate and was discarded."))
                 return True
 
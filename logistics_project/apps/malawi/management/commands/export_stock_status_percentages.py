@@ -1,12 +1,12 @@
 from __future__ import print_function
 from __future__ import unicode_literals
-import csv
 from django.db.models import Sum
 from logistics_project.utils.dates import months_between
 from datetime import datetime
 from django.core.management.base import LabelCommand
+from logistics.export import excel_date, write_csv
 from logistics.models import Product, SupplyPoint
-from logistics_project.apps.malawi.util import get_facility_supply_points, fmt_pct
+from logistics_project.apps.malawi.util import fmt_pct
 from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityData
 from static.malawi import config
 
@@ -30,49 +30,58 @@ class Command(LabelCommand):
     def handle(self, *args, **options):
         """
         Exports a table of stock status percentages with the following headings:
-        product    district    facility    has    start date    end date    length
+        date    location type    location parent    location    location code
+        product    total hsas    hsas <category>...    % <category>...
         """
-        products = Product.objects.all()
+        if len(args) == 0:
+            print('please specify a filename')
+            return
 
-        def _get_rows(window_date, facility):
-            initial = ProductAvailabilityData.objects.filter(
-                supply_point=facility,
-                date=window_date,
+        products = list(Product.objects.all())
+        sites = list(SupplyPoint.objects.filter(
+            active=True,
+            type__code__in=[
+                config.SupplyPointCodes.FACILITY,
+                config.SupplyPointCodes.DISTRICT,
+                config.SupplyPointCodes.COUNTRY,
+            ]
+        ).select_related('type', 'supplied_by').order_by('type__code'))
+        # stolen from stock status report
+        ordered_slugs_managed = ['managed_and_%s' % slug for slug in CATEGORIES]
+
+        def _month_rows(window_date):
+            # the sums for every site and product in the month, in one query
+            sums = dict(
+                ((row['supply_point'], row['product']), row) for row in
+                ProductAvailabilityData.objects.filter(
+                    supply_point__in=[site.pk for site in sites], date=window_date,
+                ).order_by().values('supply_point', 'product').annotate(
+                    *[Sum(slug) for slug in ordered_slugs_managed + ['managed']])
             )
-            for p in products:
-                filtered = initial.filter(product=p)
-                if filtered.count():
-                    # stolen from stock status report
-                    ordered_slugs_managed = ['managed_and_%s' % slug for slug in CATEGORIES]
-                    values = filtered.aggregate(*[Sum(slug) for slug in ordered_slugs_managed + ['managed']])
+            for site in sites:
+                for p in products:
+                    values = sums.get((site.pk, p.pk))
+                    if values is None:
+                        continue
                     raw_vals = [values["managed_and_%s__sum" % k] or 0 for k in CATEGORIES]
                     denom = values["managed__sum"] or 0
                     pcts = [fmt_pct(val, denom) for val in raw_vals]
-
-                    def _parent(supply_point):
-                        return supply_point.supplied_by if supply_point else None
-
-                    def _display(supply_point):
-                        return supply_point.name if supply_point else '-'
-
-                    EXCEL_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
                     yield [
-                        window_date.strftime(EXCEL_DATE_FORMAT),
-                        facility.type.name,
-                        _display(_parent(facility)),
-                        _display(facility),
-                        facility.code,
+                        excel_date(window_date),
+                        site.type.name,
+                        site.supplied_by.name if site.supplied_by else '-',
+                        site.name,
+                        site.code,
                         p.name,
                     ] + [denom] + raw_vals + pcts
 
-        if len(args) == 0:
-            print('please specify a filename')
-            return
+        def _iter_rows():
+            for year, month in months_between(datetime(2012, 1, 1), datetime.now()):
+                print('getting data for %s-%s' % (month, year))
+                for row in _month_rows(datetime(year, month, 1)):
+                    yield row
 
-        filename = args[0]
-        f = file(filename, 'w')
-        out = csv.writer(f)
-        out.writerow([
+        write_csv(args[0], [
             'date',
             'location type',
             'location parent',
@@ -80,23 +89,5 @@ class Command(LabelCommand):
             'location code',
             'product',
             'total hsas',
-        ] + ['hsas %s' % _fmt_cat(cat) for cat in CATEGORIES] + ['%% %s' % _fmt_cat(cat) for cat in CATEGORIES])
-
-
-        start_date = datetime(2012, 1, 1)
-        now = datetime.now()
-        sites = SupplyPoint.objects.filter(
-            active=True,
-            type__code__in=[
-                config.SupplyPointCodes.FACILITY,
-                config.SupplyPointCodes.DISTRICT,
-                config.SupplyPointCodes.COUNTRY,
-            ]
-        ).order_by('type__code')
-
-        for year, month in months_between(start_date, now):
-            print('getting data for %s-%s' % (month, year))
-            window_date = datetime(year, month, 1)
-            for site in sites:
-                for row in _get_rows(window_date, site):
-                    out.writerow(row)
+        ] + ['hsas %s' % _fmt_cat(cat) for cat in CATEGORIES] + ['%% %s' % _fmt_cat(cat) for cat in CATEGORIES],
+            _iter_rows())
@@ -0,0 +1,32 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from datetime import datetime
+from django.core.management.base import BaseCommand
+
+from logistics_project.apps.malawi.nag import NagPlan, nag_hsas
+
+
+class Command(BaseCommand):
+
+    help = "Send the regular HSA nags, or with --dry-run just print who would get them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help="Print the nags that would be sent, without sending or recording them",
+        )
+
+    def handle(self, *args, **options):
+        start_time = datetime.now()
+        plan = nag_hsas(NagPlan())
+        planned_time = datetime.now()
+        for line in plan.lines:
+            print(line)
+        print("%s nags, %s messages, planned in %s" % (
+            len(plan.nag_records), len(plan.messages), planned_time - start_time))
+        if not options['dry_run']:
+            plan.send()
+            print(f'Sent in {datetime.now() - planned_time}')
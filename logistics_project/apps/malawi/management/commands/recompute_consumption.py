@@ -12,6 +12,7 @@ from rapidsms.contrib.messagelog.models import Message
 from logistics_project.utils.dates import months_between
 from logistics_project.apps.malawi.warehouse.runner import ReportPeriod,\
     update_consumption, aggregate, update_consumption_times
+from logistics_project.apps.malawi.warehouse.consumption import ConsumptionEngine
 from logistics_project.apps.malawi.util import hsa_supply_points_below
 from static.malawi.config import BaseLevel, SupplyPointCodes
 
@@ -56,6 +57,13 @@ class Command(BaseCommand):
             default=None,
             help="Explicit start date",
         )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            dest='bulk',
+            default=False,
+            help="Recompute each HSA's consumption in one pass with the consumption engine",
+        )
 
     def handle(self, *args, **options):
         aggregate_only = options['aggregate_only']
@@ -91,7 +99,7 @@ class Command(BaseCommand):
                                                start_run=datetime.utcnow())
         try:
             recompute(new_run, aggregate_only, hsa_code=options['hsa'], facility_code=options['facility'],
-                      district_code=options['district'])
+                      district_code=options['district'], bulk=options['bulk'])
         finally:
             # complete run
             new_run.end_run = datetime.utcnow()
@@ -101,7 +109,8 @@ class Command(BaseCommand):
             print(f'Duration {datetime.now() - start_time}')
 
 
-def recompute(run_record, aggregate_only, hsa_code=None, facility_code=None, district_code=None):
+def recompute(run_record, aggregate_only, hsa_code=None, facility_code=None, district_code=None,
+              bulk=False):
     if not aggregate_only:
         hsas = SupplyPoint.objects.filter(active=True, type__code='hsa').order_by('id')
         if hsa_code:
@@ -112,10 +121,14 @@ def recompute(run_record, aggregate_only, hsa_code=None, facility_code=None, dis
             hsas = hsas.filter(supplied_by__supplied_by__code=district_code)
 
         count = hsas.count()
+        engine = ConsumptionEngine(run_record.start, run_record.end, BaseLevel.HSA) if bulk else None
         for i, hsa in enumerate(hsas):
             print("processing hsa %s (%s) (%s of %s)" % (
                 hsa.name, str(hsa.id), i+1, count
             ))
+            if engine:
+                engine.recompute(hsa)
+                continue
             clear_calculated_consumption(hsa)
             for year, month in months_between(run_record.start, run_record.end):
                 window_date = datetime(year, month, 1)
@@ -7,9 +7,9 @@ from rapidsms.models import Contact
 
 
 def below_location(location):
-    return {location.name: Q(supply_point__location=location) |
-                           Q(supply_point__supplied_by__location=location) | 
-                           Q(supply_point__supplied_by__supplied_by__location=location)}
+    # the supply point at the location, or up to two steps up the supply chain
+    return {location.name: Q(supply_point__ancestor_links__ancestor__location=location,
+                             supply_point__ancestor_links__depth__lte=2)}
 
 
 def by_district():
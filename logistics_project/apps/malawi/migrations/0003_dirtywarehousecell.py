@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0004_auto_20220505_1519'),
+        ('malawi', '0002_auto_20220308_1525'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyWarehouseCell',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateTimeField()),
+                ('created_at', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='logistics.Product')),
+                ('supply_point', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='logistics.SupplyPoint')),
+            ],
+        ),
+    ]
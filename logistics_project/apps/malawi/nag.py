@@ -3,16 +3,17 @@ from datetime import datetime, timedelta
 import logging
 import os
 from rapidsms.contrib.locations.models import Location
-from rapidsms.models import Contact
+from rapidsms.models import Contact, Connection
 from logistics.models import ProductReport, ProductReportType, SupplyPoint,\
     SupplyPointType, NagRecord, ContactRole, StockRequest, StockRequestStatus
-from rapidsms.contrib.messaging.utils import send_message
+from rapidsms.contrib.messaging.utils import send_messages
 from logistics.const import Reports
 from logistics.util import config, get_ussd_connection
 from logistics_project.apps.malawi.util import hsa_supply_points_below,\
     get_district_supply_points, get_imci_coordinators,\
     get_district_pharmacists
 import itertools
+from collections import defaultdict
 from logistics_project.apps.malawi.warehouse.models import Alert
 
 DAYS_BETWEEN_FIRST_AND_SECOND_WARNING = 3
@@ -30,12 +31,10 @@ def get_non_reporting_hsas(since, report_code=Reports.SOH, location=None):
     """
     Get all HSAs who haven't reported since a passed in date
     """
-    hsas = set(hsa_supply_points_below(location))
-    reporters = set(x.supply_point for x in \
-                    ProductReport.objects.filter(report_type__code=report_code,
-                                                 report_date__range=[since, datetime.utcnow()],
-                                                 supply_point__type__code=config.SupplyPointCodes.HSA))
-    return hsas - reporters
+    reporters = ProductReport.objects.filter(report_type__code=report_code,
+                                             report_date__range=[since, datetime.utcnow()],
+                                             supply_point__type__code=config.SupplyPointCodes.HSA)
+    return set(hsa_supply_points_below(location).exclude(pk__in=reporters.values('supply_point')))
 
 def get_hsa_stock_requests_pending_pickup(before=None):
     reqs = StockRequest.objects.filter(status=StockRequestStatus.APPROVED,
@@ -47,47 +46,63 @@ def get_hsa_stock_requests_pending_pickup(before=None):
 def get_hsas_pending_pickup(before=None):
     return set([x.supply_point for x in get_hsa_stock_requests_pending_pickup(before)])
                      
-def nag_hsas_soh(since, location=None):
+def _soh_warning_levels(since, location=None, now=None):
     """
-    Send non-reporting HSAs a predefined nag message.  
-    Notify their supervisor if they've been sufficiently delinquent.
+    The ids of the HSAs due their first, second and third stock on hand
+    nags: those who haven't reported since *since*, by the nags they have
+    had since then.
     """
-    # everyone who didn't report
-    hsas = get_non_reporting_hsas(since, Reports.SOH, location)
-    
-    nags_in_range = NagRecord.objects.filter\
-                        (report_date__range=[since, datetime.utcnow()],
-                         nag_type=Reports.SOH)
+    now = now or datetime.utcnow()
+    reporters = ProductReport.objects.filter(report_type__code=Reports.SOH,
+                                             report_date__range=[since, now],
+                                             supply_point__type__code=config.SupplyPointCodes.HSA)
+    hsas = hsa_supply_points_below(location).exclude(pk__in=reporters.values('supply_point'))
+    hsa_ids = set(hsas.values_list('pk', flat=True))
+
+    nags_in_range = defaultdict(set)
+    for supply_point_id, warning in NagRecord.objects.filter(
+            report_date__range=[since, now], nag_type=Reports.SOH,
+            supply_point__in=hsas.values('pk')).values_list('supply_point', 'warning'):
+        nags_in_range[supply_point_id].add(warning)
+
+    def _due(warning):
+        # everyone who hasn't gotten a nag at this level or higher, but has
+        # gotten the one before it (or hasn't been nagged at all, for the first)
+        due = set()
+        for hsa in hsa_ids:
+            nagged = nags_in_range[hsa]
+            previous = not nagged if warning == 1 else warning - 1 in nagged
+            if previous and max(nagged or [0]) < warning:
+                due.add(hsa)
+        return due
 
-    # empty init
     hsa_first_warnings = set(())
     hsa_second_warnings = set(())
     hsa_third_warnings = set(())
-    hsa_fourth_warnings = set(())
-    now = datetime.utcnow()
-    
+
     # only send nags if we're past the nag period
     if now > since + timedelta(days=WARNING_DAYS):
-        # everyone who didn't report - people who have gotten at least 1 nag in the period
-        hsa_first_warnings = hsas - set(x.supply_point for x in nags_in_range)
-        
+        hsa_first_warnings = _due(1)
     if now > since + timedelta(days=WARNING_DAYS + DAYS_BETWEEN_FIRST_AND_SECOND_WARNING):
-        # everyone who hasn't gotten a nag level 2 or higher, but has gotten a first
-        hsa_second_warnings = hsas.intersection(x.supply_point for x in \
-                                                nags_in_range.filter(warning=1)) - \
-                              set(x.supply_point for x in nags_in_range.filter(warning__gte=2))
-
+        hsa_second_warnings = _due(2)
     if now > since + timedelta(days=WARNING_DAYS + DAYS_BETWEEN_FIRST_AND_SECOND_WARNING +\
                                DAYS_BETWEEN_SECOND_AND_THIRD_WARNING):
-        # everyone who hasn't gotten a nag level 3 or higher, but has gotten a second.
-        hsa_third_warnings = hsas.intersection(x.supply_point for x in \
-                                               nags_in_range.filter(warning=2)) - \
-                             set(x.supply_point for x in nags_in_range.filter(warning__gte=3))
-    
+        hsa_third_warnings = _due(3)
+    return hsa_first_warnings, hsa_second_warnings, hsa_third_warnings
+
+
+def nag_hsas_soh(since, location=None, plan=None):
+    """
+    Send non-reporting HSAs a predefined nag message.
+    Notify their supervisor if they've been sufficiently delinquent.
+    """
+    hsa_first_warnings, hsa_second_warnings, hsa_third_warnings = \
+        _soh_warning_levels(since, location, plan.now if plan else None)
+
     # These should never fail.
     assert(hsa_first_warnings.intersection(hsa_second_warnings) == set())
     assert(hsa_second_warnings.intersection(hsa_third_warnings) == set())
-    
+
     warnings = [
             {'hsas': hsa_first_warnings,
              'number': 1,
@@ -109,48 +124,69 @@ def nag_hsas_soh(since, location=None):
              'flag_supervisor': True,
              'supervisor_message': config.Messages.HSA_SUPERVISOR_NAG}
             ]
-    
-    send_nag_messages(warnings)
 
-def nag_hsas_rec():
+    send_nag_messages(warnings, plan)
+
+
+def _rec_warning_levels(now=None):
     """
-    Send non-reporting HSAs a predefined nag message.  Notify their supervisor if they've been
-    sufficiently delinquent.
+    The ids of the HSAs due their first, second and third receipt nags:
+    those with an order ready for pick up that they haven't reported
+    receiving, by how long it has been ready and the nags they have had
+    since.
     """
-    now = datetime.utcnow()
-    
+    now = now or datetime.utcnow()
     # send the first nag WARNING_DAYS days after the order ready message
-    def _get_hsas_ready_for_nag(warning_time, extra_filter_params={}):
-        
-        reqs = get_hsa_stock_requests_pending_pickup(warning_time)
-
-        hsa_warnings = []
-        for req in reqs:
-            if not NagRecord.objects.filter(supply_point=req.supply_point,
-                                        report_date__range=[req.responded_on,now],
-                                        nag_type=Reports.REC,
-                                        **extra_filter_params).count():
-
-                if not ProductReport.objects.filter(supply_point=req.supply_point,
-                                                    report_type__code=Reports.REC,
-                                                    report_date__range=[req.responded_on, now]).exists():
-                    hsa_warnings.append(req.supply_point)
-        return set(hsa_warnings)
-        
     first_warning_time = now - timedelta(days=WARNING_DAYS)
-    hsa_first_warnings = _get_hsas_ready_for_nag(first_warning_time)
-    
     second_warning_time = first_warning_time - timedelta(days=REC_DAYS_BETWEEN_FIRST_AND_SECOND_WARNING)
-    hsa_second_warnings = _get_hsas_ready_for_nag(second_warning_time, 
-                                                  extra_filter_params={"warning__gte": 2}) \
-                                - hsa_first_warnings
-    
     third_warning_time = second_warning_time - timedelta(days=REC_DAYS_BETWEEN_SECOND_AND_THIRD_WARNING)
-    hsa_third_warnings = _get_hsas_ready_for_nag(third_warning_time, 
-                                                 extra_filter_params={"warning__gte": 3}) \
+
+    reqs = get_hsa_stock_requests_pending_pickup(first_warning_time)
+    pending = list(reqs.values_list('supply_point', 'responded_on'))
+    if not pending:
+        return set(), set(), set()
+    earliest = min(responded_on for supply_point_id, responded_on in pending)
+
+    nags = defaultdict(list)
+    for supply_point_id, report_date, warning in NagRecord.objects.filter(
+            supply_point__in=reqs.values('supply_point'), nag_type=Reports.REC,
+            report_date__range=[earliest, now]).values_list('supply_point', 'report_date', 'warning'):
+        nags[supply_point_id].append((report_date, warning))
+    receipts = defaultdict(list)
+    for supply_point_id, report_date in ProductReport.objects.filter(
+            supply_point__in=reqs.values('supply_point'), report_type__code=Reports.REC,
+            report_date__range=[earliest, now]).values_list('supply_point', 'report_date'):
+        receipts[supply_point_id].append(report_date)
+
+    def _get_hsas_ready_for_nag(warning_time, min_warning=1):
+        hsa_warnings = set()
+        for supply_point_id, responded_on in pending:
+            if responded_on > warning_time:
+                continue
+            if any(responded_on <= report_date <= now and warning >= min_warning
+                   for report_date, warning in nags[supply_point_id]):
+                continue
+            if any(responded_on <= report_date <= now for report_date in receipts[supply_point_id]):
+                continue
+            hsa_warnings.add(supply_point_id)
+        return hsa_warnings
+
+    hsa_first_warnings = _get_hsas_ready_for_nag(first_warning_time)
+    hsa_second_warnings = _get_hsas_ready_for_nag(second_warning_time, 2) \
+                                - hsa_first_warnings
+    hsa_third_warnings = _get_hsas_ready_for_nag(third_warning_time, 3) \
                                 - hsa_first_warnings - hsa_second_warnings
+    return hsa_first_warnings, hsa_second_warnings, hsa_third_warnings
 
 
+def nag_hsas_rec(plan=None):
+    """
+    Send non-reporting HSAs a predefined nag message.  Notify their supervisor if they've been
+    sufficiently delinquent.
+    """
+    hsa_first_warnings, hsa_second_warnings, hsa_third_warnings = \
+        _rec_warning_levels(plan.now if plan else None)
+
     warnings = [
             {'hsas': hsa_first_warnings,
              'number': 1,
@@ -173,47 +209,151 @@ def nag_hsas_rec():
              'flag_supervisor': True,
              'supervisor_message': config.Messages.HSA_RECEIPT_SUPERVISOR_NAG}
             ]
-    send_nag_messages(warnings)
-
-
-def send_nag_messages(warnings):
-    for w in warnings:
-        for hsa in w["hsas"]:
-            
-            previous_nags = NagRecord.objects.filter(supply_point=hsa, nag_type=w['code'])\
-                                .order_by('-report_date')
-            if previous_nags:
-                # don't nag anyone we've nagged for the same reason in the last 24 hours
-                last_nag_date = previous_nags[0].report_date
-                if datetime.utcnow() - last_nag_date < timedelta(hours=MIN_NAG_INTERVAL):
-                    continue 
-            try:
-                contact = Contact.objects.get(supply_point=hsa, is_active=True)
-                connection = get_ussd_connection(contact.default_connection)
-                send_message(connection, w["message"] % {'hsa': contact.name, 'days': w['days']})
-                NagRecord(supply_point=hsa, warning=w["number"],nag_type=w['code']).save()
-            except Contact.DoesNotExist:
-                # these warnings are no longer useful and clogging up the logs
-                # logging.warning("Contact does not exist for HSA: %s" % hsa.name)
-                continue
-            except Contact.MultipleObjectsReturned:
-                logging.warning("More than one active contact found for HSA: %s" % hsa.name)
-                continue
-            if w["flag_supervisor"]:
-                for supervisor in Contact.objects.filter(is_active=True,
-                                                         role=ContactRole.objects.get(code=config.Roles.HSA_SUPERVISOR),
-                                                         supply_point=hsa.supplied_by):
-                    send_message(supervisor.default_connection, w["supervisor_message"] % { 'hsa': contact.name})
-                
-
-def nag_hsas_ept():
+    send_nag_messages(warnings, plan)
+
+
+def _default_connections(contacts):
+    """
+    The equivalent of contact.default_connection for each of the contacts,
+    keyed by contact id.
+    """
+    connections = {}
+    for connection in Connection.objects.filter(contact__in=[c.pk for c in contacts])\
+            .select_related('backend', 'contact').order_by('pk'):
+        connections.setdefault(connection.contact_id, connection)
+    return connections
+
+
+class NagPlan(object):
+    """
+    The nags to send in a run, worked out for all the HSAs at once: who
+    was already nagged too recently, and the connections of the HSAs and
+    (where flagged) their supervisors.
+
+    Nothing is sent or recorded until NagPlan.send is called.
+    """
+
+    def __init__(self, now=None):
+        self.now = now or datetime.utcnow()
+        self.messages = []      # (connection, text)
+        self.nag_records = []
+        self.lines = []         # a description of each nag, for dry runs
+        self._planned = set()   # (supply point id, nag type)
+
+    def add(self, warnings):
+        hsa_ids = set()
+        for w in warnings:
+            w['hsas'] = set(getattr(hsa, 'pk', hsa) for hsa in w['hsas'])
+            hsa_ids.update(w['hsas'])
+        if not hsa_ids:
+            return
+
+        # don't nag anyone we've nagged for the same reason in the last 24 hours
+        recently_nagged = set(NagRecord.objects.filter(
+            supply_point__in=hsa_ids,
+            nag_type__in=set(w['code'] for w in warnings),
+            report_date__gt=self.now - timedelta(hours=MIN_NAG_INTERVAL),
+        ).values_list('supply_point', 'nag_type')) | self._planned
+
+        hsa_contacts = defaultdict(list)
+        for contact in Contact.objects.filter(supply_point__in=hsa_ids, is_active=True)\
+                .select_related('supply_point'):
+            hsa_contacts[contact.supply_point_id].append(contact)
+
+        # the supervisors of each of the HSAs whose nags are flagged to them
+        supervisors = defaultdict(list)
+        flagged = set().union(*[w['hsas'] for w in warnings if w['flag_supervisor']])
+        if flagged:
+            parents = dict(SupplyPoint.objects.filter(pk__in=flagged).values_list('pk', 'supplied_by'))
+            by_parent = defaultdict(list)
+            for supervisor in Contact.objects.filter(is_active=True,
+                                                     role__code=config.Roles.HSA_SUPERVISOR,
+                                                     supply_point__in=set(parents.values())):
+                by_parent[supervisor.supply_point_id].append(supervisor)
+            for hsa, parent_id in parents.items():
+                supervisors[hsa] = by_parent[parent_id]
+
+        connections = _default_connections(
+            [c for contacts in hsa_contacts.values() for c in contacts] +
+            [c for contacts in supervisors.values() for c in contacts])
+
+        for w in warnings:
+            for hsa in sorted(w['hsas']):
+                if (hsa, w['code']) in recently_nagged:
+                    continue
+                contacts = hsa_contacts[hsa]
+                if not contacts:
+                    # these warnings are no longer useful and clogging up the logs
+                    # logging.warning("Contact does not exist for HSA: %s" % hsa)
+                    continue
+                if len(contacts) > 1:
+                    logging.warning("More than one active contact found for HSA: %s" %
+                                    contacts[0].supply_point.name)
+                    continue
+                contact = contacts[0]
+                if contact.pk not in connections:
+                    logging.warning("No connection found for HSA: %s" % contact.name)
+                    continue
+
+                self.messages.append((get_ussd_connection(connections[contact.pk]),
+                                      w["message"] % {'hsa': contact.name, 'days': w['days']}))
+                self.nag_records.append(NagRecord(supply_point_id=hsa, warning=w["number"],
+                                                  nag_type=w['code'], report_date=self.now))
+                self._planned.add((hsa, w['code']))
+                self.lines.append("%s nag %s: %s (%s)" % (w['code'], w['number'], contact.name,
+                                                         contact.supply_point.code))
+                if w["flag_supervisor"]:
+                    for supervisor in supervisors[hsa]:
+                        if supervisor.pk in connections:
+                            self.messages.append((connections[supervisor.pk],
+                                                  w["supervisor_message"] % {'hsa': contact.name}))
+                            self.lines.append("    and supervisor %s" % supervisor.name)
+
+    def send(self):
+        """
+        Hand all the messages to the router in one batch, then record the nags.
+        """
+        send_messages(self.messages)
+        NagRecord.objects.bulk_create(self.nag_records)
+        self.messages = []
+        self.nag_records = []
+
+
+def send_nag_messages(warnings, plan=None):
+    """
+    Nag the HSAs (or supply point ids) in each of the warnings. With a
+    plan the nags are only added to it; otherwise they are sent right away.
+    """
+    if plan is not None:
+        plan.add(warnings)
+        return
+    plan = NagPlan()
+    plan.add(warnings)
+    plan.send()
+
+
+def nag_hsas(plan=None):
+    """
+    All the regular HSA nags, sent in one batch unless a plan is passed in.
+    """
+    send = plan is None
+    plan = plan or NagPlan()
+    nag_hsas_ept(plan)
+    nag_hsas_em(plan)
+    nag_hsas_rec(plan)
+    if send:
+        plan.send()
+    return plan
+
+
+def nag_hsas_ept(plan=None):
     # For the EPT group, nag them so that they report at least every 30 days
     since = datetime.utcnow() - timedelta(days=30-WARNING_DAYS)
     locs = [Location.objects.get(name=loc) for loc in config.Groups.GROUPS[config.Groups.EPT]]
     for l in locs:
-        nag_hsas_soh(since, l)
+        nag_hsas_soh(since, l, plan)
 
-def nag_hsas_em():
+def nag_hsas_em(plan=None):
     # For the EM group, nag them to report around a (configurable) day of month
     # We send nags at 9am UTC/11am malawi time
     since = datetime.utcnow().replace(day=EM_REPORTING_DAY,
@@ -228,15 +368,15 @@ def nag_hsas_em():
     
     locs = [Location.objects.get(name=loc) for loc in config.Groups.GROUPS[config.Groups.EM]]
     for l in locs:
-        nag_hsas_soh(since, l)
+        nag_hsas_soh(since, l, plan)
         
 def send_district_so_reminders():
-    for d in get_district_supply_points():
-        _send_so_notice(d)
+    send_messages(itertools.chain.from_iterable(
+        _so_notices(d) for d in get_district_supply_points()))
         
 def send_district_eo_reminders():
-    for d in get_district_supply_points():
-        _send_eo_notice(d)
+    send_messages(itertools.chain.from_iterable(
+        _eo_notices(d) for d in get_district_supply_points()))
         
 def _district_contacts(district):
     all = itertools.chain(get_imci_coordinators(district),
@@ -245,14 +385,14 @@ def _district_contacts(district):
         if c.default_connection:
             yield c
     
-def _send_eo_notice(district):        
+def _eo_notices(district):        
     relevant_alert = Alert.objects.get(supply_point=district)
     msg = config.Messages.DISTRICT_NAG_EO % {"pct": relevant_alert.eo_without_resupply }
-    for contact in _district_contacts(district):
-        send_message(get_ussd_connection(contact.default_connection), msg)
+    return [(get_ussd_connection(contact.default_connection), msg)
+            for contact in _district_contacts(district)]
     
-def _send_so_notice(district):
+def _so_notices(district):
     relevant_alert = Alert.objects.get(supply_point=district)
     msg = config.Messages.DISTRICT_NAG_SO % {"pct": relevant_alert.have_stockouts }
-    for contact in _district_contacts(district):
-        send_message(get_ussd_connection(contact.default_connection), msg)
+    return [(get_ussd_connection(contact.default_connection), msg)
+            for contact in _district_contacts(district)]
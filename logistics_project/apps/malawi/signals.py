@@ -2,10 +2,17 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from datetime import datetime
+
 from django.db import transaction
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from rapidsms.models import Contact
+from rapidsms.contrib.locations.models import Location
+from logistics.models import ProductReport, StockTransaction, StockRequest, ProductStock, \
+    Product, ProductType, SupplyPoint
+from logistics.signals import stock_reports_saved, stock_requests_saved
 from static.malawi.config import SupplyPointCodes
+from logistics_project.apps.malawi.warehouse.models import DirtyWarehouseCell
 
 
 @transaction.atomic
@@ -31,3 +38,100 @@ def deactivate_hsa_location(sender, instance, created, **kwargs):
                 sp.location.save()
 
 post_save.connect(deactivate_hsa_location, sender=Contact)
+
+
+def mark_product_report_dirty(sender, instance, created, **kwargs):
+    if getattr(instance, '_batched', False):
+        # marked along with the rest of its batch, in mark_stock_reports_dirty
+        return
+    DirtyWarehouseCell.mark(instance.supply_point_id, instance.product_id, instance.report_date)
+
+
+def mark_stock_transaction_dirty(sender, instance, created, **kwargs):
+    if created:
+        DirtyWarehouseCell.mark(instance.supply_point_id, instance.product_id, instance.date)
+
+
+def _request_changed_on(request):
+    # requests are saved whenever their status changes, and the latest
+    # of these dates is the one that just changed
+    return max(d for d in (request.requested_on, request.responded_on, request.received_on) if d)
+
+
+def mark_stock_request_dirty(sender, instance, created, **kwargs):
+    DirtyWarehouseCell.mark(instance.supply_point_id, instance.product_id,
+                            _request_changed_on(instance))
+
+
+def mark_product_stock_dirty(sender, instance, created, **kwargs):
+    # covers products being added to or removed from a supply point,
+    # which changes what it manages
+    DirtyWarehouseCell.mark(instance.supply_point_id, instance.product_id, datetime.utcnow())
+
+post_save.connect(mark_product_report_dirty, sender=ProductReport)
+post_save.connect(mark_stock_transaction_dirty, sender=StockTransaction)
+post_save.connect(mark_stock_request_dirty, sender=StockRequest)
+post_save.connect(mark_product_stock_dirty, sender=ProductStock)
+
+
+def invalidate_alerts(supply_point_ids):
+    # imported here since the alerts pull in most of the app
+    from logistics_project.apps.malawi.alerts import invalidate_alert_cache
+    # only once the change is committed, or a dashboard loading in the
+    # meantime would cache the old alerts under the new version
+    transaction.on_commit(lambda: invalidate_alert_cache(supply_point_ids))
+
+
+def invalidate_stock_alerts(sender, instance, **kwargs):
+    invalidate_alerts([instance.supply_point_id])
+
+
+def invalidate_commodity_alerts(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        supply_point_ids = [instance.supply_point_id]
+    elif pk_set:
+        supply_point_ids = list(Contact.objects.filter(pk__in=pk_set)
+                                .values_list('supply_point', flat=True))
+    else:
+        # a product's contacts were cleared, and which they were is gone
+        supply_point_ids = None
+    invalidate_alerts(supply_point_ids)
+
+for model in (StockRequest, ProductStock):
+    post_save.connect(invalidate_stock_alerts, sender=model)
+    post_delete.connect(invalidate_stock_alerts, sender=model)
+m2m_changed.connect(invalidate_commodity_alerts, sender=Contact.commodities.through)
+
+
+def mark_stock_reports_dirty(sender, supply_point, transactions, product_stocks, **kwargs):
+    # a batch of reports saves its transactions and stocks without their
+    # post_save signals, so this does what those would have done (the
+    # transactions have the same months as the reports)
+    now = datetime.utcnow()
+    DirtyWarehouseCell.mark_many(
+        [(st.supply_point_id, st.product_id, st.date) for st in transactions] +
+        [(ps.supply_point_id, ps.product_id, now) for ps in product_stocks])
+    invalidate_alerts([supply_point.pk])
+
+stock_reports_saved.connect(mark_stock_reports_dirty)
+
+
+def mark_stock_requests_dirty(sender, supply_point, requests, **kwargs):
+    # the same for requests created, received or canceled in bulk
+    DirtyWarehouseCell.mark_many([(r.supply_point_id, r.product_id, _request_changed_on(r))
+                                  for r in requests])
+    invalidate_alerts(set(r.supply_point_id for r in requests))
+
+stock_requests_saved.connect(mark_stock_requests_dirty)
+
+
+def invalidate_reference_data(sender, **kwargs):
+    # imported here like the alerts, to keep the warehouse views out of startup
+    from logistics_project.apps.malawi.warehouse.reference import invalidate_reference_data
+    invalidate_reference_data(sender, **kwargs)
+
+for model in (Product, ProductType, SupplyPoint, Location):
+    post_save.connect(invalidate_reference_data, sender=model)
+    post_delete.connect(invalidate_reference_data, sender=model)
@@ -1,7 +1,11 @@
 from __future__ import unicode_literals
+from logistics_project.apps.malawi.tests.alerts import *
 from logistics_project.apps.malawi.tests.approval import *
 from logistics_project.apps.malawi.tests.boot import *
+from logistics_project.apps.malawi.tests.breakdown import *
+from logistics_project.apps.malawi.tests.closure import *
 from logistics_project.apps.malawi.tests.createuser import *
+from logistics_project.apps.malawi.tests.export import *
 from logistics_project.apps.malawi.tests.nag import *
 from logistics_project.apps.malawi.tests.product import *
 from logistics_project.apps.malawi.tests.receipts import *
@@ -11,3 +15,9 @@ from logistics_project.apps.malawi.tests.roles import *
 from logistics_project.apps.malawi.tests.stockonhand import *
 from logistics_project.apps.malawi.tests.transfer import *
 from logistics_project.apps.malawi.tests.warehouse.consumption import *
+from logistics_project.apps.malawi.tests.warehouse.bulk import *
+from logistics_project.apps.malawi.tests.warehouse.parallel import *
+from logistics_project.apps.malawi.tests.warehouse.rollup import *
+from logistics_project.apps.malawi.tests.warehouse.incremental import *
+from logistics_project.apps.malawi.tests.warehouse.cells import *
+from logistics_project.apps.malawi.tests.warehouse.reference import *
@@ -0,0 +1,109 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from django.conf.urls import url
+from django.db import transaction
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from logistics.models import Product, ProductStock, StockRequest, StockRequestStatus, \
+    SupplyPoint
+from logistics_project.apps.malawi.alerts import hsa_below_emergency_quantity, \
+    health_center_unable_resupply_stockout, hsas_no_products, invalidate_alert_cache
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa
+
+# the alerts link to the HSA and facility pages, which the malawi urls
+# don't currently have
+urlpatterns = [
+    url(r'^hsa/(?P<code>\w+)/$', HttpResponse, name="malawi_hsa"),
+    url(r'^facility/(?P<code>\w+)/$', HttpResponse, name="malawi_facility"),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TestAlerts(MalawiTestBase):
+
+    def setUp(self):
+        super(TestAlerts, self).setUp()
+        self.wendy = create_hsa(self, "+16175551000", "wendy", products="la zi")
+        self.steve = create_hsa(self, "+16175551001", "steve", id="2", products="zi")
+        self.zi = Product.objects.get(sms_code="zi")
+        self.la = Product.objects.get(sms_code="la")
+        Product.objects.filter(pk=self.zi.pk).update(emergency_order_level=10)
+        Product.objects.filter(pk=self.la.pk).update(emergency_order_level=None)
+        for hsa, product, quantity in [(self.wendy, self.zi, 5), (self.wendy, self.la, 0),
+                                       (self.steve, self.zi, 5)]:
+            ps = ProductStock.objects.get(supply_point=hsa.supply_point, product=product)
+            ps.quantity = quantity
+            ps.save()
+        self._request(self.steve, self.zi, StockRequestStatus.REQUESTED)
+
+    def _request(self, hsa, product, status):
+        return StockRequest.objects.create(product=product, supply_point=hsa.supply_point,
+                                           status=status, requested_on=datetime.utcnow(),
+                                           amount_requested=10)
+
+    def _get(self, generator, place=None):
+        request = RequestFactory().get("/", {"place": place} if place else {})
+        request.session = {}
+        return generator(request)
+
+    def testBelowEmergencyQuantity(self):
+        alerts = self._get(hsa_below_emergency_quantity)
+        self.assertEqual([(self.wendy.supply_point, self.zi)],
+                         [(a.supply_point, a.product) for a in alerts])
+
+        # the alerts are cached
+        with self.assertNumQueries(0):
+            self.assertEqual([a.text for a in alerts],
+                             [a.text for a in self._get(hsa_below_emergency_quantity)])
+
+        # until a request is made
+        self._request(self.wendy, self.zi, StockRequestStatus.REQUESTED)
+        self.assertEqual([], self._get(hsa_below_emergency_quantity))
+
+    def testInvalidatedPerLocation(self):
+        self.steve.supply_point.supplied_by = SupplyPoint.objects.get(code="2601")
+        self.steve.supply_point.save()
+        wendys = self.wendy.supply_point.supplied_by.location.code
+        steves = self.steve.supply_point.supplied_by.location.code
+        for place in (wendys, steves, None):
+            self._get(hsa_below_emergency_quantity, place)
+
+        # a change at wendy's facility leaves the alerts of steve's cached...
+        self._request(self.wendy, self.zi, StockRequestStatus.REQUESTED)
+        with self.assertNumQueries(2):
+            # (looking up the place)
+            self._get(hsa_below_emergency_quantity, steves)
+        # ...but not those of hers or of the whole country
+        self.assertEqual([], self._get(hsa_below_emergency_quantity, wendys))
+        self.assertEqual([], self._get(hsa_below_emergency_quantity))
+
+    def testInvalidatedOnCommit(self):
+        self.assertEqual(1, len(self._get(hsa_below_emergency_quantity)))
+        with transaction.atomic():
+            self._request(self.wendy, self.zi, StockRequestStatus.REQUESTED)
+            with self.assertNumQueries(0):
+                self.assertEqual(1, len(self._get(hsa_below_emergency_quantity)))
+        self.assertEqual([], self._get(hsa_below_emergency_quantity))
+
+    def testQueriesDontDependOnHSAs(self):
+        invalidate_alert_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(1, len(self._get(hsa_below_emergency_quantity)))
+        self._request(self.wendy, self.la, StockRequestStatus.STOCKED_OUT)
+        self._request(self.steve, self.la, StockRequestStatus.STOCKED_OUT)
+        with self.assertNumQueries(1):
+            alerts = self._get(health_center_unable_resupply_stockout)
+        # steve doesn't have a ProductStock for la, which counts as stocked out
+        self.assertEqual(sorted([(self.wendy.supply_point.pk, self.la.pk),
+                                 (self.steve.supply_point.pk, self.la.pk)]),
+                         sorted((a.supply_point.pk, a.product.pk) for a in alerts))
+
+    def testNoProducts(self):
+        create_hsa(self, "+16175551002", "nancy", id="3")
+        self.assertEqual(["nancy"], [a.text.split()[0] for a in self._get(hsas_no_products)
+                                     if "nancy" in a.text or "wendy" in a.text or "steve" in a.text])
+        self.steve.commodities.clear()
+        self.assertEqual(2, len([a for a in self._get(hsas_no_products)
+                                 if "nancy" in a.text or "steve" in a.text]))
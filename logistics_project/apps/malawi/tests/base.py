@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 from django.conf import settings
+from django.core.cache import cache
 from rapidsms.tests.scripted import TestScript
 from logistics_project.apps.malawi.loader import load_static_data_for_tests
 from logistics_project.apps.malawi.management.commands.create_epi_products import create_or_update_epi_products
@@ -45,6 +46,9 @@ class MalawiTestBase(OutputtingTestScript):
     
     def setUp(self):
         super(MalawiTestBase, self).setUp()
+        # the database is rolled back between tests, so nothing cached
+        # about it (e.g. recent messages) still holds
+        cache.clear()
         load_static_data_for_tests()
         create_or_update_epi_products()
         settings.LOGISTICS_APPROVAL_REQUIRED = False
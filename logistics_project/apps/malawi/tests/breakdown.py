@@ -0,0 +1,89 @@
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+from logistics.const import Reports
+from logistics.models import Product, ProductReport, ProductReportType, StockRequest, \
+    StockRequestStatus, SupplyPoint
+from logistics.reports import ReportingBreakdown
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa
+from logistics_project.utils.dates import DateSpan
+
+
+class TestReportingBreakdown(MalawiTestBase):
+
+    def setUp(self):
+        super(TestReportingBreakdown, self).setUp()
+        self.wendy = create_hsa(self, "+16175551000", "wendy", products="la zi")
+        self.steve = create_hsa(self, "+16175551001", "steve", id="2", products="zi")
+        self.bob = create_hsa(self, "+16175551002", "bob", id="3", products="la zi")
+        self.zi = Product.objects.get(sms_code="zi")
+        self.la = Product.objects.get(sms_code="la")
+        self.end = datetime(2012, 3, 31)
+        self.start = self.end - timedelta(days=30)
+        self.datespan = DateSpan(self.start, self.end)
+        # clear out the reports from registering
+        ProductReport.objects.all().delete()
+        StockRequest.objects.all().delete()
+
+    def _report(self, hsa, product, quantity, days, code=Reports.SOH):
+        ProductReport.objects.create(supply_point=hsa.supply_point, product=product,
+                                     report_type=ProductReportType.objects.get(code=code),
+                                     quantity=quantity, report_date=self.start + timedelta(days=days))
+
+    def _request(self, hsa, product, requested, received, days, is_emergency=False):
+        StockRequest.objects.create(supply_point=hsa.supply_point, product=product,
+                                    status=StockRequestStatus.RECEIVED, is_emergency=is_emergency,
+                                    requested_on=self.start + timedelta(days=days),
+                                    received_on=self.start + timedelta(days=days + 2),
+                                    amount_requested=requested, amount_received=received)
+
+    def _breakdown(self):
+        return ReportingBreakdown(SupplyPoint.objects.filter(type__code="hsa"),
+                                  self.datespan, include_late=True, MNE=True)
+
+    def testBreakdown(self):
+        # stocked out of zi since last period, until the 10th day
+        self._report(self.wendy, self.zi, 0, -5)
+        self._report(self.wendy, self.zi, 5, 10)
+        # stocked out of la from the 19th day into the next period
+        self._report(self.wendy, self.la, 4, 2)
+        self._report(self.wendy, self.la, 0, 19)
+        self._report(self.wendy, self.la, 3, 35)
+        # a stockout that isn't known to have ended
+        self._report(self.steve, self.zi, 0, 8)
+        self._report(self.bob, self.zi, 6, 8)
+        self._request(self.wendy, self.zi, 10, 5, 3, is_emergency=True)
+        self._request(self.steve, self.zi, 10, 10, 4)
+        self._request(self.bob, self.zi, 10, 9, 5)
+
+        breakdown = self._breakdown()
+        wendy, steve, bob = [hsa.supply_point for hsa in (self.wendy, self.steve, self.bob)]
+        self.assertEqual(set([wendy, steve, bob]), set(breakdown.reported))
+        self.assertEqual(set([wendy, steve]), set(breakdown.full))
+        self.assertEqual([bob], list(breakdown.partial))
+        self.assertEqual([], breakdown.unconfigured)
+        self.assertEqual(set([steve, bob]), set(breakdown.reported_late))
+
+        self.assertEqual(set([wendy.pk, steve.pk]), set(breakdown.stockouts))
+        self.assertEqual(set([wendy.pk]), breakdown.stockouts_emergency)
+        self.assertEqual({"la": 1, "zi": 1}, breakdown.stockouts_p)
+        self.assertEqual({"la": 0, "zi": 2}, breakdown.no_stockouts_p)
+        self.assertEqual({"la": 1, "zi": 3}, breakdown.totals_p)
+        self.assertEqual({"la": [11 * 86400], "zi": [10 * 86400]}, breakdown.stockouts_duration_p)
+
+        self.assertEqual({"zi": 1}, breakdown.discrepancies_p)
+        self.assertEqual({"zi": 6}, breakdown.discrepancies_tot_p)
+        self.assertEqual({"zi": 6}, breakdown.discrepancies_avg_p)
+        self.assertEqual({"zi": 3}, breakdown.filled_orders_p)
+        self.assertEqual([2 * 86400] * 3, breakdown.req_times)
+
+    def testQueriesDontGrowWithSupplyPoints(self):
+        self._report(self.wendy, self.zi, 0, 5)
+        self._report(self.steve, self.zi, 0, 5)
+        self._breakdown()
+        with self.assertNumQueries(11):
+            self._breakdown()
+        self._report(self.bob, self.zi, 0, 5)
+        self._report(self.bob, self.la, 0, 6)
+        with self.assertNumQueries(11):
+            self._breakdown()
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from logistics.models import SupplyPoint, SupplyPointClosure, supply_point_closure
+from logistics.util import config
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa
+from logistics_project.apps.malawi.util import hsa_supply_points_below, hsas_below, \
+    facility_supply_points_below
+from rapidsms.contrib.locations.models import Location, location_closure
+
+
+def _walk_descendants(location):
+    # the old recursive get_descendants
+    pks = []
+    for child in Location.objects.filter(parent_id=location.pk, is_active=True):
+        pks.append(child.pk)
+        pks.extend(_walk_descendants(child))
+    return set(pks)
+
+
+class TestClosure(MalawiTestBase):
+
+    def setUp(self):
+        super(TestClosure, self).setUp()
+        self.wendy = create_hsa(self, "+16175551000", "wendy", products="la zi")
+        self.steve = create_hsa(self, "+16175551001", "steve", id="2", facility_code="2601",
+                                products="zi")
+        self.hsa = self.wendy.supply_point
+        self.facility = self.hsa.supplied_by
+        self.district = self.facility.supplied_by
+
+    def testConsistent(self):
+        self.assertEqual(([], []), supply_point_closure.check())
+        self.assertEqual(([], []), location_closure.check())
+        self.assertEqual([self.facility, self.district, self.district.supplied_by],
+                         list(supply_point_closure.ancestors(self.hsa))[:3])
+        call_command("rebuild_closures", "--check")
+
+    def testBelow(self):
+        for location in (self.hsa.location, self.facility.location, self.district.location,
+                         self.district.supplied_by.location):
+            self.assertIn(self.hsa, hsa_supply_points_below(location))
+            self.assertIn(self.wendy, hsas_below(location))
+        self.assertEqual([self.steve.supply_point],
+                         list(hsa_supply_points_below(self.steve.supply_point.supplied_by.location)))
+        self.assertIn(self.facility, facility_supply_points_below(self.district.location))
+        self.assertNotIn(self.facility, facility_supply_points_below(self.facility.location)
+                         .exclude(pk=self.facility.pk))
+
+        country = SupplyPoint.objects.get(type=config.SupplyPointCodes.COUNTRY)
+        self.assertEqual(set(SupplyPoint.objects.filter(
+            type=config.SupplyPointCodes.FACILITY, active=True,
+            supplied_by__supplied_by__supplied_by__location=country.location)),
+            set(facility_supply_points_below(country.location)))
+
+    def testMoves(self):
+        other = SupplyPoint.objects.filter(type=config.SupplyPointCodes.DISTRICT)\
+            .exclude(pk=self.district.pk)[0]
+        self.facility.supplied_by = other
+        self.facility.save()
+        self.assertEqual(([], []), supply_point_closure.check())
+        self.assertIn(self.hsa, hsa_supply_points_below(other.location))
+        self.assertNotIn(self.hsa, hsa_supply_points_below(self.district.location))
+
+        # a loop is left out, rather than followed forever
+        other.supplied_by = self.hsa
+        other.save()
+        self.assertEqual(0, SupplyPointClosure.objects.filter(descendant=self.hsa,
+                                                              ancestor=self.hsa, depth__gt=0).count())
+
+        # updates that skip the signals show up in the check, and a rebuild fixes them
+        SupplyPoint.objects.filter(pk=other.pk).update(supplied_by=self.district.supplied_by)
+        missing, extra = supply_point_closure.check()
+        self.assertTrue(missing)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_closures", "--check")
+        call_command("rebuild_closures")
+        self.assertEqual(([], []), supply_point_closure.check())
+
+    def testLocationDescendants(self):
+        district = self.district.location
+        self.assertEqual(_walk_descendants(district),
+                         set(district.get_descendants().values_list('pk', flat=True)))
+        self.assertEqual(_walk_descendants(district) | set([district.pk]),
+                         set(district.get_descendants(include_self=True).values_list('pk', flat=True)))
+
+        # nothing below an inactive location
+        facility = self.facility.location
+        facility.deprecate()
+        self.assertTrue(_walk_descendants(facility))
+        descendants = set(district.get_descendants().values_list('pk', flat=True))
+        self.assertEqual(_walk_descendants(district), descendants)
+        self.assertFalse(_walk_descendants(facility) & descendants)
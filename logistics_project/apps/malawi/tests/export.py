@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+import csv
+import io
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.urls import reverse
+from logistics.const import Reports
+from logistics.export import csv_response, iterate
+from logistics.models import Product, ProductReportType, StockRequest, StockRequestStatus
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa
+from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityData
+
+
+class TestExports(MalawiTestBase):
+
+    def setUp(self):
+        super(TestExports, self).setUp()
+        self.hsa = create_hsa(self, "+16175551000", "wendy", products="la zi").supply_point
+        self.zi = Product.objects.get(sms_code="zi")
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "export.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TestExports, self).tearDown()
+
+    def _rows(self):
+        with open(self.filename, newline='') as f:
+            return list(csv.reader(f))
+
+    def testRawStockRequests(self):
+        StockRequest.objects.all().delete()
+        StockRequest.objects.create(supply_point=self.hsa, product=self.zi,
+                                    status=StockRequestStatus.REQUESTED,
+                                    requested_on=datetime(2012, 3, 1, 8, 30))
+        call_command("export_raw_stock_request_data", self.filename)
+        header, row = self._rows()
+        self.assertEqual(['district', 'facility', 'hsa name'], header[:3])
+        self.assertEqual([self.hsa.supplied_by.supplied_by.name, self.hsa.supplied_by.name,
+                          self.hsa.name, self.hsa.code, StockRequestStatus.REQUESTED,
+                          '2012-03-01 08:30:00', '', '', self.zi.name], row)
+
+    def testIterateInChunks(self):
+        StockRequest.objects.all().delete()
+        for day in (3, 1, 2, 1, 3):
+            for product in Product.objects.all()[:2]:
+                StockRequest.objects.create(supply_point=self.hsa, product=product,
+                                            status=StockRequestStatus.REQUESTED,
+                                            requested_on=datetime(2012, 3, day))
+        # foreign keys are ordered by id rather than the related model's ordering
+        for ordering, by in [(['requested_on', 'product'], ['requested_on', 'product_id', 'pk']),
+                             (['-requested_on'], ['-requested_on', 'pk']), ([], ['pk'])]:
+            requests = StockRequest.objects.order_by(*ordering).values_list('pk', 'requested_on')
+            expected = list(requests.order_by(*by))
+            self.assertEqual(10, len(expected))
+            for chunk_size in (1, 3, 10):
+                self.assertEqual(expected, list(iterate(requests, chunk_size=chunk_size)))
+
+    def testStockoutPeriods(self):
+        soh = ProductReportType.objects.get(code=Reports.SOH)
+        for quantity in (10, 0, 0, 5, 0):
+            self.hsa.report(self.zi, soh, quantity)
+        call_command("export_stockout_periods", self.filename)
+        rows = [row for row in self._rows()[1:] if row[0] == self.zi.name]
+        # the stockout that ended (one still going on with the last of all
+        # the transactions isn't written out)
+        self.assertEqual([['False', self.hsa.code]], [[row[7], row[4]] for row in rows])
+        self.assertEqual(self.hsa.supplied_by.supplied_by.name, rows[0][1])
+
+    def testStockStatusPercentages(self):
+        facility = self.hsa.supplied_by
+        ProductAvailabilityData.objects.create(supply_point=facility, product=self.zi,
+                                               date=datetime(2012, 2, 1), managed=4,
+                                               managed_and_without_stock=1, managed_and_good_stock=3)
+        with redirect_stdout(io.StringIO()):
+            call_command("export_stock_status_percentages", self.filename)
+        rows = self._rows()
+        self.assertEqual(2, len(rows))
+        self.assertEqual(['2012-02-01 00:00:00', facility.type.name, facility.supplied_by.name,
+                          facility.name, facility.code, self.zi.name, '4', '1', '0', '3', '0', '0'],
+                         rows[1][:12])
+
+    def testAmc(self):
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        response = self.client.get(reverse('export_amc_csv'), {'from': '2012-01-01', 'to': '2012-02-28'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(['Year', 'Month'], rows[0][:2])
+        self.assertEqual([['2012', '1'], ['2012', '2']], [row[:2] for row in rows[1:]])
+
+    def testStreamingResponse(self):
+        response = csv_response('test.csv', ['a', 'b'], iter([[1, 2], [3, 'x,y']]))
+        self.assertEqual('attachment; filename=test.csv', response['Content-Disposition'])
+        self.assertEqual(b'a,b\r\n1,2\r\n3,"x,y"\r\n', b''.join(response.streaming_content))
@@ -60,3 +60,71 @@
 #        return create_hsa(self, "16175551000", "wendy")
 #
 #        
+
+from datetime import datetime, timedelta
+from logistics.models import NagRecord, StockRequest, StockRequestStatus, Product
+from logistics.const import Reports
+from static.malawi.config import Messages
+from logistics_project.apps.malawi.nag import NagPlan, nag_hsas_soh, nag_hsas_rec
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa, create_manager
+
+
+class TestNagPlan(MalawiTestBase):
+
+    def setUp(self):
+        super(TestNagPlan, self).setUp()
+        self.wendy = create_hsa(self, "+16175551000", "wendy")
+        self.steve = create_hsa(self, "+16175551001", "steve", id="2")
+        self.sally = create_manager(self, "+16175551002", "sally", role="sh")
+        self.now = datetime.utcnow()
+
+    def _sent(self, plan):
+        return [(connection.identity, text) for connection, text in plan.messages]
+
+    def testSohNags(self):
+        NagRecord.objects.create(supply_point=self.wendy.supply_point, warning=2,
+                                 nag_type=Reports.SOH, report_date=self.now - timedelta(days=3))
+        plan = NagPlan(self.now)
+        nag_hsas_soh(self.now - timedelta(days=10), plan=plan)
+
+        sent = self._sent(plan)
+        self.assertIn(("+16175551001", Messages.HSA_NAG_FIRST % {"hsa": "steve", "days": 1}), sent)
+        self.assertIn(("+16175551000", Messages.HSA_NAG_THIRD % {"hsa": "wendy", "days": 2}), sent)
+        self.assertIn(("+16175551002", Messages.HSA_SUPERVISOR_NAG % {"hsa": "wendy"}), sent)
+        self.assertEqual(3, len(sent))
+        self.assertEqual(
+            [(self.wendy.supply_point_id, 3), (self.steve.supply_point_id, 1)],
+            sorted([(r.supply_point_id, r.warning) for r in plan.nag_records], key=lambda r: -r[1]))
+        # nothing is recorded until the plan is sent
+        self.assertEqual(1, NagRecord.objects.count())
+
+        # the same nags aren't planned twice
+        nag_hsas_soh(self.now - timedelta(days=10), plan=plan)
+        self.assertEqual(3, len(plan.messages))
+
+    def testRecentlyNagged(self):
+        NagRecord.objects.create(supply_point=self.steve.supply_point, warning=1,
+                                 nag_type=Reports.SOH, report_date=self.now - timedelta(hours=2))
+        plan = NagPlan(self.now)
+        nag_hsas_soh(self.now - timedelta(hours=30), plan=plan)
+        self.assertEqual([("+16175551000", Messages.HSA_NAG_FIRST % {"hsa": "wendy", "days": 1})],
+                         self._sent(plan))
+
+    def testRecNags(self):
+        for hsa in (self.wendy, self.steve):
+            StockRequest.objects.create(product=Product.objects.get(sms_code="zi"),
+                                        supply_point=hsa.supply_point,
+                                        status=StockRequestStatus.APPROVED,
+                                        requested_on=self.now - timedelta(days=6),
+                                        responded_on=self.now - timedelta(days=5),
+                                        amount_requested=10)
+        NagRecord.objects.create(supply_point=self.wendy.supply_point, warning=1,
+                                 nag_type=Reports.REC, report_date=self.now - timedelta(days=4))
+        plan = NagPlan(self.now)
+        nag_hsas_rec(plan=plan)
+        self.assertEqual(sorted([
+            ("+16175551001", Messages.HSA_RECEIPT_NAG_FIRST % {"hsa": "steve", "days": 0}),
+            ("+16175551000", Messages.HSA_RECEIPT_NAG_SECOND % {"hsa": "wendy", "days": 3}),
+            ("+16175551002", Messages.HSA_RECEIPT_SUPERVISOR_NAG % {"hsa": "wendy"}),
+        ]), sorted(self._sent(plan)))
@@ -1,5 +1,8 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
+from datetime import datetime, timedelta
+from django.conf import settings
+from rapidsms.contrib.messagelog.models import Message
 from logistics.models import ProductStock, SupplyPoint, ProductReport, Product
 from logistics_project.apps.malawi.tests.util import create_hsa
 from logistics_project.apps.malawi.tests.base import MalawiTestBase
@@ -54,6 +57,19 @@ class MalawiTestReceipts(MalawiTestBase):
         self.assertEqual(100, zi.quantity)
         self.assertEqual(200, la.quantity)
 
+    def testReceiptsOldDupesAccepted(self):
+        create_hsa(self, "+16175551000", "wendy", products="co la lb zi")
+        c = """
+           +16175551000 > rec zi 100 la 200
+           +16175551000 < Thank you, you reported receipts for la zi.
+        """
+        self.runScript(c)
+        # only copies sent within LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN count
+        Message.objects.filter(direction="I").update(
+            date=datetime.utcnow() - timedelta(seconds=settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN + 60))
+        self.runScript(c)
+        self.assertEqual(4, ProductReport.objects.count())
+
     def testFacilityLevelProduct(self):
         create_hsa(self, "+16175551000", "wendy", products="co la lb zi")
         product_code = Product.objects.filter(type__base_level=config.BaseLevel.FACILITY)[0].sms_code
@@ -0,0 +1,114 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from logistics.models import Product, ProductReportType, StockRequest, \
+    StockRequestStatus, SupplyPoint
+from logistics.const import Reports
+from static.malawi.config import BaseLevel
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa
+from logistics_project.apps.malawi.warehouse.bulk import BulkBaseLevelUpdater
+from logistics_project.apps.malawi.warehouse.models import ReportingRate,\
+    ProductAvailabilityData, ProductAvailabilityDataSummary, TimeTracker, \
+    OrderRequest, OrderFulfillment, CalculatedConsumption, CurrentConsumption, \
+    HistoricalStock
+from logistics_project.apps.malawi.warehouse.runner import MalawiWarehouseRunner, \
+    get_products
+
+WAREHOUSE_MODELS = [ReportingRate, ProductAvailabilityData, ProductAvailabilityDataSummary,
+                    TimeTracker, OrderRequest, OrderFulfillment, CalculatedConsumption,
+                    CurrentConsumption, HistoricalStock]
+
+
+class WarehouseDataTestBase(MalawiTestBase):
+    """
+    Sets up a couple of HSAs with a few months of reports and requests.
+    """
+    start = datetime(2012, 6, 1)
+    end = datetime(2012, 10, 15)
+
+    def setUp(self):
+        super(WarehouseDataTestBase, self).setUp()
+        create_hsa(self, "+16175551000", "wendy", id="1", products="la zi")
+        create_hsa(self, "+16175551001", "steve", id="2", products="zi")
+        self.hsas = list(SupplyPoint.objects.filter(contact__name__in=["wendy", "steve"]).order_by('id'))
+        SupplyPoint.objects.filter(pk__in=[h.pk for h in self.hsas]).update(created_at=datetime(2012, 5, 1))
+        self.hsas = list(SupplyPoint.objects.filter(pk__in=[h.pk for h in self.hsas]).order_by('id'))
+        soh = ProductReportType.objects.get(code=Reports.SOH)
+        rec = ProductReportType.objects.get(code=Reports.REC)
+        zi = Product.objects.get(sms_code="zi")
+        la = Product.objects.get(sms_code="la")
+        wendy, steve = self.hsas
+        for sp, product, report_type, quantity, date in [
+            (wendy, zi, soh, 100, datetime(2012, 5, 20)),
+            (wendy, zi, soh, 70, datetime(2012, 6, 5)),
+            (wendy, zi, soh, 0, datetime(2012, 7, 3)),
+            (wendy, zi, rec, 80, datetime(2012, 7, 20)),
+            (wendy, zi, soh, 55, datetime(2012, 9, 1)),
+            (wendy, la, soh, 30, datetime(2012, 6, 10)),
+            (wendy, la, soh, 5, datetime(2012, 8, 12)),
+            (steve, zi, soh, 10, datetime(2012, 6, 1)),
+            (steve, zi, soh, 3, datetime(2012, 10, 2)),
+        ]:
+            sp.report(product, report_type, quantity, date=date)
+        for sp, product, requested, responded, received, emergency in [
+            (wendy, zi, datetime(2012, 6, 5), datetime(2012, 6, 7), datetime(2012, 7, 20), False),
+            (wendy, la, datetime(2012, 8, 12), datetime(2012, 8, 14), None, True),
+            (steve, zi, datetime(2012, 10, 2), None, None, False),
+        ]:
+            StockRequest.objects.create(product=product, supply_point=sp,
+                                        status=StockRequestStatus.REQUESTED,
+                                        is_emergency=emergency, requested_on=requested,
+                                        responded_on=responded, received_on=received,
+                                        amount_requested=50,
+                                        amount_received=40 if received else None)
+        self._clear()
+
+    def _clear(self):
+        for model in WAREHOUSE_MODELS:
+            model.objects.all().delete()
+
+    def _snapshot(self):
+        snapshot = {}
+        for model in WAREHOUSE_MODELS:
+            fields = [f.attname for f in model._meta.concrete_fields
+                      if f.name not in ('id', 'create_date', 'update_date')]
+            snapshot[model.__name__] = sorted(
+                tuple(row[f] for f in fields) for row in model.objects.values(*fields)
+            )
+        return snapshot
+
+
+class TestBulkBaseLevelData(WarehouseDataTestBase):
+    """
+    The bulk engine must produce exactly the same warehouse data as the
+    per-supply point update_base_level_data.
+    """
+
+    def _run_each(self, runs):
+        runner = MalawiWarehouseRunner()
+        products = get_products(BaseLevel.HSA)
+        for i in range(runs):
+            for hsa in self.hsas:
+                runner.update_base_level_data(hsa, self.start, self.end, products)
+        return self._snapshot()
+
+    def _run_bulk(self, runs):
+        runner = MalawiWarehouseRunner(bulk=True)
+        products = get_products(BaseLevel.HSA)
+        for i in range(runs):
+            BulkBaseLevelUpdater(runner, self.start, self.end, chunk_size=1).update(self.hsas, products)
+        return self._snapshot()
+
+    def testSingleRunIdentical(self):
+        expected = self._run_each(1)
+        self.assertTrue(expected['CalculatedConsumption'])
+        self.assertTrue(expected['TimeTracker'])
+        self._clear()
+        self.assertEqual(expected, self._run_bulk(1))
+
+    def testRepeatedRunsIdentical(self):
+        # some of the models are additive, so make sure repeated runs
+        # over the same window also match.
+        expected = self._run_each(2)
+        self._clear()
+        self.assertEqual(expected, self._run_bulk(2))
@@ -0,0 +1,42 @@
+from __future__ import unicode_literals
+from builtins import range
+from static.malawi.config import BaseLevel
+from logistics_project.apps.malawi.tests.warehouse.bulk import WarehouseDataTestBase
+from logistics_project.apps.malawi.warehouse.models import ReportingRate
+from logistics_project.apps.malawi.warehouse.runner import MalawiWarehouseRunner, \
+    get_products
+
+
+class TestWarehouseCellStore(WarehouseDataTestBase):
+    """
+    Running the warehouse through the cell store must produce exactly the
+    same data as going to the database for every cell.
+    """
+
+    def _run(self, runs, use_cell_store):
+        runner = MalawiWarehouseRunner(use_cell_store=use_cell_store)
+        products = get_products(BaseLevel.HSA)
+        for i in range(runs):
+            for hsa in self.hsas:
+                runner.update_base_level_data(hsa, self.start, self.end, products)
+        return self._snapshot()
+
+    def testSingleRunIdentical(self):
+        expected = self._run(1, use_cell_store=False)
+        self._clear()
+        self.assertEqual(expected, self._run(1, use_cell_store=True))
+
+    def testRepeatedRunsIdentical(self):
+        expected = self._run(2, use_cell_store=False)
+        self._clear()
+        self.assertEqual(expected, self._run(2, use_cell_store=True))
+
+    def testDuplicatesRemoved(self):
+        self._run(1, use_cell_store=True)
+        rr = ReportingRate.objects.filter(supply_point=self.hsas[0]).order_by('date')[0]
+        duplicate = ReportingRate.objects.get(pk=rr.pk)
+        duplicate.pk = None
+        duplicate.save()
+        self._run(1, use_cell_store=True)
+        self.assertEqual(1, ReportingRate.objects.filter(supply_point=self.hsas[0], date=rr.date,
+                                                         base_level=rr.base_level).count())
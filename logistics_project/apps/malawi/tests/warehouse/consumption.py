@@ -6,7 +6,15 @@ from logistics.tests.util import fake_report
 from logistics.const import Reports
 from logistics_project.apps.malawi.warehouse.models import CalculatedConsumption
 from logistics_project.apps.malawi.tests.base import MalawiTestBase
-from logistics_project.apps.malawi.warehouse.runner import update_consumption_values
+from logistics_project.apps.malawi.warehouse.runner import update_consumption_values, \
+    update_consumption, ReportPeriod
+from logistics_project.apps.malawi.warehouse.consumption import ConsumptionEngine, \
+    consumption_slices
+from logistics_project.apps.malawi.tests.warehouse.bulk import WarehouseDataTestBase
+from logistics_project.apps.malawi.management.commands.recompute_consumption import \
+    clear_calculated_consumption
+from logistics_project.utils.dates import months_between
+from static.malawi.config import BaseLevel
 
 SECONDS = 60 * 60 * 24
 
@@ -191,4 +199,48 @@ class TestConsumption(MalawiTestBase):
         self.assertEqual(14 * SECONDS, c.time_with_data)
         
         
-    
\ No newline at end of file
+    
+
+class TestConsumptionEngine(WarehouseDataTestBase):
+    """
+    The consumption engine must give the same results as clearing the
+    consumption and running update_consumption for every month.
+    """
+
+    def _consumption(self):
+        return self._snapshot()['CalculatedConsumption']
+
+    def _recompute_each(self):
+        for hsa in self.hsas:
+            clear_calculated_consumption(hsa)
+            for year, month in months_between(self.start, self.end):
+                report_period = ReportPeriod(hsa, datetime(year, month, 1), self.start, self.end)
+                update_consumption(report_period, BaseLevel.HSA)
+        return self._consumption()
+
+    def _recompute_engine(self):
+        engine = ConsumptionEngine(self.start, self.end, BaseLevel.HSA)
+        for hsa in self.hsas:
+            engine.recompute(hsa)
+        return self._consumption()
+
+    def testSlices(self):
+        slices = list(consumption_slices(
+            [datetime(2012, 7, 21), datetime(2012, 8, 11)], [100, 79], [False, False]
+        ))
+        self.assertEqual([datetime(2012, 7, 1), datetime(2012, 8, 1)], [s[0] for s in slices])
+        self.assertEqual(21.0, sum(s[1] for s in slices))
+        self.assertEqual(21 * SECONDS, sum(s[2] for s in slices))
+        self.assertEqual(0, sum(s[3] for s in slices))
+
+    def testRecomputeIdentical(self):
+        expected = self._recompute_each()
+        self.assertTrue(expected)
+        self._clear()
+        self.assertEqual(expected, self._recompute_engine())
+
+    def testRecomputeOverExistingIdentical(self):
+        # the command recomputes on top of whatever is there already
+        self._recompute_each()
+        expected = self._recompute_each()
+        self.assertEqual(expected, self._recompute_engine())
@@ -0,0 +1,102 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from logistics.models import Product, SupplyPoint, ProductReportBatch
+from logistics.const import Reports
+from logistics.warehouse_models import SupplyPointWarehouseRecord
+from rapidsms.contrib.messagelog.models import Message
+from warehouse.models import ReportRun
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.tests.util import create_hsa
+from logistics_project.apps.malawi.warehouse.models import DirtyWarehouseCell, \
+    ReportingRate, CalculatedConsumption
+from logistics_project.apps.malawi.warehouse.runner import MalawiWarehouseRunner, \
+    get_ancestor_ids
+
+
+class TestIncrementalWarehouse(MalawiTestBase):
+
+    def setUp(self):
+        super(TestIncrementalWarehouse, self).setUp()
+        self.wendy = create_hsa(self, "+16175551000", "wendy", id="1", products="zi").supply_point
+        self.steve = create_hsa(self, "+16175551001", "steve", id="2", products="zi").supply_point
+        Message.objects.update(date=datetime(2012, 1, 1))
+        # skip filling in the history of every supply point
+        now = datetime.utcnow()
+        for sp in SupplyPoint.objects.all():
+            SupplyPointWarehouseRecord.objects.create(supply_point=sp, create_date=now)
+
+    def testReportsMarkCellsDirty(self):
+        DirtyWarehouseCell.objects.all().delete()
+        zi = Product.objects.get(sms_code="zi")
+        self.wendy.report_stock(zi, 10)
+        today = datetime.utcnow()
+        cells = DirtyWarehouseCell.objects.all()
+        self.assertTrue(cells.count() > 0)
+        for cell in cells:
+            self.assertEqual(self.wendy.pk, cell.supply_point_id)
+            self.assertEqual(zi.pk, cell.product_id)
+            self.assertEqual(datetime(today.year, today.month, 1), cell.date)
+
+    def testBatchMarksCellsOnce(self):
+        DirtyWarehouseCell.objects.all().delete()
+        zi = Product.objects.get(sms_code="zi")
+        batch = ProductReportBatch(self.wendy)
+        batch.report(zi, Reports.SOH, 10)
+        batch.report(zi, Reports.REC, 5)
+        batch.save()
+        self.assertEqual(1, DirtyWarehouseCell.objects.count())
+
+    def testAncestors(self):
+        facility = self.wendy.supplied_by
+        ancestors = get_ancestor_ids([self.wendy.pk])
+        self.assertTrue(facility.pk in ancestors)
+        self.assertTrue(facility.supplied_by_id in ancestors)
+        self.assertFalse(self.wendy.pk in ancestors)
+
+    def testOnlyChangedSupplyPointsUpdated(self):
+        DirtyWarehouseCell.objects.all().delete()
+        DirtyWarehouseCell.mark(self.wendy.pk, None, datetime(2012, 6, 10))
+        run = ReportRun.objects.create(start=datetime(2012, 6, 5), end=datetime(2012, 6, 20),
+                                       start_run=datetime.utcnow())
+        MalawiWarehouseRunner(incremental=True, skip_alerts=True).generate(run)
+        updated = set(ReportingRate.objects.values_list('supply_point', flat=True))
+        self.assertTrue(self.wendy.pk in updated)
+        self.assertTrue(self.wendy.supplied_by_id in updated)
+        self.assertFalse(self.steve.pk in updated)
+        self.assertEqual(0, DirtyWarehouseCell.objects.count())
+
+    def testNewMonthsUpdateEverything(self):
+        DirtyWarehouseCell.objects.all().delete()
+        run = ReportRun.objects.create(start=datetime(2012, 6, 5), end=datetime(2012, 7, 2),
+                                       start_run=datetime.utcnow())
+        MalawiWarehouseRunner(incremental=True, skip_alerts=True).generate(run)
+        self.assertFalse(ReportingRate.objects.filter(supply_point=self.steve,
+                                                      date=datetime(2012, 6, 1)).exists())
+        self.assertTrue(ReportingRate.objects.filter(supply_point=self.steve,
+                                                     date=datetime(2012, 7, 1)).exists())
+
+    def _consumption(self, supply_point, date):
+        return sorted(CalculatedConsumption.objects.filter(supply_point=supply_point, date=date)
+                      .values_list('product', 'time_needing_data', 'time_with_data', 'time_stocked_out'))
+
+    def _run(self, start, end, incremental):
+        DirtyWarehouseCell.objects.all().delete()
+        run = ReportRun.objects.create(start=start, end=end, start_run=datetime.utcnow())
+        MalawiWarehouseRunner(incremental=incremental, skip_alerts=True).generate(run)
+
+    def testConsumptionUpdatedAcrossMonths(self):
+        june = datetime(2012, 6, 1)
+        SupplyPoint.objects.filter(pk=self.steve.pk).update(created_at=datetime(2012, 1, 1))
+        self._run(datetime(2012, 6, 5), datetime(2012, 6, 15), False)
+        before = self._consumption(self.steve, june)
+        self.assertTrue(before)
+
+        # steve didn't change, but june went on after the last run
+        self._run(datetime(2012, 6, 15), datetime(2012, 7, 2), True)
+        incremental = self._consumption(self.steve, june)
+        facility = self._consumption(self.steve.supplied_by, june)
+        self.assertNotEqual(before, incremental)
+
+        self._run(datetime(2012, 6, 15), datetime(2012, 7, 2), False)
+        self.assertEqual(self._consumption(self.steve, june), incremental)
+        self.assertEqual(self._consumption(self.steve.supplied_by, june), facility)
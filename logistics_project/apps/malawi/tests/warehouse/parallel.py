@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+from builtins import range
+from datetime import datetime
+from logistics.models import SupplyPoint
+from static.malawi.config import SupplyPointCodes, BaseLevel
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.warehouse.parallel import shard, process_shard
+from logistics_project.apps.malawi.warehouse.runner import MalawiWarehouseRunner
+
+
+class FailingRunner(MalawiWarehouseRunner):
+    skip_current_consumption = True
+    skip_reporting_rates = True
+    skip_product_availability = True
+    skip_lead_times = True
+    skip_order_requests = True
+    skip_order_fulfillment = True
+    skip_consumption = True
+    skip_historical_stock = True
+    fail_for = None
+
+    def update_base_level_data(self, supply_point, *args, **kwargs):
+        if supply_point.id == self.fail_for:
+            raise ValueError("bad supply point")
+        return super(FailingRunner, self).update_base_level_data(supply_point, *args, **kwargs)
+
+
+class TestParallelWarehouse(MalawiTestBase):
+
+    def testShardsCoverAllIds(self):
+        ids = list(range(1, 104))
+        shards = shard(ids, 4, shard_size=10)
+        self.assertEqual(ids, [i for s in shards for i in s])
+        self.assertEqual(11, len(shards))
+        # never fewer shards than workers
+        self.assertEqual(4, len(shard(list(range(8)), 4)))
+        self.assertEqual(3, len(shard(list(range(3)), 4)))
+        self.assertEqual([], shard([], 4))
+
+    def testFailuresReportedPerSupplyPoint(self):
+        ids = list(SupplyPoint.objects.filter(type__code=SupplyPointCodes.FACILITY)
+                   .order_by('id').values_list('id', flat=True)[:3])
+        runner = FailingRunner(fail_for=ids[1])
+        failures = process_shard((runner, ids, datetime(2012, 1, 1), datetime(2012, 2, 1), BaseLevel.HSA))
+        [failure] = failures
+        self.assertEqual(ids[1], failure.supply_point_id)
+        self.assertTrue("bad supply point" in failure.error)
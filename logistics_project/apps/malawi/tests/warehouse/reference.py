@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.test.client import RequestFactory
+from logistics.models import Product, SupplyPoint
+from logistics.util import config
+from logistics_project.apps.malawi.tests.base import MalawiTestBase
+from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityData
+from logistics_project.apps.malawi.warehouse.reference import reference_data, _reference_version, \
+    REFERENCE_VERSION_KEY
+from logistics_project.apps.malawi.warehouse.report_utils import current_report_period
+
+
+class TestReferenceData(MalawiTestBase):
+
+    def setUp(self):
+        super(TestReferenceData, self).setUp()
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+
+    def _request(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        request.location = None
+        return request
+
+    def testSharedWithinRequest(self):
+        request = self._request()
+        reference = reference_data(request)
+        self.assertIs(reference, reference_data(request))
+        self.assertEqual(reference.country_sp, reference.reporting_supply_point)
+        with self.assertNumQueries(0):
+            reference.view_level
+            reference.default_supply_point
+            reference.reporting_supply_point
+
+    def testLongLived(self):
+        hsa_products = list(Product.objects.filter(is_active=True, type__base_level=config.BaseLevel.HSA)
+                            .order_by('sms_code'))
+        reference = reference_data(self._request())
+        self.assertEqual(hsa_products, reference.products(config.BaseLevel.HSA))
+        country = reference.country_sp
+
+        # later requests only check the version in the cache
+        with self.assertNumQueries(0):
+            reference = reference_data(self._request())
+            self.assertEqual(hsa_products, reference.products(config.BaseLevel.HSA))
+            self.assertEqual(country, reference.country_sp)
+
+        # until the products change
+        product = hsa_products[0]
+        product.is_active = False
+        product.save()
+        self.assertEqual(hsa_products[1:], reference_data(self._request()).products(config.BaseLevel.HSA))
+
+        # reports coming in don't count as a change
+        country = reference_data(self._request()).country_sp
+        country.last_reported = datetime.utcnow()
+        country.save(update_fields=['last_reported'])
+        with self.assertNumQueries(0):
+            reference_data(self._request()).country_sp
+
+    def testVersionBumpedOnCommit(self):
+        version = _reference_version()
+        with transaction.atomic():
+            product = Product.objects.filter(is_active=True)[0]
+            product.is_active = False
+            product.save()
+            self.assertEqual(version, cache.get(REFERENCE_VERSION_KEY))
+        self.assertNotEqual(version, cache.get(REFERENCE_VERSION_KEY))
+
+    def testNationalStockoutPcts(self):
+        reference = reference_data(self._request())
+        products = reference.products(config.BaseLevel.HSA)
+        ProductAvailabilityData.objects.create(supply_point=reference.country_sp, product=products[0],
+                                               date=current_report_period(), managed=4,
+                                               managed_and_without_stock=1)
+        with self.assertNumQueries(1):
+            pcts = reference.national_stockout_pcts(config.BaseLevel.HSA)
+        self.assertEqual(products, list(pcts))
+        self.assertEqual((25.0, 4), pcts[products[0]])
+        self.assertEqual(('?', '?'), pcts[products[1]])
@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from logistics.models import SupplyPoint
+from static.malawi.config import BaseLevel, SupplyPointCodes
+from logistics_project.apps.malawi.tests.warehouse.bulk import WarehouseDataTestBase
+from logistics_project.apps.malawi.warehouse.rollup import LevelRollup
+from logistics_project.apps.malawi.warehouse.runner import MalawiWarehouseRunner, \
+    get_products
+
+
+class TestLevelRollup(WarehouseDataTestBase):
+    """
+    The level rollup must produce exactly the same aggregates as
+    update_aggregated_data, one supply point at a time.
+    """
+
+    def setUp(self):
+        super(TestLevelRollup, self).setUp()
+        self._reset()
+        facility = self.hsas[0].supplied_by
+        district = facility.supplied_by
+        country = SupplyPoint.objects.get(type__code=SupplyPointCodes.COUNTRY)
+        # only the branch with data, in the order aggregate_data does them
+        self.levels = [[facility], [district], [country]]
+        self.base_snapshot = self._snapshot()
+
+    def _reset(self):
+        self._clear()
+        runner = MalawiWarehouseRunner()
+        products = get_products(BaseLevel.HSA)
+        self.since = datetime.utcnow()
+        for hsa in self.hsas:
+            runner.update_base_level_data(hsa, self.start, self.end, products)
+
+    def _run_each(self, base_level):
+        runner = MalawiWarehouseRunner()
+        products = get_products(base_level)
+        for parents in self.levels:
+            for supply_point in parents:
+                runner.update_aggregated_data(supply_point, self.start, self.end, self.since,
+                                              all_products=products, base_level=base_level)
+        return self._snapshot()
+
+    def _run_rollup(self, base_level):
+        runner = MalawiWarehouseRunner()
+        products = get_products(base_level)
+        for parents in self.levels:
+            LevelRollup(runner, parents, self.start, self.end, self.since,
+                        products, base_level).update()
+        return self._snapshot()
+
+    def testHSARollupIdentical(self):
+        expected = self._run_each(BaseLevel.HSA)
+        self.assertNotEqual(self.base_snapshot, expected)
+        self._reset()
+        self.assertEqual(expected, self._run_rollup(BaseLevel.HSA))
+
+    def testFacilityRollupIdentical(self):
+        # exercises the EPI filtering at the national level
+        expected = self._run_each(BaseLevel.FACILITY)
+        self._reset()
+        self.assertEqual(expected, self._run_rollup(BaseLevel.FACILITY))
+
+    def testRepeatedRollupIdentical(self):
+        self._run_each(BaseLevel.HSA)
+        expected = self._run_each(BaseLevel.HSA)
+        self._reset()
+        self._run_rollup(BaseLevel.HSA)
+        self.assertEqual(expected, self._run_rollup(BaseLevel.HSA))
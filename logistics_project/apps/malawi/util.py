@@ -80,6 +80,36 @@ def get_facility(supply_point_code):
         return None
 
 
+# how many steps up the supply chain from an HSA (or facility) the
+# supply point at each type of location is
+HSA_DEPTHS = {
+    config.LocationCodes.HSA: 0,
+    config.LocationCodes.FACILITY: 1,
+    config.LocationCodes.DISTRICT: 2,
+    config.LocationCodes.ZONE: 3,
+    config.LocationCodes.COUNTRY: 4,
+}
+FACILITY_DEPTHS = {
+    config.LocationCodes.FACILITY: 0,
+    config.LocationCodes.DISTRICT: 1,
+    config.LocationCodes.ZONE: 2,
+    config.LocationCodes.COUNTRY: 3,
+}
+
+
+def supply_points_below_lookup(location, depths, prefix=""):
+    """
+    The lookups for the supply points whose supplier *depths* levels up
+    the supply chain (going by the type of location) is at *location*,
+    via the supply point closure table. Pass them all to the same
+    filter() call, so they apply to the same row.
+    """
+    if location.type_id not in depths:
+        raise config.UnknownLocationCodeException(location.type_id)
+    return {"%sancestor_links__ancestor__location" % prefix: location,
+            "%sancestor_links__depth" % prefix: depths[location.type_id]}
+
+
 def hsas_below(location):
     """
     Given an optional location, return all HSAs below that location.
@@ -89,19 +119,7 @@ def hsas_below(location):
     hsas = Contact.objects.filter(role__code="hsa", is_active=True, 
                                   supply_point__active=True) 
     if location:
-        if location.type_id == config.LocationCodes.HSA:
-            hsas = hsas.filter(supply_point__location=location)
-        elif location.type_id == config.LocationCodes.FACILITY:
-            hsas = hsas.filter(supply_point__supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.DISTRICT:
-            hsas = hsas.filter(supply_point__supplied_by__supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.ZONE:
-            hsas = hsas.filter(supply_point__supplied_by__supplied_by__supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.COUNTRY:
-            hsas = hsas.filter(supply_point__supplied_by__supplied_by__supplied_by__supplied_by__location=location)
-        else:
-            raise config.UnknownLocationCodeException(location.type_id)
-
+        hsas = hsas.filter(**supply_points_below_lookup(location, HSA_DEPTHS, "supply_point__"))
     return hsas
 
 
@@ -113,19 +131,7 @@ def hsa_supply_points_below(location):
     """
     hsa_sps = SupplyPoint.objects.filter(type__code="hsa", active=True, contact__is_active=True)
     if location:
-        if location.type_id == config.LocationCodes.HSA:
-            hsa_sps = hsa_sps.filter(location=location)
-        elif location.type_id == config.LocationCodes.FACILITY:
-            hsa_sps = hsa_sps.filter(supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.DISTRICT:
-            hsa_sps = hsa_sps.filter(supplied_by__supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.ZONE:
-            hsa_sps = hsa_sps.filter(supplied_by__supplied_by__supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.COUNTRY:
-            hsa_sps = hsa_sps.filter(supplied_by__supplied_by__supplied_by__supplied_by__location=location)
-        else:
-            raise config.UnknownLocationCodeException(location.type_id)
-
+        hsa_sps = hsa_sps.filter(**supply_points_below_lookup(location, HSA_DEPTHS))
     return hsa_sps
     
     
@@ -193,17 +199,7 @@ def get_facilities():
 def facility_supply_points_below(location):
     facs = get_facility_supply_points()
     if location:
-        if location.type_id == config.LocationCodes.FACILITY:
-            facs = facs.filter(location=location)
-        elif location.type_id == config.LocationCodes.DISTRICT:
-            facs = facs.filter(supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.ZONE:
-            facs = facs.filter(supplied_by__supplied_by__location=location)
-        elif location.type_id == config.LocationCodes.COUNTRY:
-            facs = facs.filter(supplied_by__supplied_by__supplied_by__location=location)
-        else:
-            raise config.UnknownLocationCodeException(location.type_id)
-
+        facs = facs.filter(**supply_points_below_lookup(location, FACILITY_DEPTHS))
     return facs
 
 
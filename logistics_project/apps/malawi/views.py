@@ -1,5 +1,4 @@
 from __future__ import unicode_literals
-import csv
 
 import sentry_sdk
 from future import standard_library
@@ -37,7 +36,8 @@ from logistics.models import SupplyPoint, Product, LogisticsProfile,\
     StockTransaction, StockRequestStatus, ContactRole
 from logistics.decorators import place_in_request
 from logistics.util import config
-from logistics.charts import amc_plot
+from logistics.charts import monthly_amcs
+from logistics.export import csv_response
 
 from logistics_project.apps.malawi.warehouse.report_utils import datespan_default
 from logistics_project.apps.malawi.exceptions import IdFormatException
@@ -554,26 +554,16 @@ def send_outreach(req):
     
 @datespan_in_request()
 def export_amc_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=amc.csv'
-    products = Product.objects.filter(type__base_level=config.BaseLevel.HSA).order_by('sms_code')
-    writer = csv.writer(response)
-    _, data_rows = amc_plot(
-        SupplyPoint.objects.filter(active=True, type__code=config.SupplyPointCodes.HSA),
-        request.datespan,
-        products=products
-    )
-    datetimes = [datetime(m, y, 1) for m, y in request.datespan.months_iterator()]
-    row = ['Year', 'Month']
-    row.extend([p.sms_code for p in products])
-    writer.writerow(row)
-    for dt in datetimes:
-        row = [dt.year, dt.month]
-        v = data_rows[dt]
-        for p in products:
-            row.append(v[p.sms_code])
-        writer.writerow(row)
-    return response
+    products = list(Product.objects.filter(type__base_level=config.BaseLevel.HSA).order_by('sms_code'))
+    hsas = SupplyPoint.objects.filter(active=True, type__code=config.SupplyPointCodes.HSA)
+
+    def _rows():
+        # a month at a time, as the response is sent
+        for year, month in request.datespan.months_iterator():
+            amcs = monthly_amcs(hsas, year, month, products)
+            yield [year, month] + [amcs[p.sms_code] for p in products]
+
+    return csv_response('amc.csv', ['Year', 'Month'] + [p.sms_code for p in products], _rows())
 
 def _sort_date(x,y):
     if x['registered'] < y['registered']: return -1
@@ -0,0 +1,595 @@
+"""
+Set-based engine for the base level (HSA and facility) warehouse data.
+
+This computes exactly what MalawiWarehouseRunner.update_base_level_data does,
+but for a chunk of supply points at a time: all the source data (transactions,
+reports and requests) and all the existing warehouse rows for the window are
+pulled in a handful of queries, the warehouse models are computed in memory,
+and the results are written back with bulk_create / bulk_update.
+
+Every function below mirrors one of the per-object functions in runner.py
+and should be kept in sync with it. The output of the two paths is expected
+to be identical (apart from the create_date / update_date timestamps), which
+is checked in the warehouse tests.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from builtins import object
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q
+
+from logistics_project.utils.dates import months_between, first_of_next_month, delta_secs
+
+from logistics.models import ProductReport, StockTransaction, ProductStock, StockRequest
+from logistics.const import Reports
+from logistics.consumption import daily_consumptions
+
+from static.malawi.config import TimeTrackerTypes, BaseLevel
+
+from logistics_project.apps.malawi.util import get_managed_product_ids
+from logistics_project.apps.malawi.warehouse.models import ReportingRate,\
+    ProductAvailabilityData, ProductAvailabilityDataSummary, TimeTracker, \
+    OrderRequest, OrderFulfillment, CalculatedConsumption, CurrentConsumption, \
+    HistoricalStock
+
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_BATCH_SIZE = 500
+
+_Transaction = namedtuple('_Transaction', 'pk date ending_balance report_type')
+_Report = namedtuple('_Report', 'product_id report_date')
+_Request = namedtuple('_Request', 'product_id is_emergency requested_on responded_on '
+                                  'received_on amount_requested amount_received')
+
+
+class WarehouseRowStore(object):
+    """
+    An in-memory view of the warehouse rows of a single model, keyed the same
+    way get_or_create_singular_model looks them up (e.g. supply point, date
+    and product).
+
+    Rows are changed in memory and written back in bulk on flush().
+    """
+
+    def __init__(self, model, key_fields):
+        self.model = model
+        self.key_fields = tuple(key_fields)
+        self.rows = {}
+        self.created = []
+        self.changed = {}
+        self.duplicates = []
+        self._integer_fields = [
+            f.attname for f in model._meta.concrete_fields
+            if isinstance(f, models.IntegerField) and not f.primary_key
+        ]
+        self._update_fields = [
+            f.attname for f in model._meta.concrete_fields
+            if not f.primary_key and f.attname not in self.key_fields and f.name != 'create_date'
+        ]
+
+    def key_for(self, obj):
+        return tuple(getattr(obj, f) for f in self.key_fields)
+
+    def load(self, queryset):
+        """
+        Load the existing rows. If there is more than one row for a key the
+        most recently updated one wins and the rest get deleted on flush,
+        the same as get_or_create_singular_model.
+        """
+        found = defaultdict(list)
+        for obj in queryset.iterator():
+            found[self.key_for(obj)].append(obj)
+        for key, objs in found.items():
+            objs.sort(key=lambda o: (o.update_date, o.pk), reverse=True)
+            self.rows[key] = objs[0]
+            self.duplicates.extend(o.pk for o in objs[1:])
+
+    def get_or_create(self, *key):
+        try:
+            return self.rows[key], False
+        except KeyError:
+            obj = self.model(**dict(zip(self.key_fields, key)))
+            self.rows[key] = obj
+            self.created.append(obj)
+            return obj, True
+
+    def save(self, obj):
+        """
+        The in-memory equivalent of obj.save(). Integer values are coerced
+        the way the database would store them, since the per-object code
+        re-reads the (truncated) stored values on every access.
+        """
+        for f in self._integer_fields:
+            setattr(obj, f, int(getattr(obj, f)))
+        if obj.pk:
+            self.changed[obj.pk] = obj
+
+    def flush(self, now, batch_size=DEFAULT_BATCH_SIZE):
+        if self.duplicates:
+            self.model.objects.filter(pk__in=self.duplicates).delete()
+        for obj in self.created:
+            obj.create_date = now
+            obj.update_date = now
+        self.model.objects.bulk_create(self.created, batch_size=batch_size)
+        for obj in self.changed.values():
+            obj.update_date = now
+        self.model.objects.bulk_update(list(self.changed.values()), self._update_fields,
+                                       batch_size=batch_size)
+        self.rows = {}
+        self.created = []
+        self.changed = {}
+        self.duplicates = []
+
+
+class _SupplyPointData(object):
+    """
+    All the source data needed to compute the warehouse for one supply point.
+    """
+
+    def __init__(self):
+        self.transactions = defaultdict(list)   # product id -> [_Transaction] by date
+        self.reports = []                       # SOH reports in the window
+        self.requests = []                      # stock requests touching the window
+        self.product_stocks = {}                # product id -> ProductStock
+        self.daily_consumptions = {}            # product id -> daily consumption
+        self._dates = {}
+
+    def transactions_for(self, product_id):
+        """
+        The transactions for a product and their dates, for bisecting.
+        """
+        txs = self.transactions.get(product_id, [])
+        if product_id not in self._dates:
+            self._dates[product_id] = [t.date for t in txs]
+        return txs, self._dates[product_id]
+
+
+class BulkBaseLevelUpdater(object):
+    """
+    Set-based equivalent of MalawiWarehouseRunner.update_base_level_data,
+    honoring the same skip_* switches on the runner.
+    """
+
+    def __init__(self, runner, start, end, base_level=BaseLevel.HSA,
+                 chunk_size=DEFAULT_CHUNK_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.runner = runner
+        self.start = start
+        self.end = end
+        self.base_level = base_level
+        self.base_level_is_hsa = (base_level == BaseLevel.HSA)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.months = [datetime(year, month, 1) for year, month in months_between(start, end)]
+        self._thresholds = {}
+
+    def update(self, supply_points, all_products):
+        supply_points = list(supply_points)
+        all_products = list(all_products)
+        count = len(supply_points)
+        for i in range(0, count, self.chunk_size):
+            chunk = supply_points[i:i + self.chunk_size]
+            print("processing %s supply points in bulk (%s-%s of %s)" % (
+                len(chunk), i, i + len(chunk), count
+            ))
+            self.update_chunk(chunk, all_products)
+
+    def update_chunk(self, supply_points, all_products):
+        data = self._load_source_data(supply_points)
+        stores = self._load_stores(supply_points, all_products, data)
+        for supply_point in supply_points:
+            self._update_supply_point(supply_point, data[supply_point.pk], stores, all_products)
+
+        now = datetime.utcnow()
+        with transaction.atomic():
+            for store in stores.values():
+                store.flush(now, self.batch_size)
+
+    def _load_source_data(self, supply_points):
+        ids = [sp.pk for sp in supply_points]
+        data = dict((sp_id, _SupplyPointData()) for sp_id in ids)
+
+        # every transaction that can matter: the ones in the window, plus the
+        # ones before it for historical stock and the consumption start points
+        transactions = StockTransaction.objects.filter(
+            supply_point__in=ids,
+            date__lt=self.end,
+        ).order_by('date', 'pk').values_list(
+            'pk', 'supply_point_id', 'product_id', 'date', 'ending_balance',
+            'product_report__report_type__code',
+        )
+        for pk, sp_id, product_id, date, ending_balance, report_type in transactions.iterator():
+            data[sp_id].transactions[product_id].append(
+                _Transaction(pk, date, ending_balance, report_type)
+            )
+
+        if not self.runner.skip_reporting_rates:
+            reports = ProductReport.objects.filter(
+                supply_point__in=ids,
+                report_type__code=Reports.SOH,
+                report_date__gte=self.months[0],
+                report_date__lte=self.end,
+            ).values_list('supply_point_id', 'product_id', 'report_date')
+            for sp_id, product_id, report_date in reports.iterator():
+                data[sp_id].reports.append(_Report(product_id, report_date))
+
+        if self.base_level_is_hsa:
+            def _in_window(field):
+                return Q(**{'%s__gte' % field: self.start, '%s__lt' % field: self.end})
+
+            requests = StockRequest.objects.filter(supply_point__in=ids).filter(
+                _in_window('requested_on') | _in_window('responded_on') | _in_window('received_on')
+            ).order_by('pk').values_list(
+                'supply_point_id', 'product_id', 'is_emergency', 'requested_on',
+                'responded_on', 'received_on', 'amount_requested', 'amount_received',
+            )
+            for row in requests.iterator():
+                data[row[0]].requests.append(_Request(*row[1:]))
+
+        product_stocks = ProductStock.objects.filter(supply_point__in=ids)\
+            .select_related('product', 'supply_point__type')
+        for ps in product_stocks:
+            data[ps.supply_point_id].product_stocks[ps.product_id] = ps
+
+        if not self.runner.skip_current_consumption:
+            pairs = [(sp_id, product_id) for sp_id, sp_data in data.items()
+                     for product_id in sp_data.product_stocks]
+            for (sp_id, product_id), value in daily_consumptions(pairs).items():
+                data[sp_id].daily_consumptions[product_id] = value
+
+        return data
+
+    def _consumption_start(self, data):
+        """
+        Consumption between a transaction in the window and the one before it
+        is attributed to the months in between, so we may need rows from
+        before the start of the window.
+        """
+        earliest = self.months[0]
+        for sp_data in data.values():
+            for product_id in sp_data.transactions:
+                txs, dates = sp_data.transactions_for(product_id)
+                i = bisect_left(dates, self.start)
+                if 0 < i < len(txs) and txs[i - 1].date < earliest:
+                    earliest = datetime(txs[i - 1].date.year, txs[i - 1].date.month, 1)
+        return earliest
+
+    def _load_stores(self, supply_points, all_products, data):
+        runner = self.runner
+        ids = [sp.pk for sp in supply_points]
+        product_ids = [p.pk for p in all_products]
+        in_window = dict(supply_point__in=ids, date__gte=self.months[0], date__lte=self.months[-1])
+        by_product = ('supply_point_id', 'date', 'product_id')
+        by_base_level = ('supply_point_id', 'date', 'base_level')
+        stores = {}
+
+        def _add(model, key_fields, queryset):
+            store = WarehouseRowStore(model, key_fields)
+            store.load(queryset)
+            stores[model] = store
+
+        if not runner.skip_current_consumption:
+            _add(CurrentConsumption, ('supply_point_id', 'product_id'),
+                 CurrentConsumption.objects.filter(supply_point__in=ids, product__in=product_ids))
+        if not runner.skip_reporting_rates:
+            _add(ReportingRate, by_base_level,
+                 ReportingRate.objects.filter(base_level=self.base_level, **in_window))
+        if not runner.skip_product_availability:
+            _add(ProductAvailabilityData, by_product,
+                 ProductAvailabilityData.objects.filter(product__in=product_ids, **in_window))
+            _add(ProductAvailabilityDataSummary, by_base_level,
+                 ProductAvailabilityDataSummary.objects.filter(base_level=self.base_level, **in_window))
+        if not runner.skip_lead_times and self.base_level_is_hsa:
+            _add(TimeTracker, ('supply_point_id', 'date', 'type'),
+                 TimeTracker.objects.filter(**in_window))
+        if not runner.skip_order_requests and self.base_level_is_hsa:
+            _add(OrderRequest, by_product,
+                 OrderRequest.objects.filter(product__in=product_ids, **in_window))
+        if not runner.skip_order_fulfillment and self.base_level_is_hsa:
+            _add(OrderFulfillment, by_product,
+                 OrderFulfillment.objects.filter(product__in=product_ids, **in_window))
+        if not runner.skip_consumption:
+            _add(CalculatedConsumption, by_product,
+                 CalculatedConsumption.objects.filter(
+                     supply_point__in=ids, product__in=product_ids,
+                     date__gte=self._consumption_start(data), date__lte=self.months[-1],
+                 ))
+        if not runner.skip_historical_stock:
+            _add(HistoricalStock, by_product,
+                 HistoricalStock.objects.filter(product__in=product_ids, **in_window))
+        return stores
+
+    def _update_supply_point(self, supply_point, data, stores, all_products):
+        runner = self.runner
+        products_managed = get_managed_product_ids(supply_point, self.base_level)
+
+        if not runner.skip_current_consumption:
+            self._update_current_consumption(supply_point, data, stores[CurrentConsumption],
+                                             all_products)
+
+        # imported here to avoid a circular import with the runner
+        from logistics_project.apps.malawi.warehouse.runner import ReportPeriod
+        for window_date in self.months:
+            report_period = ReportPeriod(supply_point, window_date, self.start, self.end)
+
+            if not runner.skip_reporting_rates:
+                self._update_reporting_rate(report_period, data, stores[ReportingRate],
+                                            products_managed)
+            if not runner.skip_product_availability:
+                self._update_product_availability(report_period, data, stores, all_products,
+                                                  products_managed)
+            if not runner.skip_lead_times and self.base_level_is_hsa:
+                self._update_lead_times(report_period, data, stores[TimeTracker])
+            if not runner.skip_order_requests and self.base_level_is_hsa:
+                self._update_order_requests(report_period, data, stores[OrderRequest],
+                                            all_products)
+            if not runner.skip_order_fulfillment and self.base_level_is_hsa:
+                self._update_order_fulfillment(report_period, data, stores[OrderFulfillment],
+                                               all_products)
+            if not runner.skip_consumption:
+                self._update_consumption(report_period, data, stores[CalculatedConsumption],
+                                         all_products, products_managed)
+            if not runner.skip_historical_stock:
+                self._update_historical_stock(report_period, data, stores[HistoricalStock],
+                                              all_products)
+
+    def _update_current_consumption(self, supply_point, data, store, all_products):
+        """
+        See update_current_consumption
+        """
+        for p in all_products:
+            consumption = store.get_or_create(supply_point.pk, p.pk)[0]
+            consumption.total = 1
+            ps = data.product_stocks.get(p.pk)
+            if ps is not None:
+                consumption.current_daily_consumption = data.daily_consumptions.get(p.pk) or 0
+                consumption.stock_on_hand = ps.quantity or 0
+            else:
+                consumption.current_daily_consumption = 0
+                consumption.stock_on_hand = 0
+            store.save(consumption)
+
+    def _update_reporting_rate(self, report_period, data, store, products_managed):
+        """
+        See _update_reporting_rate
+        """
+        late_cutoff = report_period.window_date + \
+            timedelta(days=settings.LOGISTICS_DAYS_UNTIL_LATE_PRODUCT_REPORT)
+
+        reports_in_range = [r for r in data.reports
+                            if report_period.period_start <= r.report_date <= report_period.period_end]
+        period_rr = store.get_or_create(report_period.supply_point.pk,
+                                        report_period.window_date, self.base_level)[0]
+        period_rr.total = 1
+        period_rr.reported = 1 if reports_in_range else period_rr.reported
+        if reports_in_range:
+            first_report_date = min(r.report_date for r in reports_in_range)
+            period_rr.on_time = first_report_date <= late_cutoff or period_rr.on_time
+
+        if not period_rr.complete:
+            found = set(r.product_id for r in data.reports
+                        if report_period.window_date <= r.report_date <= report_period.period_end)
+            period_rr.complete = 0 if found and (products_managed - found) else \
+                (1 if found else 0)
+            if period_rr.complete:
+                period_rr.reported = 1
+
+        store.save(period_rr)
+
+    def _stock_levels(self, product_stock):
+        """
+        The (emergency, reorder, maximum) levels for a product stock, which
+        don't change over the course of a run.
+        """
+        if product_stock.pk not in self._thresholds:
+            levels = product_stock.stock_levels()
+            self._thresholds[product_stock.pk] = (
+                levels.emergency_reorder_level,
+                levels.reorder_level,
+                levels.maximum_level,
+            )
+        return self._thresholds[product_stock.pk]
+
+    def _update_product_availability(self, report_period, data, stores, all_products,
+                                     products_managed):
+        """
+        See _update_product_availability
+        """
+        supply_point = report_period.supply_point
+        store = stores[ProductAvailabilityData]
+        period_rows = []
+        for p in all_products:
+            product_data, created = store.get_or_create(supply_point.pk, report_period.window_date, p.pk)
+            period_rows.append(product_data)
+            if created:
+                product_data.without_data = 1
+
+            txs, dates = data.transactions_for(p.pk)
+            i = bisect_left(dates, report_period.period_end)
+            trans = txs[i - 1] if i and dates[i - 1] >= report_period.period_start else None
+
+            product_data.total = 1
+            product_data.managed = 1 if p.pk in products_managed else 0
+            if trans:
+                try:
+                    product_stock = data.product_stocks[p.pk]
+                except KeyError:
+                    raise ProductStock.DoesNotExist(
+                        "No ProductStock for %s at %s" % (p, supply_point)
+                    )
+                emergency_level, reorder_level, maximum_level = self._stock_levels(product_stock)
+
+                product_data.without_data = 0
+                if trans.ending_balance <= 0:
+                    product_data.without_stock = 1
+                    product_data.with_stock = 0
+                    product_data.under_stock = 0
+                    product_data.over_stock = 0
+                else:
+                    product_data.without_stock = 0
+                    product_data.with_stock = 1
+                    if emergency_level and trans.ending_balance <= emergency_level:
+                        product_data.emergency_stock = 1
+                    if reorder_level and trans.ending_balance <= reorder_level:
+                        product_data.under_stock = 1
+                        product_data.over_stock = 0
+                    elif maximum_level and trans.ending_balance > maximum_level:
+                        product_data.under_stock = 0
+                        product_data.over_stock = 1
+                    else:
+                        product_data.under_stock = 0
+                        product_data.over_stock = 0
+
+                product_data.good_stock = product_data.with_stock - \
+                    (product_data.under_stock + product_data.over_stock)
+                assert product_data.good_stock in (0, 1)
+
+            product_data.set_managed_attributes()
+            store.save(product_data)
+
+        # update the summary data
+        product_summary = stores[ProductAvailabilityDataSummary].get_or_create(
+            supply_point.pk, report_period.window_date, self.base_level
+        )[0]
+        product_summary.total = 1
+
+        if products_managed:
+            product_summary.any_managed = 1
+            managed_rows = [row for row in period_rows if row.managed == 1]
+            for c in ProductAvailabilityData.STOCK_CATEGORIES:
+                values = [getattr(row, "managed_and_%s" % c) for row in managed_rows]
+                setattr(product_summary, "any_%s" % c, max(values) if values else None)
+                assert getattr(product_summary, "any_%s" % c) <= 1
+        else:
+            product_summary.any_managed = 0
+            for c in ProductAvailabilityData.STOCK_CATEGORIES:
+                setattr(product_summary, "any_%s" % c, 0)
+
+        stores[ProductAvailabilityDataSummary].save(product_summary)
+
+    def _requests_in_range(self, report_period, data, field):
+        return [r for r in data.requests if getattr(r, field) is not None and
+                report_period.period_start <= getattr(r, field) < report_period.period_end]
+
+    def _update_lead_times(self, report_period, data, store):
+        """
+        See _update_lead_times
+        """
+        supply_point_id = report_period.supply_point.pk
+        or_tt = store.get_or_create(supply_point_id, report_period.window_date,
+                                    TimeTrackerTypes.ORD_READY)[0]
+        for r in self._requests_in_range(report_period, data, 'responded_on'):
+            if r.requested_on is not None:
+                or_tt.time_in_seconds += delta_secs(r.responded_on - r.requested_on)
+                or_tt.total += 1
+        store.save(or_tt)
+
+        rr_tt = store.get_or_create(supply_point_id, report_period.window_date,
+                                    TimeTrackerTypes.READY_REC)[0]
+        for r in self._requests_in_range(report_period, data, 'received_on'):
+            if r.responded_on is not None:
+                rr_tt.time_in_seconds += delta_secs(r.received_on - r.responded_on)
+                rr_tt.total += 1
+        store.save(rr_tt)
+
+    def _update_order_requests(self, report_period, data, store, all_products):
+        """
+        See _update_order_requests
+        """
+        requests_in_range = self._requests_in_range(report_period, data, 'requested_on')
+        for p in all_products:
+            ord_req = store.get_or_create(report_period.supply_point.pk,
+                                          report_period.window_date, p.pk)[0]
+            ord_req.total += len([r for r in requests_in_range if r.product_id == p.pk])
+            ord_req.emergency += len([r for r in requests_in_range
+                                      if r.product_id == p.pk and r.is_emergency])
+            store.save(ord_req)
+
+    def _update_order_fulfillment(self, report_period, data, store, all_products):
+        """
+        See _update_order_fulfillment
+        """
+        requests_in_range = [
+            r for r in self._requests_in_range(report_period, data, 'received_on')
+            if r.amount_requested is not None and r.amount_received is not None
+        ]
+        for p in all_products:
+            order_fulfill = store.get_or_create(report_period.supply_point.pk,
+                                                report_period.window_date, p.pk)[0]
+            for r in requests_in_range:
+                if r.product_id == p.pk:
+                    order_fulfill.total += 1
+                    order_fulfill.quantity_requested += r.amount_requested
+                    order_fulfill.quantity_received += r.amount_received
+            if requests_in_range:
+                store.save(order_fulfill)
+
+    def _update_consumption(self, report_period, data, store, all_products, products_managed):
+        """
+        See update_consumption
+        """
+        supply_point = report_period.supply_point
+        for p in all_products:
+            c = store.get_or_create(supply_point.pk, report_period.window_date, p.pk)[0]
+
+            start_time = max(supply_point.created_at, report_period.window_date)
+            if start_time < report_period.period_end and p.pk in products_managed:
+                assert start_time.year == report_period.window_date.year
+                assert start_time.month == report_period.window_date.month
+                c.time_needing_data = delta_secs(report_period.period_end - start_time)
+                store.save(c)
+
+            txs, dates = data.transactions_for(p.pk)
+            first = bisect_left(dates, report_period.period_start)
+            last = bisect_left(dates, report_period.period_end)
+            if last > first:
+                # include the transaction immediately before the first one
+                self._update_consumption_values(supply_point, p, txs[max(first - 1, 0):last], store)
+
+    def _update_consumption_values(self, supply_point, product, to_process, store):
+        """
+        See update_consumption_values
+        """
+        for start, end in zip(to_process, to_process[1:]):
+            assert start.date <= end.date
+            delta = end.ending_balance - start.ending_balance
+            total_timedelta = end.date - start.date
+            for year, month in months_between(start.date, end.date):
+                window_date = datetime(year, month, 1)
+                next_window_date = first_of_next_month(window_date)
+                start_date = max(window_date, start.date)
+                end_date = min(next_window_date, end.date)
+
+                secs_in_window = delta_secs(end_date-start_date)
+                proportion_in_window = secs_in_window / (delta_secs(total_timedelta)) if secs_in_window else 0
+                assert proportion_in_window <= 1
+                c = store.get_or_create(supply_point.pk, window_date, product.pk)[0]
+                if delta < 0:
+                    c.calculated_consumption += float(abs(delta)) * proportion_in_window
+
+                if delta <= 0 or end.report_type == Reports.REC:
+                    c.time_with_data += secs_in_window
+
+                if start.ending_balance == 0:
+                    c.time_stocked_out += secs_in_window
+
+                store.save(c)
+
+    def _update_historical_stock(self, report_period, data, store, all_products):
+        """
+        See _update_historical_stock
+        """
+        for p in all_products:
+            hs = store.get_or_create(report_period.supply_point.pk,
+                                     report_period.window_date, p.pk)[0]
+            txs, dates = data.transactions_for(p.pk)
+            i = bisect_left(dates, report_period.period_end)
+            hs.total = 1
+            if i:
+                hs.stock = txs[i - 1].ending_balance
+            store.save(hs)
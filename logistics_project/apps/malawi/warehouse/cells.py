@@ -0,0 +1,148 @@
+"""
+A per-run store of warehouse cells, used by the per supply point warehouse
+functions in runner.py in place of a SELECT (and maybe an INSERT) for every
+cell they touch.
+
+The existing rows for a supply point and window are preloaded, keyed the same
+way get_or_create_singular_model looks them up, duplicates are resolved in
+one pass, and all the changes are written back in bulk when the store is
+flushed at the end of the supply point. Cells outside what was preloaded
+(e.g. consumption for months before the window) are looked up on demand.
+
+The store is activated with the using_cell_store context manager; when no
+store is active the warehouse functions fall back to the database.
+"""
+from __future__ import unicode_literals
+from builtins import object
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+
+from django.db import transaction
+
+from logistics_project.apps.malawi.warehouse.bulk import WarehouseRowStore, DEFAULT_BATCH_SIZE
+from logistics_project.apps.malawi.warehouse.models import ReportingRate,\
+    ProductAvailabilityData, ProductAvailabilityDataSummary, TimeTracker, \
+    OrderRequest, OrderFulfillment, CalculatedConsumption, CurrentConsumption, \
+    HistoricalStock
+
+# the fields each model's cells are looked up by, other than the supply point
+CELL_KEYS = {
+    ReportingRate: ('date', 'base_level'),
+    ProductAvailabilityData: ('date', 'product_id'),
+    ProductAvailabilityDataSummary: ('date', 'base_level'),
+    TimeTracker: ('date', 'type'),
+    OrderRequest: ('date', 'product_id'),
+    OrderFulfillment: ('date', 'product_id'),
+    CalculatedConsumption: ('date', 'product_id'),
+    HistoricalStock: ('date', 'product_id'),
+    CurrentConsumption: ('product_id',),
+}
+
+_local = threading.local()
+
+
+def active_cell_store():
+    return getattr(_local, 'store', None)
+
+
+@contextmanager
+def using_cell_store(store):
+    """
+    Make the store the active one for the warehouse functions, flushing it
+    at the end if everything went well.
+    """
+    previous = active_cell_store()
+    _local.store = store
+    try:
+        yield store
+        store.flush()
+    finally:
+        _local.store = previous
+
+
+class WarehouseCellStore(object):
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.stores = {}
+        self.loaded = {}   # model -> (supply point id, first date, last date)
+
+    def _store(self, model):
+        if model not in self.stores:
+            self.stores[model] = WarehouseRowStore(model, ('supply_point_id',) + CELL_KEYS[model])
+        return self.stores[model]
+
+    def preload(self, supply_point, start=None, end=None, models=None):
+        """
+        Load the existing cells of a supply point, between start and end
+        for the dated models.
+        """
+        for model in models or CELL_KEYS:
+            queryset = model.objects.filter(supply_point=supply_point)
+            dated = 'date' in CELL_KEYS[model]
+            if dated:
+                queryset = queryset.filter(date__gte=start, date__lte=end)
+            self._store(model).load(queryset)
+            self.loaded[model] = (supply_point.pk, start if dated else None, end if dated else None)
+
+    def _key(self, model, query_kwargs):
+        """
+        The store key for a get_or_create_singular_model lookup, or None if
+        the lookup isn't one this store handles.
+        """
+        if model not in CELL_KEYS:
+            return None
+        values = {}
+        for name, value in query_kwargs.items():
+            field = model._meta.get_field(name)
+            if field.is_relation:
+                values[field.attname] = getattr(value, 'pk', value)
+            else:
+                values[field.attname] = value
+        key_fields = ('supply_point_id',) + CELL_KEYS[model]
+        if set(values) != set(key_fields):
+            return None
+        return tuple(values[f] for f in key_fields)
+
+    def _covers(self, model, key):
+        if model not in self.loaded:
+            return False
+        supply_point_id, start, end = self.loaded[model]
+        if key[0] != supply_point_id:
+            return False
+        if start is None:
+            return True
+        date = key[1]
+        return start <= date <= end
+
+    def get_or_create(self, model, **query_kwargs):
+        """
+        The in-memory equivalent of get_or_create_singular_model. Returns None
+        if the lookup isn't one this store handles.
+        """
+        key = self._key(model, query_kwargs)
+        if key is None:
+            return None
+        store = self._store(model)
+        if key not in store.rows and not self._covers(model, key):
+            store.load(model.objects.filter(**dict(zip(store.key_fields, key))))
+        return store.get_or_create(*key)
+
+    def handles(self, obj):
+        store = self.stores.get(type(obj))
+        return store is not None and store.rows.get(store.key_for(obj)) is obj
+
+    def save(self, obj):
+        self.stores[type(obj)].save(obj)
+
+    def cells(self, model):
+        return list(self._store(model).rows.values())
+
+    def flush(self):
+        with transaction.atomic():
+            now = datetime.utcnow()
+            for store in self.stores.values():
+                store.flush(now, self.batch_size)
+        self.stores = {}
+        self.loaded = {}
@@ -328,3 +328,37 @@ class HistoricalStock(MalawiWarehouseModel):
     product = models.ForeignKey('logistics.Product', on_delete=models.CASCADE)
     stock = models.BigIntegerField(default=0)
     total = models.PositiveIntegerField(default=0)
+
+
+class DirtyWarehouseCell(models.Model):
+    """
+    A (supply point, product, month) whose source data changed since the
+    last warehouse run. These are recorded by signals as reports, stock
+    transactions and requests come in, so that an incremental warehouse
+    run only has to recompute the supply points that changed (and their
+    parents). product is empty when the change isn't product specific.
+    """
+    supply_point = models.ForeignKey('logistics.SupplyPoint', on_delete=models.CASCADE)
+    product = models.ForeignKey('logistics.Product', null=True, on_delete=models.CASCADE)
+    date = models.DateTimeField()
+    created_at = models.DateTimeField(default=datetime.utcnow)
+
+    class Meta(object):
+        app_label = "malawi"
+
+    @classmethod
+    def mark(cls, supply_point_id, product_id, date):
+        return cls.objects.create(supply_point_id=supply_point_id, product_id=product_id,
+                                  date=datetime(date.year, date.month, 1))
+
+    @classmethod
+    def mark_many(cls, cells):
+        """
+        mark for many (supply point id, product id, date) cells in one insert.
+        """
+        months = set((supply_point_id, product_id, datetime(date.year, date.month, 1))
+                     for supply_point_id, product_id, date in cells)
+        return cls.objects.bulk_create([
+            cls(supply_point_id=supply_point_id, product_id=product_id, date=date)
+            for supply_point_id, product_id, date in months
+        ])
@@ -0,0 +1,110 @@
+"""
+Runs the base level (HSA and facility) part of the warehouse across a pool
+of worker processes.
+
+The base level data of a supply point doesn't depend on any other supply
+point, so the supply points are split into shards which the workers pick up
+as they become free. Each worker opens its own database connection.
+
+A supply point that fails doesn't stop the rest of the run; its failure is
+collected and handed back to the runner.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from builtins import range
+from collections import namedtuple
+import multiprocessing
+import traceback
+
+from django.db import connections
+
+from logistics.models import SupplyPoint
+
+from static.malawi.config import BaseLevel
+
+
+DEFAULT_SHARD_SIZE = 50
+
+SupplyPointFailure = namedtuple('SupplyPointFailure', 'supply_point_id name error')
+
+
+def shard(ids, workers, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Split the ids into shards of at most shard_size, making sure there are
+    at least as many shards as workers (where there are enough ids).
+    """
+    if not ids:
+        return []
+    size = max(1, min(shard_size, -(-len(ids) // workers)))
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def _init_worker():
+    # never share the parent's database connections; each worker
+    # opens its own the first time it needs one.
+    connections.close_all()
+
+
+def process_shard(job):
+    """
+    Update the base level data for one shard of supply points. Returns a
+    list of SupplyPointFailure for the supply points that couldn't be
+    processed.
+    """
+    # imported here to avoid a circular import with the runner
+    from logistics_project.apps.malawi.warehouse.runner import get_products
+    from logistics_project.apps.malawi.warehouse.bulk import BulkBaseLevelUpdater
+
+    runner, ids, start, end, base_level = job
+    products = get_products(base_level)
+    supply_points = list(SupplyPoint.objects.filter(id__in=ids).order_by('id'))
+    failures = []
+    if runner.bulk:
+        try:
+            BulkBaseLevelUpdater(runner, start, end, base_level).update(supply_points, products)
+        except Exception:
+            # the bulk updater writes each chunk in a single transaction,
+            # so none of these supply points were updated.
+            error = traceback.format_exc()
+            failures.extend(SupplyPointFailure(sp.id, sp.name, error) for sp in supply_points)
+    else:
+        for supply_point in supply_points:
+            print("processing %s (%s) in worker %s" % (supply_point.name, supply_point.id,
+                                                      multiprocessing.current_process().name))
+            try:
+                runner.update_base_level_data(supply_point, start, end, products, base_level=base_level)
+            except Exception:
+                failures.append(SupplyPointFailure(supply_point.id, supply_point.name,
+                                                   traceback.format_exc()))
+    return failures
+
+
+def update_base_level_data_in_parallel(runner, supply_points, start, end,
+                                       base_level=BaseLevel.HSA, workers=None):
+    """
+    Update the base level data for all the supply points using a pool of
+    worker processes, blocking until every shard has finished. Returns the
+    list of SupplyPointFailure across all shards.
+    """
+    workers = workers or runner.workers
+    ids = [sp.id for sp in supply_points]
+    jobs = [(runner, ids_in_shard, start, end, base_level) for ids_in_shard in shard(ids, workers)]
+    print("processing %s supply points in %s shards with %s workers" % (len(ids), len(jobs), workers))
+
+    # the workers are forked from this process, so make sure they
+    # don't inherit any open database connections.
+    connections.close_all()
+    pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    failures = []
+    try:
+        for i, shard_failures in enumerate(pool.imap_unordered(process_shard, jobs)):
+            print("finished shard %s of %s" % (i + 1, len(jobs)))
+            failures.extend(shard_failures)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failures
@@ -0,0 +1,205 @@
+"""
+Reference data for the warehouse reports: the lookups that the shared
+context and the report views all need (products, the country supply
+point, what the user can see, the report period, ...), memoized for
+the request.
+
+What only changes when someone edits the products or the supply chain
+is also kept for the life of the process, under a version kept in the
+cache. The model signals bump the version, so every process starts
+afresh on its next request.
+"""
+from __future__ import unicode_literals
+from builtins import object
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+
+from logistics.models import Product, SupplyPoint
+from logistics.util import config
+from logistics_project.apps.malawi.util import get_country_sp, get_default_supply_point, \
+    get_districts, get_facilities, get_view_level, get_visible_districts, \
+    get_all_visible_locations, pct, filter_district_queryset_for_epi
+from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityData
+from logistics_project.apps.malawi.warehouse.report_utils import current_report_period
+
+
+REFERENCE_VERSION_KEY = "malawi-warehouse-reference-version"
+
+# saves that only touch these don't change any reference data
+VOLATILE_FIELDS = frozenset(["last_reported"])
+
+_process_lock = threading.Lock()
+_process_data = {}
+_process_version = [None]
+
+
+def _reference_version():
+    version = cache.get(REFERENCE_VERSION_KEY)
+    if version is None:
+        cache.add(REFERENCE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(REFERENCE_VERSION_KEY)
+    return version
+
+
+def invalidate_reference_data(sender=None, **kwargs):
+    """
+    Forget the long-lived reference data, in this process and the others.
+    Connected to the signals of the models it comes from.
+    """
+    update_fields = kwargs.get('update_fields')
+    if update_fields and VOLATILE_FIELDS.issuperset(update_fields):
+        return
+    # the other processes are only told once the change is committed, or
+    # they could load the old data under the new version and keep it
+    _forget_process_data()
+    transaction.on_commit(_bump_reference_version)
+
+
+def _forget_process_data():
+    with _process_lock:
+        _process_data.clear()
+        _process_version[0] = None
+
+
+def _bump_reference_version():
+    cache.set(REFERENCE_VERSION_KEY, uuid.uuid4().hex, None)
+    _forget_process_data()
+
+
+class ReferenceData(object):
+    """
+    The reference data for a request. Use ReferenceData.for_request so
+    that everything handling the request shares one.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.user = getattr(request, 'user', None)
+        self._memo = {}
+        self._version = None
+
+    @classmethod
+    def for_request(cls, request):
+        data = getattr(request, '_reference_data', None)
+        if data is None:
+            data = request._reference_data = cls(request)
+        return data
+
+    def _memoized(self, key, compute):
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def _long_lived(self, key, compute):
+        def _get():
+            # the version is only looked up once per request
+            if self._version is None:
+                self._version = _reference_version()
+            with _process_lock:
+                if _process_version[0] != self._version:
+                    _process_data.clear()
+                    _process_version[0] = self._version
+                if key in _process_data:
+                    return _process_data[key]
+            value = compute()
+            with _process_lock:
+                if _process_version[0] == self._version:
+                    _process_data[key] = value
+            return value
+        return self._memoized(key, _get)
+
+    # long-lived
+
+    @property
+    def country_sp(self):
+        return self._long_lived('country_sp', get_country_sp)
+
+    def products(self, base_level):
+        """
+        The active products at the base level, by code.
+        """
+        return self._long_lived(('products', base_level), lambda: list(
+            Product.objects.filter(is_active=True, type__base_level=base_level)
+            .select_related('type').order_by('sms_code')))
+
+    def supply_point_at(self, location):
+        return self._long_lived(('supply_point_at', location.pk),
+                                lambda: SupplyPoint.objects.get(location=location))
+
+    def national_counts(self, base_level):
+        """
+        The number of districts, facilities and active HSAs, for the
+        national view sidebar.
+        """
+        def _counts():
+            all_districts = get_districts()
+            if base_level == config.BaseLevel.FACILITY:
+                all_districts = filter_district_queryset_for_epi(all_districts)
+            return {
+                'district_count': all_districts.count(),
+                'facility_count': get_facilities().filter(
+                    parent_id__in=all_districts.values_list('id', flat=True)).count(),
+                'hsas': SupplyPoint.objects.filter(active=True, type__code="hsa").count(),
+            }
+        return self._long_lived(('national_counts', base_level), _counts)
+
+    # for this request
+
+    @property
+    def report_period(self):
+        return self._memoized('report_period', current_report_period)
+
+    @property
+    def view_level(self):
+        return self._memoized('view_level', lambda: get_view_level(self.user))
+
+    @property
+    def default_supply_point(self):
+        return self._memoized('default_supply_point', lambda: get_default_supply_point(self.user))
+
+    @property
+    def reporting_supply_point(self):
+        """
+        The supply point at the location of the request, or the user's
+        default one.
+        """
+        location = getattr(self.request, 'location', None)
+        if location:
+            return self.supply_point_at(location)
+        return self.default_supply_point
+
+    @property
+    def visible_districts(self):
+        return self._memoized('visible_districts', lambda: get_visible_districts(self.user))
+
+    @property
+    def all_visible_locations(self):
+        return self._memoized('all_visible_locations', lambda: get_all_visible_locations(self.user))
+
+    def national_stockout_pcts(self, base_level):
+        """
+        The national stockout percentage and the number of supply points
+        managing each product in the current report period, or '?'s
+        where there's no data.
+        """
+        def _pcts():
+            products = self.products(base_level)
+            availability = dict(
+                (a.product_id, a) for a in ProductAvailabilityData.objects.filter(
+                    supply_point=self.country_sp, date=self.report_period,
+                    product__in=[p.pk for p in products]))
+            stockout_pcts = OrderedDict()
+            for p in products:
+                a = availability.get(p.pk)
+                stockout_pcts[p] = (pct(a.managed_and_without_stock, a.managed), a.managed) \
+                    if a else ('?', '?')
+            return stockout_pcts
+        return self._memoized(('national_stockout_pcts', base_level), _pcts)
+
+
+def reference_data(request):
+    return ReferenceData.for_request(request)
@@ -1,9 +1,9 @@
 from __future__ import unicode_literals
 from builtins import object
 from logistics_project.apps.malawi.warehouse import warehouse_view
-from logistics.models import SupplyPoint, ProductReport, Product
-from logistics_project.apps.malawi.util import get_default_supply_point,\
-    hsa_supply_points_below
+from logistics.models import ProductReport, Product
+from logistics_project.apps.malawi.util import hsa_supply_points_below
+from logistics_project.apps.malawi.warehouse.reference import reference_data
 from logistics_project.utils.dates import first_of_next_month
 import itertools
 from logistics_project.apps.malawi.warehouse.report_views.consumption_profiles import consumption_row
@@ -62,8 +62,7 @@ def hc_context(request):
     weeks later). This one might be complicated so let me know if it is
     possible.
     """
-    sp = SupplyPoint.objects.get(location=request.location) \
-        if request.location else get_default_supply_point(request.user)
+    sp = reference_data(request).reporting_supply_point
 
     hsas = hsa_supply_points_below(sp.location).order_by('code')
     end_date = first_of_next_month(request.datespan.enddate)
@@ -103,8 +102,7 @@ def amc_context(request):
     AMC for Nov and Dec period for all HSAs in the list attached. The last
     column in the consumption profiles report is is the information we require.
     """
-    sp = SupplyPoint.objects.get(location=request.location) \
-        if request.location else get_default_supply_point(request.user)
+    sp = reference_data(request).reporting_supply_point
 
     hsas = hsa_supply_points_below(sp.location).order_by('code')
     products = Product.objects.all()
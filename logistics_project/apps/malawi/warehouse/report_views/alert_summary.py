@@ -1,9 +1,8 @@
 from __future__ import unicode_literals
-from logistics.models import SupplyPoint
 
 from logistics_project.apps.malawi.warehouse.models import Alert
 from logistics_project.apps.malawi.warehouse import warehouse_view
-from logistics_project.apps.malawi.util import get_default_supply_point, fmt_pct,\
+from logistics_project.apps.malawi.util import fmt_pct,\
     facility_supply_points_below, is_country, get_district_supply_points
 
 class View(warehouse_view.DistrictOnlyView):
@@ -27,8 +26,7 @@ class View(warehouse_view.DistrictOnlyView):
             "data": [],
         }
 
-        sp = SupplyPoint.objects.get(location=request.location)\
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
 
         if is_country(sp):
             facilities = get_district_supply_points(request.user.is_superuser)
@@ -7,7 +7,8 @@ from logistics_project.apps.malawi.util import (pct, fmt_pct, get_default_supply
     filter_district_queryset_for_epi)
 from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityDataSummary,\
     Alert
-from logistics_project.apps.malawi.warehouse.report_utils import current_report_period, \
+from logistics_project.apps.malawi.warehouse.reference import reference_data
+from logistics_project.apps.malawi.warehouse.report_utils import \
     get_multiple_reporting_rates_chart, supply_point_type_display
 from logistics_project.apps.malawi.warehouse import warehouse_view
 from django.core.exceptions import ObjectDoesNotExist
@@ -167,13 +168,14 @@ class View(warehouse_view.DashboardView):
         return table
 
     def custom_context(self, request):
-        window_date = current_report_period()
+        window_date = reference_data(request).report_period
         reporting_supply_point = self.get_reporting_supply_point(request)
 
         # reporting rates + stockout summary
         child_sps = SupplyPoint.objects.filter(active=True).order_by('name')
         if reporting_supply_point.type_id == SupplyPointCodes.COUNTRY:
-            child_sps = child_sps.filter(supplied_by__supplied_by=reporting_supply_point)
+            child_sps = child_sps.filter(ancestor_links__ancestor=reporting_supply_point,
+                                         ancestor_links__depth=2)
             if request.base_level_is_facility:
                 child_sps = filter_district_queryset_for_epi(child_sps)
         else:
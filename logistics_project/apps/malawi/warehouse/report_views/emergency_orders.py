@@ -7,9 +7,9 @@ from builtins import range
 import itertools
 from collections import defaultdict
 
-from logistics.models import SupplyPoint, ProductType, Product
+from logistics.models import ProductType, Product
 
-from logistics_project.apps.malawi.util import get_default_supply_point, pct, fmt_or_none,\
+from logistics_project.apps.malawi.util import pct, fmt_or_none,\
     is_facility, hsa_supply_points_below
 from logistics_project.apps.malawi.warehouse.models import OrderRequest
 from logistics_project.apps.malawi.warehouse.report_utils import get_datelist,\
@@ -26,8 +26,7 @@ class View(warehouse_view.DistrictOnlyView):
         if request.GET.get("product-type") in [ptype.code for ptype in product_types]:
             selected_type = ProductType.objects.get(code=request.GET["product-type"])
 
-        sp = SupplyPoint.objects.get(location=request.location) \
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
         
         datelist = get_datelist(request.datespan.startdate, 
                                 request.datespan.enddate)
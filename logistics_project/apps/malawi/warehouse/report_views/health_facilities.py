@@ -1,8 +1,6 @@
 from __future__ import unicode_literals
 from logistics_project.apps.malawi.warehouse import warehouse_view
-from logistics.models import SupplyPoint
-from logistics_project.apps.malawi.util import get_default_supply_point,\
-    hsa_supply_points_below, fmt_pct
+from logistics_project.apps.malawi.util import hsa_supply_points_below, fmt_pct
 from static.malawi import config
 from logistics_project.apps.malawi.warehouse.report_utils import previous_report_period,\
     get_lead_time_table_data, get_stock_status_table_data,\
@@ -16,8 +14,7 @@ class View(warehouse_view.DistrictOnlyView):
     show_report_nav = False
     
     def custom_context(self, request):
-        sp = SupplyPoint.objects.get(location=request.location)\
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
 
         report_date = request.datespan.enddate
         current_date = previous_report_period()
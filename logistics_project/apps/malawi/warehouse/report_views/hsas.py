@@ -8,8 +8,7 @@ from logistics.models import SupplyPoint, StockRequest, ProductStock
 
 from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityDataSummary, ReportingRate
 from logistics_project.apps.malawi.warehouse import warehouse_view
-from logistics_project.apps.malawi.util import get_default_supply_point, \
-    hsa_supply_points_below, fmt_or_none
+from logistics_project.apps.malawi.util import hsa_supply_points_below, fmt_or_none
 from logistics_project.apps.malawi.warehouse.report_utils import get_hsa_url
 from rapidsms.models import Contact
 from static.malawi.config import SupplyPointCodes
@@ -38,8 +37,7 @@ class View(warehouse_view.DistrictOnlyView):
             "data": [],
         }
 
-        sp = SupplyPoint.objects.get(location=request.location)\
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
 
         hsas = hsa_supply_points_below(sp.location)
         hsa_count = hsas.count()
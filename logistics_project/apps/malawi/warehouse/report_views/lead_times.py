@@ -6,11 +6,9 @@ from datetime import datetime
 from logistics_project.utils.dates import months_between
 
 from logistics.util import config
-from logistics.models import SupplyPoint
 
 from logistics_project.apps.malawi.warehouse import warehouse_view
-from logistics_project.apps.malawi.util import get_default_supply_point,\
-    facility_supply_points_below, hsa_supply_points_below, get_district_supply_points
+from logistics_project.apps.malawi.util import facility_supply_points_below, hsa_supply_points_below, get_district_supply_points
 from logistics_project.apps.malawi.warehouse.models import TimeTracker,\
     TIME_TRACKER_TYPES
 
@@ -21,8 +19,7 @@ from logistics_project.apps.malawi.warehouse.report_utils import get_lead_time_t
 class View(warehouse_view.DistrictOnlyView):
 
     def custom_context(self, request):
-        sp = SupplyPoint.objects.get(location=request.location) \
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
         
         data = defaultdict(lambda: defaultdict(lambda: 0))
         dates = [
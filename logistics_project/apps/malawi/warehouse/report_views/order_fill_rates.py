@@ -1,10 +1,9 @@
 from __future__ import unicode_literals
 from collections import defaultdict
 
-from logistics.models import Product, SupplyPoint, ProductType
+from logistics.models import Product, ProductType
 
-from logistics_project.apps.malawi.util import get_default_supply_point,\
-    facility_supply_points_below, fmt_pct, fmt_or_none, is_district, is_facility,\
+from logistics_project.apps.malawi.util import facility_supply_points_below, fmt_pct, fmt_or_none, is_district, is_facility,\
     hsa_supply_points_below
 from logistics_project.apps.malawi.warehouse.models import OrderFulfillment
 from logistics_project.apps.malawi.warehouse.report_utils import get_datelist
@@ -17,8 +16,7 @@ class View(warehouse_view.DistrictOnlyView):
     def custom_context(self, request):
         product_types = list(ProductType.objects.filter(base_level=request.base_level))
 
-        sp = SupplyPoint.objects.get(location=request.location) \
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
         
         selected_type = None
         if request.GET.get("product-type") in [ptype.code for ptype in product_types]:
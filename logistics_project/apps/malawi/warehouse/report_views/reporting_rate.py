@@ -5,10 +5,8 @@ from collections import defaultdict, OrderedDict
 
 from logistics_project.utils.dates import months_between
 
-from logistics.models import SupplyPoint
 
-from logistics_project.apps.malawi.util import (get_default_supply_point,
-    get_district_supply_points, facility_supply_points_below, fmt_pct,
+from logistics_project.apps.malawi.util import (get_district_supply_points, facility_supply_points_below, fmt_pct,
     hsa_supply_points_below, is_country, is_district, is_facility,
     filter_district_queryset_for_epi)
 from logistics_project.apps.malawi.warehouse.models import ReportingRate
@@ -25,8 +23,7 @@ class View(warehouse_view.DistrictOnlyView):
         shared_slugs = ["reported", "on_time", "late", "missing", "complete"]
         
         # reporting rates by month table
-        sp = SupplyPoint.objects.get(location=request.location) \
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
         
         months = OrderedDict()
         for year, month in months_between(request.datespan.startdate, 
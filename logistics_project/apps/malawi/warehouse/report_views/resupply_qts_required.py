@@ -1,10 +1,9 @@
 from __future__ import unicode_literals
 from builtins import str
 from django.db.models import Q
-from logistics.models import StockRequest, Product, SupplyPoint
+from logistics.models import StockRequest, Product
 from logistics_project.apps.malawi.warehouse import warehouse_view
-from logistics_project.apps.malawi.util import (get_default_supply_point,
-    facility_supply_points_below, is_district, is_country, is_facility,
+from logistics_project.apps.malawi.util import (facility_supply_points_below, is_district, is_country, is_facility,
     hsa_supply_points_below, get_district_supply_points,
     filter_district_queryset_for_epi)
 from collections import defaultdict
@@ -29,8 +28,7 @@ class View(warehouse_view.DistrictOnlyView):
             selected_type = str(request.GET.get("emergency"))
             emergency = selected_type == "yes"
 
-        sp = SupplyPoint.objects.get(location=request.location)\
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
         
         if is_country(sp):
             table["header"] = ["District Name"]
@@ -10,8 +10,9 @@ from logistics_project.apps.malawi.util import (fmt_pct, pct,
     facility_supply_points_below, get_district_supply_points,
     filter_district_queryset_for_epi)
 from logistics_project.apps.malawi.warehouse import warehouse_view
+from logistics_project.apps.malawi.warehouse.reference import reference_data
 from logistics_project.apps.malawi.warehouse.report_utils import get_datelist,\
-    get_stock_status_table_data, current_report_period
+    get_stock_status_table_data
 from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityData
 from django.db.models.aggregates import Sum
 from django.shortcuts import get_object_or_404
@@ -71,7 +72,7 @@ class View(warehouse_view.DistrictOnlyView):
         }
 
     def get_months_of_stock_table(self, request, reporting_supply_point):
-        products = Product.objects.filter(is_active=True, type__base_level=request.base_level).order_by('sms_code')
+        products = reference_data(request).products(request.base_level)
         table = {
             "id": "months-of-stock-table",
             "is_datatable": True,
@@ -129,7 +130,7 @@ class View(warehouse_view.DistrictOnlyView):
             table["data"] = self._get_product_status_table(
                 facility_supply_points_below(reporting_supply_point.location).order_by('name'),
                 selected_product,
-                current_report_period(),
+                reference_data(request).report_period,
             )
         elif is_country(reporting_supply_point):
             table["location_type"] = "District"
@@ -140,7 +141,7 @@ class View(warehouse_view.DistrictOnlyView):
             table["data"] = self._get_product_status_table(
                 districts,
                 selected_product,
-                current_report_period(),
+                reference_data(request).report_period,
             )
 
         return table
@@ -227,7 +228,7 @@ class View(warehouse_view.DistrictOnlyView):
 
         return {
             'product_types': ProductType.objects.filter(base_level=request.base_level),
-            'window_date': current_report_period(),
+            'window_date': reference_data(request).report_period,
             'selected_type': selected_type,
             'selected_product': selected_product,
             'status_table': self.get_stock_status_by_product_table(request, reporting_supply_point),
@@ -4,8 +4,7 @@ from logistics.util import config
 
 from logistics_project.apps.malawi.warehouse import warehouse_view
 from logistics_project.apps.malawi.warehouse.report_utils import get_hsa_url
-from logistics_project.apps.malawi.util import get_default_supply_point,\
-    get_district_supply_points, get_imci_coordinators,\
+from logistics_project.apps.malawi.util import get_district_supply_points, get_imci_coordinators,\
     facility_supply_points_below, get_in_charge, hsa_supply_points_below,\
     get_supervisors
 
@@ -17,8 +16,7 @@ class View(warehouse_view.DistrictOnlyView):
         facility = SupplyPoint.objects.none()
 
         # set district or facility based on user
-        sp = SupplyPoint.objects.get(location=request.location)\
-            if request.location else get_default_supply_point(request.user)
+        sp = self.get_reporting_supply_point(request)
 
         if sp.type.code == config.SupplyPointCodes.DISTRICT:
             district = sp
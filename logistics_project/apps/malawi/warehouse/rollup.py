@@ -0,0 +1,229 @@
+"""
+Set-based rollup of the warehouse data up the supply point hierarchy.
+
+This computes the same rows as MalawiWarehouseRunner.update_aggregated_data,
+but for every supply point of a level (facility, district or country) at
+once: each aggregated model is summed with a single query grouped by the
+parent supply point (and product / type and date), and the results are
+written back with bulk_create / bulk_update.
+
+The children of a parent are the same as in proper_children, including
+the EPI district filtering at the national level and the exclusion of the
+test district ('99') from the country totals.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from builtins import object
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Sum, Min, F
+
+from logistics_project.utils.dates import months_between
+
+from logistics.models import SupplyPoint, supply_point_closure
+
+from static.malawi.config import SupplyPointCodes, BaseLevel
+
+from logistics_project.apps.malawi.util import get_country_sp, filter_district_queryset_for_epi
+from logistics_project.apps.malawi.warehouse.bulk import WarehouseRowStore, DEFAULT_BATCH_SIZE
+from logistics_project.apps.malawi.warehouse.models import ReportingRate,\
+    ProductAvailabilityData, ProductAvailabilityDataSummary, \
+    TIME_TRACKER_TYPES, TimeTracker, OrderRequest, OrderFulfillment, \
+    CalculatedConsumption, CurrentConsumption, HistoricalStock
+
+CONSUMPTION_FIELDS = ['calculated_consumption', 'time_stocked_out', 'time_with_data', 'time_needing_data']
+
+
+class LevelRollup(object):
+    """
+    Aggregates all the warehouse data for one level of parent supply points,
+    honoring the same skip_* switches on the runner.
+    """
+
+    def __init__(self, runner, parents, start, end, since, all_products,
+                 base_level=BaseLevel.HSA, batch_size=DEFAULT_BATCH_SIZE):
+        self.runner = runner
+        self.parents = list(parents)
+        self.parent_ids = [p.id for p in self.parents]
+        self.start = start
+        self.end = end
+        self.since = since
+        self.product_ids = [p.id for p in all_products]
+        self.base_level = base_level
+        self.base_level_is_hsa = (base_level == BaseLevel.HSA)
+        self.batch_size = batch_size
+        self.windows = [datetime(year, month, 1) for year, month in months_between(start, end)]
+        self.stores = []
+
+    def update(self):
+        if not self.parents:
+            return
+        # imported here to avoid a circular import with the runner
+        from logistics_project.apps.malawi.warehouse.runner import proper_child_type
+
+        parent_type = self.parents[0].type.code
+        self.child_type = proper_child_type(self.parents[0])
+        # countries skip over the zone level, like proper_children. the
+        # children are found (and grouped by parent) through the supply
+        # point closure table, like everything else below a supply point
+        self.depth = 2 if parent_type == SupplyPointCodes.COUNTRY else 1
+        self.children = self._children(parent_type)
+
+        runner = self.runner
+        products = [(p,) for p in self.product_ids]
+        months = [(w,) for w in self.windows]
+        product_months = [(p, w) for p in self.product_ids for w in self.windows]
+
+        if not runner.skip_current_consumption:
+            self._rollup(CurrentConsumption, ['total', 'current_daily_consumption', 'stock_on_hand'],
+                         ['product_id'], products, dated=False)
+        if not runner.skip_reporting_rates:
+            self._rollup(ReportingRate, ['total', 'reported', 'on_time', 'complete'],
+                         ['date'], months, fixed={'base_level': self.base_level})
+        if not runner.skip_product_availability:
+            self._rollup(ProductAvailabilityData,
+                         ['total', 'managed'] + ProductAvailabilityData.STOCK_CATEGORIES +
+                         ["managed_and_%s" % c for c in ProductAvailabilityData.STOCK_CATEGORIES],
+                         ['product_id', 'date'], product_months)
+            self._rollup(ProductAvailabilityDataSummary,
+                         ['total', 'any_managed'] +
+                         ["any_%s" % c for c in ProductAvailabilityData.STOCK_CATEGORIES],
+                         ['date'], months, fixed={'base_level': self.base_level})
+        if not runner.skip_lead_times and self.base_level_is_hsa:
+            self._rollup(TimeTracker, ['total', 'time_in_seconds'], ['type', 'date'],
+                         [(code, w) for code, name in TIME_TRACKER_TYPES for w in self.windows])
+        if not runner.skip_order_requests and self.base_level_is_hsa:
+            self._rollup(OrderRequest, ['total', 'emergency'], ['product_id', 'date'], product_months)
+        if not runner.skip_order_fulfillment and self.base_level_is_hsa:
+            self._rollup(OrderFulfillment, ['total', 'quantity_requested', 'quantity_received'],
+                         ['product_id', 'date'], product_months)
+        if not runner.skip_consumption and runner.consumption_test_mode:
+            self._rollup(CalculatedConsumption, CONSUMPTION_FIELDS, ['product_id', 'date'], product_months)
+        if not runner.skip_historical_stock:
+            self._rollup(HistoricalStock, ['total', 'stock'], ['product_id', 'date'], product_months)
+        if not runner.skip_consumption and not runner.consumption_test_mode:
+            self._rollup_consumption()
+
+        with transaction.atomic():
+            now = datetime.utcnow()
+            for store in self.stores:
+                store.flush(now, self.batch_size)
+        self.stores = []
+
+    def _below_parents(self, prefix=''):
+        # pass these to the same filter() call, so that they (and the
+        # parent, see _parent) refer to the same closure row
+        return {'%sancestor_links__ancestor__in' % prefix: self.parent_ids,
+                '%sancestor_links__depth' % prefix: self.depth}
+
+    def _parent(self, prefix=''):
+        return F('%sancestor_links__ancestor' % prefix)
+
+    def _children(self, parent_type):
+        children = SupplyPoint.objects.filter(active=True, **self._below_parents())
+        if self.child_type == 'hsa':
+            # match hsa_supply_points_below, see proper_children
+            children = children.filter(contact__is_active=True)
+
+        wrong_type = set(children.exclude(type__code=self.child_type)
+                         .values_list(self._parent(), flat=True))
+        for parent in self.parents:
+            if parent.id in wrong_type and 'test' not in parent.name.lower():
+                raise AssertionError('{0} ({1}) has the wrong number of children of the right type'.format(
+                    parent.name, parent.pk
+                ))
+
+        if self.base_level == BaseLevel.FACILITY and parent_type == SupplyPointCodes.COUNTRY:
+            # For EPI, only aggregate national data over participating districts.
+            children = filter_district_queryset_for_epi(children)
+
+        # hack: remove test district users from national level
+        country = get_country_sp()
+        if country.id in self.parent_ids:
+            children = children.exclude(code='99',
+                                        pk__in=supply_point_closure.descendants(country, self.depth))
+        return children
+
+    def _totals(self, model, fields, group_by, date_from=None, **filters):
+        """
+        Sum the fields over all the children, grouped by parent and the
+        group_by fields, in a single query.
+        """
+        rows = model.objects.filter(supply_point__in=self.children,
+                                    **dict(filters, **self._below_parents('supply_point__')))
+        if date_from is not None:
+            rows = rows.filter(date__gte=date_from, date__lte=self.end)
+        rows = rows.values(*group_by, parent=self._parent('supply_point__')) \
+            .annotate(*[Sum(f) for f in fields]).order_by()
+        totals = {}
+        for row in rows:
+            key = (row['parent'],) + tuple(row[g] for g in group_by)
+            totals[key] = row
+        return totals
+
+    def _store(self, model, key_fields, date_from=None, **filters):
+        store = WarehouseRowStore(model, ('supply_point_id',) + tuple(key_fields))
+        existing = model.objects.filter(supply_point__in=self.parent_ids, **filters)
+        if date_from is not None:
+            existing = existing.filter(date__gte=date_from, date__lte=self.end)
+        store.load(existing)
+        self.stores.append(store)
+        return store
+
+    def _save(self, store, key, fields, totals):
+        obj = store.get_or_create(*key)[0]
+        for f in fields:
+            setattr(obj, f, totals.get("%s__sum" % f) or 0)
+        store.save(obj)
+
+    def _rollup(self, model, fields, group_by, keys, fixed=None, dated=True):
+        """
+        Every parent gets a row for each of the keys (values of the group_by
+        fields), which is zero if none of its children have any data.
+        """
+        fixed = fixed or {}
+        if dated and not self.windows:
+            return
+        date_from = self.windows[0] if dated else None
+        totals = self._totals(model, fields, group_by, date_from, **fixed)
+        fixed_names = tuple(fixed)
+        fixed_values = tuple(fixed[n] for n in fixed_names)
+        store = self._store(model, fixed_names + tuple(group_by), date_from, **fixed)
+        for parent_id in self.parent_ids:
+            for key in keys:
+                self._save(store, (parent_id,) + fixed_values + tuple(key), fields,
+                           totals.get((parent_id,) + tuple(key), {}))
+
+    def _rollup_consumption(self):
+        """
+        The warehouse can update historical consumption values outside the
+        range we are looking at, so rollup every month since the earliest
+        child value that was updated in this run.
+        """
+        new_starts = {}
+        rows = CalculatedConsumption.objects.filter(
+            update_date__gte=self.since,
+            supply_point__in=self.children,
+            product__in=self.product_ids,
+            **self._below_parents('supply_point__')
+        ).values('product_id', parent=self._parent('supply_point__')) \
+            .annotate(Min('date')).order_by()
+        for row in rows:
+            assert row['date__min'] <= self.end
+            new_starts[(row['parent'], row['product_id'])] = row['date__min']
+        if not new_starts:
+            return
+
+        date_from = min(new_starts.values())
+        date_from = datetime(date_from.year, date_from.month, 1)
+        totals = self._totals(CalculatedConsumption, CONSUMPTION_FIELDS, ['product_id', 'date'], date_from)
+        store = self._store(CalculatedConsumption, ['product_id', 'date'], date_from)
+        for parent_id in self.parent_ids:
+            for product_id in self.product_ids:
+                new_start = new_starts.get((parent_id, product_id))
+                if new_start:
+                    for year, month in months_between(new_start, self.end):
+                        key = (parent_id, product_id, datetime(year, month, 1))
+                        self._save(store, key, CONSUMPTION_FIELDS, totals.get(key, {}))
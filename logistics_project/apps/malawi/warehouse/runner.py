@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 from builtins import str
 from builtins import range
 from builtins import object
+import copy
 from datetime import datetime, timedelta
 
 from django.conf import settings
@@ -14,8 +15,9 @@ from logistics_project.utils.dates import months_between, first_of_next_month, d
 from rapidsms.contrib.messagelog.models import Message
 
 from logistics.models import SupplyPoint, ProductReport, StockTransaction,\
-    ProductStock, Product, StockRequest, StockRequestStatus
+    ProductStock, Product, StockRequest, StockRequestStatus, HistoricalStockCache
 from logistics.const import Reports
+from logistics.consumption import daily_consumptions
 from logistics.warehouse_models import SupplyPointWarehouseRecord
 
 from warehouse.runner import WarehouseRunner
@@ -28,8 +30,12 @@ from logistics_project.apps.malawi.util import (hsa_supply_points_below, get_cou
 from logistics_project.apps.malawi.warehouse.models import ReportingRate,\
     ProductAvailabilityData, ProductAvailabilityDataSummary, \
     TIME_TRACKER_TYPES, TimeTracker, OrderRequest, OrderFulfillment, Alert,\
-    CalculatedConsumption, CurrentConsumption, HistoricalStock
-from django.core.exceptions import ObjectDoesNotExist
+    CalculatedConsumption, CurrentConsumption, HistoricalStock, DirtyWarehouseCell
+from logistics_project.apps.malawi.warehouse.bulk import BulkBaseLevelUpdater
+from logistics_project.apps.malawi.warehouse.cells import WarehouseCellStore, \
+    using_cell_store, active_cell_store
+from logistics_project.apps.malawi.warehouse.parallel import update_base_level_data_in_parallel
+from logistics_project.apps.malawi.warehouse.rollup import LevelRollup
 
 
 class ReportPeriod(object):
@@ -44,6 +50,12 @@ class ReportPeriod(object):
         self.period_end = min(self.next_window_date, end)
 
 
+# the base level data that only changes when a supply point's data does
+CONSUMPTION_ONLY_SKIPS = ['skip_reporting_rates', 'skip_product_availability', 'skip_lead_times',
+                          'skip_order_requests', 'skip_order_fulfillment', 'skip_current_consumption',
+                          'skip_historical_stock']
+
+
 class MalawiWarehouseRunner(WarehouseRunner):
     """
     Malawi's implementation of the warehouse runner. 
@@ -61,6 +73,14 @@ class MalawiWarehouseRunner(WarehouseRunner):
     skip_current_consumption = False
     skip_historical_stock = False
     consumption_test_mode = False
+    # use the set-based engine in warehouse/bulk.py for the base level data
+    bulk = False
+    # only recompute the supply points that changed since the last run
+    incremental = False
+    # keep the cells of each supply point in memory and write them in bulk
+    use_cell_store = True
+    # number of worker processes for the base level data (see warehouse/parallel.py)
+    workers = 1
     hsa_limit = 0
     facility_limit = 0
     agg_limit_per_type = 0
@@ -100,34 +120,67 @@ class MalawiWarehouseRunner(WarehouseRunner):
         if start < first_activity:
             start = first_activity
         
+        # the changes this run is responsible for (see DirtyWarehouseCell).
+        # anything recorded after this point is left for the next run.
+        dirty = DirtyWarehouseCell.objects.filter(
+            id__lte=DirtyWarehouseCell.objects.aggregate(Max('id'))['id__max'] or 0
+        )
+        if self.incremental:
+            dirty_ids = set(dirty.values_list('supply_point', flat=True).distinct())
+            print("incremental run: %s supply points changed" % len(dirty_ids))
+
         # first populate all the warehouse tables for all hsas
         hsas = SupplyPoint.objects.filter(active=True, type__code=SupplyPointCodes.HSA).order_by('id')
         if self.hsa_limit:
             hsas = hsas[:self.hsa_limit]
-        
-        count = len(hsas)
+        unchanged_hsas = unchanged_facilities = []
+        if self.incremental:
+            hsas, unchanged_hsas = split_changed(hsas, dirty_ids)
+
         if not self.skip_hsas:
-            products = get_products(BaseLevel.HSA)
-            for i, hsa in enumerate(hsas):
-                # process all the hsa-level warehouse tables
-                print("processing hsa %s (%s) (%s of %s)" % (hsa.name, str(hsa.id), i, count))
-                self.update_base_level_data(hsa, start, end, products)
+            self.update_base_level(run_record, hsas, start, end, BaseLevel.HSA)
 
         if settings.ENABLE_FACILITY_WORKFLOWS:
             print('processing facility data')
-            products = get_products(BaseLevel.FACILITY)
             facilities = SupplyPoint.objects.filter(active=True, type__code=SupplyPointCodes.FACILITY).order_by('id')
             if self.facility_limit:
                 facilities = facilities[:self.facility_limit]
-            for i, facility in enumerate(facilities):
-                print("processing facility %s (%s) (%s of %s)" % (facility.name, str(facility.id), i, count))
-                self.update_base_level_data(facility, start, end, products, base_level=BaseLevel.FACILITY)
+            if self.incremental:
+                facilities, unchanged_facilities = split_changed(facilities, dirty_ids)
+            self.update_base_level(run_record, facilities, start, end, BaseLevel.FACILITY)
+
+        if self.incremental:
+            # a supply point's consumption for a month (time_needing_data
+            # etc.) grows with the end of the period, so it goes stale for
+            # the supply points that didn't change too. recompute it for
+            # all of them, like a full run does, in the current month and
+            # any new ones.
+            if not self.skip_consumption:
+                consumption_only = self._runner_for(consumption_only=True)
+                if not self.skip_hsas:
+                    consumption_only.update_base_level(run_record, unchanged_hsas, start, end, BaseLevel.HSA)
+                if settings.ENABLE_FACILITY_WORKFLOWS:
+                    consumption_only.update_base_level(run_record, unchanged_facilities, start, end,
+                                                       BaseLevel.FACILITY)
+            new_months_start = first_of_next_month(start)
+            if new_months_start <= end:
+                # the months that started since the last run don't have any
+                # other data yet either, so the supply points that didn't
+                # change still need them.
+                without_consumption = self._runner_for(skip_consumption=True)
+                if not self.skip_hsas:
+                    without_consumption.update_base_level(run_record, unchanged_hsas, new_months_start, end,
+                                                          BaseLevel.HSA)
+                if settings.ENABLE_FACILITY_WORKFLOWS:
+                    without_consumption.update_base_level(run_record, unchanged_facilities, new_months_start,
+                                                          end, BaseLevel.FACILITY)
 
         if not self.skip_consumption:
             update_consumption_times(run_record.start_run)
 
         # rollup aggregates
         if not self.skip_aggregates:
+            # every level, since the consumption of every supply point changed
             self.aggregate_data(start, end, run_record, BaseLevel.HSA)
 
             if settings.ENABLE_FACILITY_WORKFLOWS:
@@ -138,38 +191,89 @@ class MalawiWarehouseRunner(WarehouseRunner):
             update_alerts(hsas)
 
         update_historical_data()
+        dirty.delete()
+
+    def _runner_for(self, consumption_only=False, **flags):
+        """
+        A copy of this runner with some of the skip_* switches changed, or
+        that only updates the (monthly) consumption.
+        """
+        runner = copy.copy(self)
+        if consumption_only:
+            for name in CONSUMPTION_ONLY_SKIPS:
+                setattr(runner, name, True)
+        for name, value in flags.items():
+            setattr(runner, name, value)
+        return runner
+
+    def update_base_level(self, run_record, supply_points, start, end, base_level):
+        """
+        Update the base level data for a list of supply points, either one
+        at a time, in bulk or across a pool of workers.
+        """
+        products = get_products(base_level)
+        if self.workers > 1:
+            self._report_failures(run_record, update_base_level_data_in_parallel(
+                self, supply_points, start, end, base_level))
+        elif self.bulk:
+            BulkBaseLevelUpdater(self, start, end, base_level).update(supply_points, products)
+        else:
+            count = len(supply_points)
+            name = 'hsa' if base_level == BaseLevel.HSA else 'facility'
+            for i, supply_point in enumerate(supply_points):
+                print("processing %s %s (%s) (%s of %s)" % (name, supply_point.name, str(supply_point.id), i, count))
+                self.update_base_level_data(supply_point, start, end, products, base_level=base_level)
 
-    def aggregate_data(self, start, end, run_record, base_level):
+    def _report_failures(self, run_record, failures):
+        """
+        Report the supply points that failed in a parallel run. The run
+        carries on, but is flagged as having an error.
+        """
+        if failures:
+            run_record.has_error = True
+            print("%s supply points failed:" % len(failures))
+            for failure in failures:
+                print("supply point %s (%s) failed with:\n%s" % (
+                    failure.name, failure.supply_point_id, failure.error))
+
+    def aggregate_data(self, start, end, run_record, base_level, only=None):
+        """
+        Roll up the base level data, one level at a time. If only is passed
+        in, only those supply points get aggregated.
+        """
         products = get_products(base_level)
         for agg_type_code, agg_type_name in aggregate_types_in_order(base_level):
-            supply_points = SupplyPoint.objects.filter(active=True).filter(type__code=agg_type_code).order_by('id')
+            supply_points = SupplyPoint.objects.filter(active=True).filter(type__code=agg_type_code)\
+                .select_related('type').order_by('id')
+            if only is not None:
+                supply_points = supply_points.filter(id__in=only)
             print('aggregating data at level %s for base level %s' % (agg_type_name, base_level))
 
             if self.agg_limit_per_type:
                 supply_points = supply_points[:self.agg_limit_per_type]
 
-            supply_points_count = supply_points.count()
-            for i, supply_point in enumerate(supply_points):
-                print("processing %s %s (%s) (%s/%s)" % (
-                    agg_type_name,
-                    supply_point.name,
-                    supply_point.id,
-                    i,
-                    supply_points_count
-                ))
-
-                self.update_aggregated_data(
-                    supply_point,
-                    start,
-                    end,
-                    run_record.start_run,
-                    all_products=products,
-                    base_level=base_level
-                )
+            # each level is rolled up in one go, and has to be complete
+            # before the next one up reads from it.
+            LevelRollup(self, supply_points, start, end,
+                        run_record.start_run, products, base_level).update()
 
     def update_base_level_data(self, supply_point, start, end, all_products=None, base_level=BaseLevel.HSA):
-        base_level_is_hsa = (base_level == BaseLevel.HSA)
+        """
+        Update all the base level warehouse data for a single supply point.
+        The set-based equivalent of this is BulkBaseLevelUpdater, and the
+        two should be kept in sync.
+        """
         all_products = all_products or get_products(base_level)
+        if self.use_cell_store:
+            store = WarehouseCellStore()
+            store.preload(supply_point, datetime(start.year, start.month, 1), end)
+            with using_cell_store(store):
+                self._update_base_level_data(supply_point, start, end, all_products, base_level)
+        else:
+            self._update_base_level_data(supply_point, start, end, all_products, base_level)
+
+    def _update_base_level_data(self, supply_point, start, end, all_products, base_level):
+        base_level_is_hsa = (base_level == BaseLevel.HSA)
         products_managed = get_managed_product_ids(supply_point, base_level)
 
         if not self.skip_current_consumption:
@@ -194,6 +298,11 @@ class MalawiWarehouseRunner(WarehouseRunner):
                 _update_historical_stock(supply_point, report_period, all_products)
 
     def update_aggregated_data(self, supply_point, start, end, since, all_products=None, base_level=BaseLevel.HSA):
+        """
+        Update all the aggregated warehouse data for a single supply point.
+        aggregate_data does the same for a whole level at a time with
+        LevelRollup, and the two should be kept in sync.
+        """
         base_level_is_hsa = (base_level == BaseLevel.HSA)
         all_products = all_products or get_products(base_level)
         relevant_children = proper_children(supply_point)
@@ -337,6 +446,12 @@ def update_current_consumption(supply_point, base_level):
     """
     Update the actual consumption data
     """
+    product_stocks = dict(
+        (ps.product_id, ps) for ps in ProductStock.objects.filter(
+            supply_point=supply_point, product__type__base_level=base_level
+        )
+    )
+    consumptions = daily_consumptions([(supply_point, product_id) for product_id in product_stocks])
     for p in get_products(base_level):
         consumption = get_or_create_singular_model(
             CurrentConsumption,
@@ -344,18 +459,21 @@ def update_current_consumption(supply_point, base_level):
             product=p
         )[0]
         consumption.total = 1
-        try:
-            ps = ProductStock.objects.get(supply_point=supply_point,
-                                          product=p)
-            consumption.current_daily_consumption = ps.daily_consumption or 0
-            consumption.stock_on_hand = ps.quantity or 0
-        except ObjectDoesNotExist:
+        if p.pk in product_stocks:
+            consumption.current_daily_consumption = consumptions[(supply_point.pk, p.pk)] or 0
+            consumption.stock_on_hand = product_stocks[p.pk].quantity or 0
+        else:
             consumption.current_daily_consumption = 0
             consumption.stock_on_hand = 0
-        consumption.save()
+        save_singular_model(consumption)
 
 
 def get_or_create_singular_model(reporting_model_class, **query_kwargs):
+    store = active_cell_store()
+    if store is not None:
+        found = store.get_or_create(reporting_model_class, **query_kwargs)
+        if found is not None:
+            return found
     try:
         return reporting_model_class.objects.get_or_create(
             **query_kwargs
@@ -368,6 +486,18 @@ def get_or_create_singular_model(reporting_model_class, **query_kwargs):
         return all_objects[0], False
 
 
+def save_singular_model(instance):
+    """
+    Save a model returned by get_or_create_singular_model, in the active
+    cell store if it came from there.
+    """
+    store = active_cell_store()
+    if store is not None and store.handles(instance):
+        store.save(instance)
+    else:
+        instance.save()
+
+
 def update_consumption_values(transactions):
     """
     Update the consumption calculations
@@ -425,7 +555,7 @@ def update_consumption_values(transactions):
                     if start.ending_balance == 0:
                         c.time_stocked_out += secs_in_window
                     
-                    c.save()
+                    save_singular_model(c)
 
 
 def update_alerts(hsas):
@@ -511,7 +641,7 @@ def update_consumption(report_period, base_level, products_managed=None):
             assert start_time.year == report_period.window_date.year
             assert start_time.month == report_period.window_date.month
             c.time_needing_data = delta_secs(report_period.period_end - start_time)
-            c.save()
+            save_singular_model(c)
         transactions = StockTransaction.objects.filter(
             supply_point=report_period.supply_point, product=p,
             date__gte=report_period.period_start,
@@ -536,7 +666,7 @@ def update_consumption_times(since):
         # if they supply the product it is already set in update_consumption, above
         if not c.supply_point.supplies(c.product):
             c.time_needing_data = c.time_with_data
-            c.save()
+            save_singular_model(c)
 
 
 def update_historical_data():
@@ -595,10 +725,34 @@ def update_historical_data_for_supply_point(sp, start=None, end=None):
     SupplyPointWarehouseRecord.objects.create(supply_point=sp, create_date=datetime.utcnow())
 
 
+def split_changed(supply_points, changed_ids):
+    """
+    Split the supply points into the ones that changed and the ones that didn't.
+    """
+    changed, unchanged = [], []
+    for supply_point in supply_points:
+        (changed if supply_point.id in changed_ids else unchanged).append(supply_point)
+    return changed, unchanged
+
+
+def get_ancestor_ids(supply_point_ids):
+    """
+    The ids of every supply point above any of the given ones.
+    """
+    ancestors = set()
+    current = set(supply_point_ids)
+    while current:
+        current = set(SupplyPoint.objects.filter(id__in=current).exclude(supplied_by=None)
+                      .values_list('supplied_by', flat=True)) - ancestors
+        ancestors |= current
+    return ancestors
+
+
 def proper_children(supply_point):
     if supply_point.type_id == SupplyPointCodes.COUNTRY:
         # Skip over zone
-        qs = SupplyPoint.objects.filter(active=True, supplied_by__supplied_by=supply_point)
+        qs = SupplyPoint.objects.filter(active=True, ancestor_links__ancestor=supply_point,
+                                        ancestor_links__depth=2)
     else:
         qs = SupplyPoint.objects.filter(active=True, supplied_by=supply_point)
 
@@ -682,7 +836,7 @@ def _update_reporting_rate(supply_point, report_period, products_managed, base_l
         if period_rr.complete:
             period_rr.reported = 1
 
-    period_rr.save()
+    save_singular_model(period_rr)
 
 
 def _update_product_availability(supply_point, report_period, all_products, products_managed, base_level):
@@ -726,15 +880,16 @@ def _update_product_availability(supply_point, report_period, all_products, prod
             else:
                 product_data.without_stock = 0
                 product_data.with_stock = 1
-                if product_stock.emergency_reorder_level and \
-                     trans.ending_balance <= product_stock.emergency_reorder_level:
+                levels = product_stock.stock_levels()
+                if levels.emergency_reorder_level and \
+                     trans.ending_balance <= levels.emergency_reorder_level:
                     product_data.emergency_stock = 1
-                if product_stock.reorder_level and \
-                     trans.ending_balance <= product_stock.reorder_level:
+                if levels.reorder_level and \
+                     trans.ending_balance <= levels.reorder_level:
                     product_data.under_stock = 1
                     product_data.over_stock = 0
-                elif product_stock.maximum_level and \
-                     trans.ending_balance > product_stock.maximum_level:
+                elif levels.maximum_level and \
+                     trans.ending_balance > levels.maximum_level:
                     product_data.under_stock = 0
                     product_data.over_stock = 1
                 else:
@@ -746,7 +901,7 @@ def _update_product_availability(supply_point, report_period, all_products, prod
             assert product_data.good_stock in (0, 1)
 
         product_data.set_managed_attributes()
-        product_data.save()
+        save_singular_model(product_data)
 
     # update the summary data
     product_summary = get_or_create_singular_model(
@@ -759,14 +914,18 @@ def _update_product_availability(supply_point, report_period, all_products, prod
 
     if products_managed:
         product_summary.any_managed = 1
-        agg_results = ProductAvailabilityData.objects.filter(
-            supply_point=supply_point,
-            date=report_period.window_date,
-            managed=1,
-            product__type__base_level=base_level
-        ).aggregate(
-            *[Max("managed_and_%s" % c) for c in ProductAvailabilityData.STOCK_CATEGORIES]
-        )
+        store = active_cell_store()
+        if store is not None and store.handles(product_summary):
+            agg_results = _managed_max_from_store(store, supply_point, report_period, all_products)
+        else:
+            agg_results = ProductAvailabilityData.objects.filter(
+                supply_point=supply_point,
+                date=report_period.window_date,
+                managed=1,
+                product__type__base_level=base_level
+            ).aggregate(
+                *[Max("managed_and_%s" % c) for c in ProductAvailabilityData.STOCK_CATEGORIES]
+            )
         for c in ProductAvailabilityData.STOCK_CATEGORIES:
             setattr(product_summary, "any_%s" % c,
                     agg_results["managed_and_%s__max" % c])
@@ -776,7 +935,24 @@ def _update_product_availability(supply_point, report_period, all_products, prod
         for c in ProductAvailabilityData.STOCK_CATEGORIES:
             setattr(product_summary, "any_%s" % c, 0)
 
-    product_summary.save()
+    save_singular_model(product_summary)
+
+
+def _managed_max_from_store(store, supply_point, report_period, all_products):
+    """
+    The in-memory equivalent of the Max aggregate over the managed products
+    in _update_product_availability.
+    """
+    product_ids = set(p.pk for p in all_products)
+    managed = [
+        pad for pad in store.cells(ProductAvailabilityData)
+        if pad.supply_point_id == supply_point.pk and pad.date == report_period.window_date
+        and pad.managed == 1 and pad.product_id in product_ids
+    ]
+    return dict(
+        ("managed_and_%s__max" % c, max(getattr(pad, "managed_and_%s" % c) for pad in managed) if managed else None)
+        for c in ProductAvailabilityData.STOCK_CATEGORIES
+    )
 
 
 def _update_lead_times(hsa, report_period):
@@ -799,7 +975,7 @@ def _update_lead_times(hsa, report_period):
         lt = delta_secs(r.responded_on - r.requested_on)
         or_tt.time_in_seconds += lt
         or_tt.total += 1
-    or_tt.save()
+    save_singular_model(or_tt)
 
     # ready-receieved
     requests_in_range = StockRequest.objects.filter(\
@@ -817,7 +993,7 @@ def _update_lead_times(hsa, report_period):
         lt = delta_secs(r.received_on - r.responded_on)
         rr_tt.time_in_seconds += lt
         rr_tt.total += 1
-    rr_tt.save()
+    save_singular_model(rr_tt)
 
 
 def _update_order_requests(hsa, report_period, all_products):
@@ -835,7 +1011,7 @@ def _update_order_requests(hsa, report_period, all_products):
         )[0]
         ord_req.total += requests_in_range.filter(product=p).count()
         ord_req.emergency += requests_in_range.filter(product=p, is_emergency=True).count()
-        ord_req.save()
+        save_singular_model(ord_req)
 
 
 def _update_order_fulfillment(hsa, report_period, all_products):
@@ -856,12 +1032,15 @@ def _update_order_fulfillment(hsa, report_period, all_products):
             order_fulfill.quantity_requested += r.amount_requested
             order_fulfill.quantity_received += r.amount_received
         if requests_in_range.count():
-            order_fulfill.save()
+            save_singular_model(order_fulfill)
 
 
 def _update_historical_stock(supply_point, report_period, all_products):
     # set the historical stock values to the last report before
     # the end of the period (even if it's not in the period)
+    stock = HistoricalStockCache.stock_as_of(
+        [supply_point.pk], [p.pk for p in all_products], report_period.period_end
+    )
     for p in all_products:
         hs = get_or_create_singular_model(
             HistoricalStock,
@@ -869,13 +1048,7 @@ def _update_historical_stock(supply_point, report_period, all_products):
             date=report_period.window_date,
             product=p,
         )[0]
-        transactions = StockTransaction.objects.filter(
-            supply_point=supply_point,
-            product=p,
-            date__lt=report_period.period_end,
-        ).order_by('-date')
-
         hs.total = 1
-        if transactions.count():
-            hs.stock = transactions[0].ending_balance
-        hs.save()
+        if (supply_point.pk, p.pk) in stock:
+            hs.stock = stock[(supply_point.pk, p.pk)]
+        save_singular_model(hs)
@@ -1,21 +1,17 @@
 from __future__ import unicode_literals
-from collections import OrderedDict
 
 from logistics_project.utils.dates import DateSpan
 from django.conf import settings
 from django.contrib import messages
 
-from logistics.models import Product, SupplyPoint
 from logistics.reports import ReportView
 from logistics.util import config
 
-from logistics_project.apps.malawi.util import (get_facilities, get_districts,
-    get_country_sp, pct, get_default_supply_point, get_visible_districts,
-    get_visible_facilities, get_all_visible_locations, get_view_level, get_visible_hsas,
-    filter_district_queryset_for_epi, filter_district_list_for_epi,
+from logistics_project.apps.malawi.util import (get_districts, get_visible_facilities,
+    get_visible_hsas, filter_district_queryset_for_epi, filter_district_list_for_epi,
     filter_facility_location_queryset_for_epi)
-from logistics_project.apps.malawi.warehouse.models import ProductAvailabilityData, ReportingRate
-from logistics_project.apps.malawi.warehouse.report_utils import current_report_period
+from logistics_project.apps.malawi.warehouse.models import ReportingRate
+from logistics_project.apps.malawi.warehouse.reference import reference_data
 
 
 class MalawiWarehouseView(ReportView):
@@ -32,10 +28,7 @@ class MalawiWarehouseView(ReportView):
         This method assumes that it's being called from a view that uses the
         @place_in_request decorator.
         """
-        if request.location:
-            return SupplyPoint.objects.get(location=request.location)
-
-        return get_default_supply_point(request.user)
+        return reference_data(request).reporting_supply_point
 
     def get_min_start_date(self, request):
         """
@@ -76,27 +69,13 @@ class MalawiWarehouseView(ReportView):
     def shared_context(self, request):
         base_context = super(MalawiWarehouseView, self).shared_context(request)
 
-        country = get_country_sp()
-        products = Product.objects.filter(
-            is_active=True,
-            type__base_level=request.base_level
-        ).order_by('sms_code')
-        date = current_report_period()
-        
+        reference = reference_data(request)
+        country = reference.country_sp
+        products = reference.products(request.base_level)
+        date = reference.report_period
+
         # national stockout percentages by product
-        stockout_pcts = OrderedDict()
-        for p in products:
-            try:
-                availability = ProductAvailabilityData.objects.get(
-                    supply_point=country,
-                    date=date,
-                    product=p
-                )
-                stockout_pcts[p] = (pct(availability.managed_and_without_stock,
-                                        availability.managed),
-                                    availability.managed)
-            except ProductAvailabilityData.DoesNotExist:
-                stockout_pcts[p] = ('?', '?')
+        stockout_pcts = reference.national_stockout_pcts(request.base_level)
 
         pct_reported = '?'
         try:
@@ -107,22 +86,19 @@ class MalawiWarehouseView(ReportView):
         except ReportingRate.DoesNotExist:
             pass
 
-        default_sp = get_default_supply_point(request.user)
+        default_sp = reference.default_supply_point
         districts = get_districts(request.user.is_superuser)
         visible_facilities = get_visible_facilities(request.user).order_by('parent_id')
         visible_hsas = []
 
         if request.base_level_is_hsa:
             visible_hsas = get_visible_hsas(request.user)
-            all_districts = get_districts()
         elif request.base_level_is_facility:
             districts = filter_district_queryset_for_epi(districts)
             visible_facilities = filter_facility_location_queryset_for_epi(visible_facilities)
-            all_districts = filter_district_queryset_for_epi(get_districts())
 
         # Get counts for national view sidebar
-        district_count = all_districts.count()
-        facility_count = get_facilities().filter(parent_id__in=all_districts.values_list('id', flat=True)).count()
+        counts = reference.national_counts(request.base_level)
 
         querystring = '?'
         for key in list(request.GET.keys()):
@@ -132,18 +108,18 @@ class MalawiWarehouseView(ReportView):
             "default_chart_width": 730,
             "country": country,
             "districts": districts,
-            "district_count": district_count,
+            "district_count": counts['district_count'],
             "facilities": visible_facilities,
-            "facility_count": facility_count,
+            "facility_count": counts['facility_count'],
             "visible_hsas": visible_hsas,
-            "hsas": SupplyPoint.objects.filter(active=True, type__code="hsa").count(),
+            "hsas": counts['hsas'],
             "reporting_rate": pct_reported,
             "products": products,
             "product_stockout_pcts": stockout_pcts,
             "location": request.location or default_sp.location,
             "querystring": querystring,
             "show_report_nav": self.show_report_nav,
-            "window_date": current_report_period(),
+            "window_date": date,
             "base_level": request.base_level,
             "base_level_is_hsa": request.base_level_is_hsa,
             "base_level_is_facility": request.base_level_is_facility,
@@ -170,12 +146,12 @@ class DashboardView(MalawiWarehouseView):
     def can_view(self, request):
         if request.user.is_superuser: return True
         else:
-            return request.location in get_all_visible_locations(request.user)\
+            return request.location in reference_data(request).all_visible_locations\
                 if request.location else True
 
     def shared_context(self, request):
         base_context = super(DashboardView, self).shared_context(request)
-        view_level = get_view_level(request.user)
+        view_level = reference_data(request).view_level
         base_context["national_view_level"] = view_level
         return base_context
 
@@ -190,16 +166,16 @@ class DistrictOnlyView(MalawiWarehouseView):
     def can_view(self, request):
         if request.user.is_superuser: return True
         else:
-            return request.location in get_all_visible_locations(request.user)\
+            return request.location in reference_data(request).all_visible_locations\
                 if request.location else True
 
     def shared_context(self, request):
         base_context = super(DistrictOnlyView, self).shared_context(request)
-        visible_districts = get_visible_districts(request.user)
+        visible_districts = reference_data(request).visible_districts
         if request.base_level_is_facility:
             visible_districts = filter_district_list_for_epi(visible_districts)
 
-        view_level = get_view_level(request.user)
+        view_level = reference_data(request).view_level
         base_context["districts"] = visible_districts
         base_context["national_view_level"] = view_level == 'national'
         return base_context